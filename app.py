@@ -6,18 +6,30 @@ import json
 import re
 import secrets
 import base64
+import binascii
 import mimetypes
 import threading
 import logging
 import hashlib
+import itertools
+import atexit
+import struct
+import math
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, render_template, send_from_directory, make_response, Response
-from PIL import Image
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask import Flask, request, jsonify, render_template, send_from_directory, send_file, make_response, redirect, Response
+from PIL import Image, ImageFilter
 import io
 import sqlite3
 from functools import wraps, lru_cache
+from contextlib import contextmanager
 import traceback
 import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import unquote
+from collections import deque, OrderedDict
 
 # ===== НАСТРОЙКА ЛОГИРОВАНИЯ =====
 logging.basicConfig(
@@ -49,19 +61,277 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600  # Кэширование ста
 DB_PATH = 'cloudchat.db'
 MESSAGE_HISTORY_LIMIT = 500
 INACTIVITY_TIMEOUT = 600  # 10 минут для автомосвобождения
-MAX_SSE_CONNECTIONS = 100  # Максимум SSE соединений
-SSE_CONNECTIONS = {}
-SSE_LOCK = threading.RLock()
+MAX_SSE_CONNECTIONS = int(os.environ.get('MAX_SSE_CONNECTIONS', 900))  # worker_connections минус запас на обычные запросы
+# Сколько доверенных прокси стоит перед приложением: адрес клиента берется из X-Forwarded-For.
+# 0 - заголовку не доверяем (его может подделать любой клиент)
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
-# Глобальные переменные с блокировками
-ONLINE_USERS = set()
-USER_LAST_ACTIVE = {}
-USER_PREFERENCES = {}  # {username: {'gender': 'male', 'age_group': '18-25', 'search_gender': 'any', 'search_age': 'any'}}
+# ===== ОЧЕРЕДЬ ОЖИДАНИЯ =====
+class WaitQueue:
+    """Очередь ожидания: O(1) проверка, O(log n) удаление и позиция (дерево Фенвика)"""
+    def __init__(self, capacity=1024):
+        self.initial_capacity = capacity
+        self.slots = {}  # {username: slot} - порядок вставки совпадает с порядком очереди
+        self.tree = [0] * (capacity + 1)
+        self.next_slot = 0
+        self.lock = threading.RLock()
+    
+    def __contains__(self, username):
+        return username in self.slots
+    
+    def __len__(self):
+        return len(self.slots)
+    
+    def __iter__(self):
+        return iter(self.snapshot())
+    
+    def snapshot(self):
+        """Копия очереди в порядке ожидания"""
+        with self.lock:
+            return list(self.slots)
+    
+    def append(self, username):
+        with self.lock:
+            if username in self.slots:
+                return False
+            if self.next_slot >= len(self.tree) - 1:
+                self._rebuild()
+            slot = self.next_slot
+            self.next_slot += 1
+            self.slots[username] = slot
+            self._add(slot, 1)
+            return True
+    
+    def remove(self, username):
+        with self.lock:
+            slot = self.slots.pop(username, None)
+            if slot is None:
+                return False
+            self._add(slot, -1)
+            return True
+    
+    def position(self, username):
+        """Позиция в очереди (с 1), 0 - если пользователя нет в очереди"""
+        with self.lock:
+            slot = self.slots.get(username)
+            if slot is None:
+                return 0
+            return self._prefix(slot)
+    
+    def _add(self, slot, delta):
+        i = slot + 1
+        size = len(self.tree)
+        while i < size:
+            self.tree[i] += delta
+            i += i & -i
+    
+    def _prefix(self, slot):
+        i = slot + 1
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+    
+    def _rebuild(self):
+        """Уплотнение слотов и увеличение емкости дерева, амортизированно O(1)"""
+        capacity = max(self.initial_capacity, len(self.slots) * 2)
+        self.tree = [0] * (capacity + 1)
+        for slot, username in enumerate(self.slots):
+            self.slots[username] = slot
+            self.tree[slot + 1] = 1
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[i]
+        self.next_slot = len(self.slots)
+
+# ===== ИСТОРИЯ ЧАТА =====
+class MessageRing:
+    """Кольцевой буфер последних сообщений чата с порядковыми номерами (seq)"""
+    # Номера идут подряд, поэтому ячейка вычисляется из seq: выборка "всё после seq" без поиска.
+    # Изменяется только под блокировкой чата.
+    def __init__(self, capacity=MESSAGE_HISTORY_LIMIT):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.last_seq = 0
+        self.count = 0
+    
+    @property
+    def first_seq(self):
+        """Номер самого старого сообщения, оставшегося в буфере"""
+        return self.last_seq - self.count + 1
+    
+    def append(self, msg):
+        self.last_seq += 1
+        msg['seq'] = self.last_seq
+        self.slots[self.last_seq % self.capacity] = msg
+        self.count = min(self.count + 1, self.capacity)
+        return self.last_seq
+    
+    def since(self, seq):
+        """Сообщения с номером больше seq из тех, что еще в буфере"""
+        start = max(seq + 1, self.first_seq)
+        return [self.slots[s % self.capacity] for s in range(start, self.last_seq + 1)]
+    
+    def last(self):
+        return self.slots[self.last_seq % self.capacity] if self.count else None
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        return iter(self.since(0))
+
+# ===== ХРАНИЛИЩЕ СОСТОЯНИЯ =====
+STATE_LOCK_STRIPES = 64
+
+class StateStore:
+    """Общее состояние пользователей и чатов под полосатыми блокировками"""
+    # Полосы захватываются только через locked() одним вызовом и всегда по возрастанию
+    # номера, поэтому составные операции не взаимоблокируются. Под gevent threading.RLock
+    # подменяется блокировкой, которая знает о гринлетах.
+    def __init__(self, stripes=STATE_LOCK_STRIPES):
+        self.online_users = set()
+        self.last_active = {}
+        self.preferences = {}
+        self.private_chats = {}
+        self.users_in_chat = {}
+        self.waiting = WaitQueue()
+        self.stripes = [threading.RLock() for _ in range(stripes)]
+    
+    @contextmanager
+    def locked(self, *keys):
+        """Захват полос для набора ключей (логинов) в фиксированном порядке"""
+        indexes = sorted({hash(key) % len(self.stripes) for key in keys if key})
+        for index in indexes:
+            self.stripes[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self.stripes[index].release()
+    
+    def chat_keys(self, chat):
+        """Ключи блокировки чата - его участники"""
+        return (chat['user1'], chat['user2'])
+    
+    def chat_locked(self, chat):
+        return self.locked(*self.chat_keys(chat))
+    
+    def _user_chat_keys(self, username):
+        chat = self.private_chats.get(self.users_in_chat.get(username))
+        return self.chat_keys(chat) if chat else ()
+    
+    def pair_users(self, user1, user2, now):
+        """Атомарно соединить двух пользователей в новый чат; None - если кто-то уже занят"""
+        if user1 == user2:
+            return None
+        
+        with self.locked(user1, user2):
+            for user in (user1, user2):
+                if user in self.users_in_chat or user not in self.online_users:
+                    return None
+            
+            chat_id = str(uuid.uuid4())
+            self.private_chats[chat_id] = {
+                'users': {user1, user2},
+                'messages': MessageRing(),
+                'created_at': now,
+                'last_activity': now,
+                'user1': user1,
+                'user2': user2,
+                'status': 'active'
+            }
+            self.users_in_chat[user1] = chat_id
+            self.users_in_chat[user2] = chat_id
+            
+            # Удаляем пользователей из очереди ожидания
+            remove_from_waiting(user1, matched=True)
+            remove_from_waiting(user2, matched=True)
+        
+        return chat_id
+    
+    def detach_from_chat(self, username):
+        """Атомарный выход из чата: {'chat_id', 'chat', 'partner', 'closed'} или {} без чата"""
+        while True:
+            keys = self._user_chat_keys(username)
+            with self.locked(username, *keys):
+                # Чат сменился между чтением и захватом - повторяем
+                if self._user_chat_keys(username) != keys:
+                    continue
+                return self._detach(username)
+    
+    def remove_user(self, username, inactive_before=None):
+        """Атомарно убрать пользователя отовсюду; None - если он успел проявить активность"""
+        while True:
+            keys = self._user_chat_keys(username)
+            with self.locked(username, *keys):
+                if self._user_chat_keys(username) != keys:
+                    continue
+                
+                if inactive_before is not None and self.last_active.get(username, 0) >= inactive_before:
+                    return None
+                
+                left = self._detach(username)
+                self.online_users.discard(username)
+                self.preferences.pop(username, None)
+                self.last_active.pop(username, None)
+                remove_from_waiting(username)
+                return left
+    
+    def drop_chat(self, chat_id, inactive_before):
+        """Удалить чат, если в нем не было активности с момента inactive_before"""
+        chat = self.private_chats.get(chat_id)
+        if not chat:
+            return False
+        
+        with self.chat_locked(chat):
+            chat = self.private_chats.get(chat_id)
+            if not chat or chat.get('last_activity', 0) >= inactive_before:
+                return False
+            
+            del self.private_chats[chat_id]
+            for user in chat['users']:
+                if self.users_in_chat.get(user) == chat_id:
+                    del self.users_in_chat[user]
+            return True
+    
+    def _detach(self, username):
+        chat_id = self.users_in_chat.pop(username, None)
+        chat = self.private_chats.get(chat_id)
+        if not chat:
+            return {}
+        
+        chat['users'].discard(username)
+        chat['last_activity'] = time.time()
+        chat['status'] = 'inactive'
+        
+        # Удаляем чат если оба пользователя вышли
+        closed = not chat['users']
+        if closed:
+            del self.private_chats[chat_id]
+        
+        return {
+            'chat_id': chat_id,
+            'chat': chat,
+            'partner': next(iter(chat['users']), None),
+            'closed': closed
+        }
+
+STATE = StateStore()
+
+# Глобальные переменные (принадлежат STATE, изменяются под STATE.locked)
+ONLINE_USERS = STATE.online_users
+USER_LAST_ACTIVE = STATE.last_active
+USER_PREFERENCES = STATE.preferences  # {username: {'gender': 'male', 'age_group': '18-25', 'search_gender': 'any', 'search_age': 'any'}}
 
 # ===== ПРИВАТНЫЕ ЧАТЫ =====
-PRIVATE_CHATS = {}  # {chat_id: {'users': set(user1, user2), 'messages': [], 'created_at': timestamp, 'last_activity': timestamp}}
-USERS_IN_CHAT = {}  # {username: chat_id} - для быстрого поиска в каком чате пользователь
-WAITING_USERS = []  # Очередь пользователей, ожидающих собеседника
+PRIVATE_CHATS = STATE.private_chats  # {chat_id: {'users': set(user1, user2), 'messages': MessageRing, 'created_at': timestamp, 'last_activity': timestamp}}
+USERS_IN_CHAT = STATE.users_in_chat  # {username: chat_id} - для быстрого поиска в каком чате пользователь
+WAITING_USERS = STATE.waiting  # Очередь пользователей, ожидающих собеседника
 
 # Очередь событий
 event_queue = queue.Queue()
@@ -155,41 +425,320 @@ def is_compatible_by_preferences(user1_prefs, user2_prefs):
     
     return gender_ok1 and age_ok1 and gender_ok2 and age_ok2
 
+# ===== ИНДЕКС СОПОСТАВЛЕНИЯ =====
+def preferences_key(prefs):
+    """Ключ корзины индекса: (пол, возраст, искомый пол, искомый возраст)"""
+    return (
+        prefs.get('gender', 'unknown'),
+        prefs.get('age_group', 'unknown'),
+        prefs.get('search_gender', 'any'),
+        prefs.get('search_age', 'any')
+    )
+
+@lru_cache(maxsize=4096)
+def is_compatible_keys(key1, key2):
+    """Совместимость двух корзин (корзин немного, поэтому результат кэшируется)"""
+    fields = ('gender', 'age_group', 'search_gender', 'search_age')
+    return is_compatible_by_preferences(dict(zip(fields, key1)), dict(zip(fields, key2)))
+
+class MatchmakingIndex:
+    """Индекс ожидающих пользователей, разложенных по корзинам предпочтений"""
+    def __init__(self):
+        self.buckets = {}  # {key: {username: seq}} - внутри корзины порядок ожидания
+        self.user_keys = {}  # {username: key}
+        self.user_seqs = {}  # {username: seq}
+        self.seq = itertools.count()
+        self.lock = threading.RLock()
+    
+    def __contains__(self, username):
+        return username in self.user_keys
+    
+    def __len__(self):
+        return len(self.user_keys)
+    
+    def add(self, username, prefs):
+        """Добавление пользователя (или перенос в новую корзину при смене предпочтений)"""
+        key = preferences_key(prefs)
+        with self.lock:
+            old_key = self.user_keys.get(username)
+            if old_key == key:
+                return
+            
+            if old_key is not None:
+                self._discard_from_bucket(username, old_key)
+                seq = self.user_seqs[username]
+            else:
+                seq = next(self.seq)
+                self.user_seqs[username] = seq
+            
+            bucket = self.buckets.setdefault(key, {})
+            bucket[username] = seq
+            # При смене предпочтений сохраняем место в очереди - восстанавливаем порядок корзины
+            if old_key is not None and len(bucket) > 1:
+                self.buckets[key] = dict(sorted(bucket.items(), key=lambda item: item[1]))
+            
+            self.user_keys[username] = key
+    
+    def update(self, username, prefs):
+        """Обновление предпочтений пользователя, если он есть в индексе"""
+        with self.lock:
+            if username in self.user_keys:
+                self.add(username, prefs)
+    
+    def remove(self, username):
+        """Удаление пользователя из индекса"""
+        with self.lock:
+            key = self.user_keys.pop(username, None)
+            self.user_seqs.pop(username, None)
+            if key is not None:
+                self._discard_from_bucket(username, key)
+    
+    def _discard_from_bucket(self, username, key):
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.pop(username, None)
+            if not bucket:
+                del self.buckets[key]
+    
+    def find_partner(self, username, prefs, accept=None):
+        """Самый давно ожидающий совместимый пользователь; просматриваются только подходящие корзины"""
+        key = preferences_key(prefs)
+        best = None
+        best_seq = None
+        
+        with self.lock:
+            for bucket_key, bucket in self.buckets.items():
+                if not is_compatible_keys(key, bucket_key):
+                    continue
+                
+                for candidate, seq in bucket.items():
+                    if best_seq is not None and seq >= best_seq:
+                        break
+                    if candidate == username:
+                        continue
+                    if accept is not None and not accept(candidate):
+                        continue
+                    best, best_seq = candidate, seq
+                    break
+        
+        return best
+    
+    def plan_pairs(self, accept=None):
+        """Пары для всей очереди за один проход; самые давние ожидающие выбирают первыми"""
+        with self.lock:
+            # Совместимость считается по кодам корзин (k*k), а не по парам пользователей (n*n)
+            keys = list(self.buckets)
+            compatible = {key: [other for other in keys if is_compatible_keys(key, other)] for key in keys}
+            heads = {
+                key: deque(user for user in bucket if accept is None or accept(user))
+                for key, bucket in self.buckets.items()
+            }
+            user_keys = dict(self.user_keys)
+            seqs = dict(self.user_seqs)
+        
+        done = set()
+        pairs = []
+        
+        order = sorted((user for key_heads in heads.values() for user in key_heads), key=seqs.__getitem__)
+        for user in order:
+            if user in done:
+                continue
+            done.add(user)
+            
+            best = None
+            for other_key in compatible[user_keys[user]]:
+                candidates = heads[other_key]
+                while candidates and candidates[0] in done:
+                    candidates.popleft()
+                if candidates and (best is None or seqs[candidates[0]] < seqs[best]):
+                    best = candidates[0]
+            
+            if best is not None:
+                done.add(best)
+                pairs.append((user, best))
+        
+        return pairs
+
+MATCHMAKING_INDEX = MatchmakingIndex()
+
+# ===== ПЛАНИРОВЩИК СОПОСТАВЛЕНИЯ =====
+MATCHMAKING_DEBOUNCE = 0.05  # Окно объединения всплесков входов (сек)
+MATCHMAKING_IDLE_INTERVAL = 30  # Страховочный проход при отсутствии событий (сек)
+
+def percentile(sorted_values, pct):
+    """Перцентиль по отсортированной выборке"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class MatchmakingScheduler:
+    """Сопоставление по событиям: просыпается при изменении очереди, а не раз в 5 секунд"""
+    def __init__(self, debounce=MATCHMAKING_DEBOUNCE, idle_interval=MATCHMAKING_IDLE_INTERVAL, samples=1000):
+        self.debounce = debounce
+        self.idle_interval = idle_interval
+        self.wakeup = threading.Event()
+        self.enqueued_at = {}  # {username: timestamp}
+        self.match_times = deque(maxlen=samples)
+        self.passes = 0
+        self.matched = 0
+        self.started = False
+        self.lock = threading.RLock()
+    
+    def start(self):
+        """Запуск фонового потока (повторный вызов ничего не делает)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.run, daemon=True, name="matchmaking").start()
+    
+    def notify(self):
+        """Разбудить планировщик"""
+        self.wakeup.set()
+    
+    def record_enqueue(self, username):
+        with self.lock:
+            self.enqueued_at.setdefault(username, time.time())
+    
+    def record_dequeue(self, username, matched=False):
+        with self.lock:
+            since = self.enqueued_at.pop(username, None)
+            if matched and since is not None:
+                self.match_times.append(time.time() - since)
+                self.matched += 1
+    
+    def run(self):
+        """Фоновый процесс для сопоставления пользователей"""
+        while True:
+            self.wakeup.wait(self.idle_interval)
+            # Даем всплеску входов собраться в один проход
+            time.sleep(self.debounce)
+            self.wakeup.clear()
+            
+            try:
+                self.passes += 1
+                match_waiting_users()
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике сопоставления: {e}")
+    
+    def stats(self):
+        """Статистика времени до сопоставления"""
+        with self.lock:
+            samples = sorted(self.match_times)
+            waiting = len(self.enqueued_at)
+        
+        p50 = percentile(samples, 50)
+        p99 = percentile(samples, 99)
+        return {
+            'waiting': waiting,
+            'passes': self.passes,
+            'matched': self.matched,
+            'time_to_match_p50': round(p50, 3) if p50 is not None else None,
+            'time_to_match_p99': round(p99, 3) if p99 is not None else None
+        }
+
+MATCHMAKING_SCHEDULER = MatchmakingScheduler()
+
+class QueuePositionNotifier:
+    """Рассылка позиций в очереди через SSE вместо опроса /chat_status"""
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.dirty = threading.Event()
+        self.last_sent = {}  # {username: position}
+        self.started = False
+        self.lock = threading.RLock()
+    
+    def start(self):
+        """Запуск фонового потока (повторный вызов ничего не делает)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.run, daemon=True, name="queue_positions").start()
+    
+    def mark_dirty(self):
+        self.dirty.set()
+    
+    def run(self):
+        while True:
+            self.dirty.wait()
+            # Изменения очереди за интервал уходят одной рассылкой
+            time.sleep(self.interval)
+            self.dirty.clear()
+            
+            try:
+                self.push()
+            except Exception as e:
+                logger.error(f"Ошибка рассылки позиций очереди: {e}")
+    
+    def push(self):
+        """Отправка позиции только тем, у кого она изменилась"""
+        waiting = WAITING_USERS.snapshot()
+        queue_size = len(waiting)
+        sent = {}
+        
+        for position, user in enumerate(waiting, 1):
+            if self.last_sent.get(user) == position:
+                sent[user] = position
+                continue
+            
+            notification = {
+                'type': 'queue_position',
+                'position': position,
+                'queue_size': queue_size,
+                'timestamp': time.time()
+            }
+            if send_push_notification(user, notification):
+                sent[user] = position
+        
+        self.last_sent = sent
+
+QUEUE_POSITION_NOTIFIER = QueuePositionNotifier()
+
+def add_to_waiting(username):
+    """Добавить пользователя в очередь ожидания и индекс сопоставления"""
+    if WAITING_USERS.append(username):
+        QUEUE_POSITION_NOTIFIER.mark_dirty()
+    MATCHMAKING_INDEX.add(username, USER_PREFERENCES.get(username, {}))
+    MATCHMAKING_SCHEDULER.record_enqueue(username)
+    MATCHMAKING_SCHEDULER.notify()
+
+def remove_from_waiting(username, matched=False):
+    """Удалить пользователя из очереди ожидания и индекса сопоставления"""
+    if WAITING_USERS.remove(username):
+        QUEUE_POSITION_NOTIFIER.mark_dirty()
+    MATCHMAKING_INDEX.remove(username)
+    MATCHMAKING_SCHEDULER.record_dequeue(username, matched=matched)
+
 # ===== ФУНКЦИИ ДЛЯ ПРИВАТНЫХ ЧАТОВ =====
 def create_private_chat(user1, user2):
-    """Создание приватного чата между двумя пользователями"""
-    chat_id = str(uuid.uuid4())
+    """Создание приватного чата между двумя пользователями; None - если пара уже занята"""
+    created = create_private_chats([(user1, user2)])
+    return created[0][0] if created else None
+
+def create_private_chats(pairs):
+    """Создание приватных чатов для списка пар одним пакетом: [(chat_id, user1, user2), ...]"""
     now = time.time()
+    chats = []
     
-    with threading.RLock():
-        PRIVATE_CHATS[chat_id] = {
-            'users': {user1, user2},
-            'messages': [],
-            'created_at': now,
-            'last_activity': now,
-            'user1': user1,
-            'user2': user2,
-            'status': 'active'
-        }
-        USERS_IN_CHAT[user1] = chat_id
-        USERS_IN_CHAT[user2] = chat_id
+    for user1, user2 in pairs:
+        chat_id = STATE.pair_users(user1, user2, now)
+        if not chat_id:
+            continue
         
-        # Удаляем пользователей из очереди ожидания
-        if user1 in WAITING_USERS:
-            WAITING_USERS.remove(user1)
-        if user2 in WAITING_USERS:
-            WAITING_USERS.remove(user2)
+        chats.append((chat_id, user1, user2, now))
+        logger.info(f"Создан приватный чат {chat_id} между {user1} и {user2}")
     
-    # Сохраняем в БД
-    threading.Thread(target=save_private_chat, args=(chat_id, user1, user2, now), daemon=True).start()
+    # Сохраняем в БД одной транзакцией
+    if chats:
+        threading.Thread(target=save_private_chats, args=(chats,), daemon=True).start()
     
-    logger.info(f"Создан приватный чат {chat_id} между {user1} и {user2}")
-    return chat_id
+    return [(chat_id, user1, user2) for chat_id, user1, user2, _ in chats]
 
 def get_user_chat(username):
     """Получить ID чата пользователя"""
-    with threading.RLock():
-        return USERS_IN_CHAT.get(username)
+    return USERS_IN_CHAT.get(username)
 
 def get_chat_partner(username):
     """Получить собеседника пользователя"""
@@ -202,80 +751,524 @@ def get_chat_partner(username):
             return next(iter(users), None)
     return None
 
-def remove_user_from_all_queues(username):
-    """Удалить пользователя из всех очередей и систем"""
-    with threading.RLock():
-        # Удаляем из онлайн пользователей
-        if username in ONLINE_USERS:
-            ONLINE_USERS.discard(username)
-        
-        # Удаляем из очереди ожидания
-        if username in WAITING_USERS:
-            WAITING_USERS.remove(username)
+def append_chat_message(chat, msg):
+    """Добавление сообщения в историю чата под его блокировкой"""
+    with STATE.chat_locked(chat):
+        chat['messages'].append(msg)
+    CHAT_WAITERS.notify(msg.get('chat_id'))
+
+def remove_user_from_all_queues(username, inactive_before=None):
+    """Удалить пользователя из всех очередей и систем, включая текущий чат"""
+    left = STATE.remove_user(username, inactive_before=inactive_before)
+    if left is None:
+        return False
+    
+    notify_chat_exit(username, left)
+    
+    # Закрываем SSE соединения всех вкладок
+    with SSE_HUB.lock:
+        SSE_HUB.close_login(username)
+        SSE_HISTORY.discard(username)
+    
+    return True
+
+def leave_private_chat(username):
+    """Пользователь выходит из приватного чата"""
+    return notify_chat_exit(username, STATE.detach_from_chat(username))
+
+def notify_chat_exit(username, left):
+    """Уведомление собеседника и обновление БД после выхода пользователя из чата"""
+    if not left:
+        return False
+    
+    chat_id = left['chat_id']
+    
+    # Уведомляем второго пользователя
+    if left['partner']:
+        system_msg = {
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'login': 'Система',
+            'text': f'{username} покинул чат',
+            'ts': time.time(),
+            'isvoice': False,
+            'mediatype': 'system',
+            'sound': LOGOUT_SOUND_DATA
+        }
         
-        # Удаляем предпочтения
-        if username in USER_PREFERENCES:
-            del USER_PREFERENCES[username]
+        # Сохраняем системное сообщение
+        append_chat_message(left['chat'], system_msg)
         
-        # Удаляем активность
-        if username in USER_LAST_ACTIVE:
-            del USER_LAST_ACTIVE[username]
+        # Рассылаем уведомление
+        broadcast_to_chat(chat_id, system_msg, exclude_login=username)
+    
+    # Долгий опрос вышедшего должен сразу узнать, что доступа больше нет
+    CHAT_WAITERS.notify(chat_id)
+    
+    # Обновляем статус в БД
+    status = 'closed' if left['closed'] else 'inactive'
+    threading.Thread(target=update_chat_status, args=(chat_id, status), daemon=True).start()
+    
+    logger.info(f"Пользователь {username} покинул чат {chat_id}")
+    return True
+
+# ===== СХЕМЫ СОБЫТИЙ SSE =====
+SSE_SCHEMA_LEGACY = 1   # Полное сообщение и звук data URI (старые клиенты)
+SSE_SCHEMA_COMPACT = 2  # Только ссылки и метаданные; клиент подключается с ?v=2
+COMPACT_MESSAGE_FIELDS = (
+    'id', 'chat_id', 'seq', 'login', 'ts', 'mediatype', 'text', 'filename', 'filesize',
+    'media_url', 'placeholder_url', 'thumb_url', 'full_url'
+)
+SOUND_KEYS = {
+    NOTIFICATION_SOUND_DATA: 'notification',
+    LOGOUT_SOUND_DATA: 'logout'
+}
+
+def sse_schema(version):
+    """Схема событий по параметру v запроса /events"""
+    return SSE_SCHEMA_COMPACT if str(version) == str(SSE_SCHEMA_COMPACT) else SSE_SCHEMA_LEGACY
+
+def sound_key(sound):
+    """Ключ звука вместо data URI: звуки лежат у клиента"""
+    return SOUND_KEYS.get(sound, 'notification') if sound else None
+
+def compact_message(msg):
+    """Сообщение без медиаданных и служебных полей: только id, отправитель, время, тип, размер и ссылки"""
+    return {key: msg[key] for key in COMPACT_MESSAGE_FIELDS if msg.get(key)}
+
+def compact_event(notification):
+    """Событие в компактной схеме; остальные типы событий и так малы"""
+    if notification.get('type') != 'private_message':
+        return notification
+    
+    event = {
+        'type': 'private_message',
+        'chat_id': notification.get('chat_id'),
+        'data': compact_message(notification.get('data') or {})
+    }
+    sound = sound_key(notification.get('sound'))
+    if sound:
+        event['sound'] = sound
+    return event
+
+def encode_event(notification, schema=SSE_SCHEMA_LEGACY):
+    """Событие в виде, который ожидает подключенный клиент"""
+    if schema == SSE_SCHEMA_COMPACT:
+        return compact_event(notification)
+    return notification
+
+SSE_HISTORY_SIZE = 256  # Событий в кольцевом буфере пользователя для дозагрузки
+SSE_EVENT_IDS = itertools.count(1)
+
+def sse_frame(payload, event_id=None):
+    """Готовый к отправке кадр SSE в байтах"""
+    frame = f"data: {json.dumps(payload)}\n\n"
+    if event_id is not None:
+        frame = f"id: {event_id}\n{frame}"
+    return frame.encode('utf-8')
+
+class SSEEncodingStats:
+    """Стоимость сериализации и размер кадров по типам событий"""
+    def __init__(self):
+        self.types = {}  # {event_type: [events, frames, encode_time, bytes]}
+        self.lock = threading.RLock()
+    
+    def record_event(self, event_type):
+        with self.lock:
+            self.types.setdefault(event_type, [0, 0, 0.0, 0])[0] += 1
+    
+    def record_frame(self, event_type, elapsed, size):
+        with self.lock:
+            entry = self.types.setdefault(event_type, [0, 0, 0.0, 0])
+            entry[1] += 1
+            entry[2] += elapsed
+            entry[3] += size
+    
+    def stats(self):
+        with self.lock:
+            return {
+                event_type: {
+                    'events': events,
+                    'frames': frames,
+                    'avg_encode_ms': round(encode_time / frames * 1000, 3) if frames else 0,
+                    'avg_frame_bytes': round(size / frames) if frames else 0
+                }
+                for event_type, (events, frames, encode_time, size) in self.types.items()
+            }
+
+SSE_ENCODING_STATS = SSEEncodingStats()
+
+class SSEEvent:
+    """Событие для рассылки: сериализуется один раз на схему, кадр общий для всех подписчиков"""
+    __slots__ = ('id', 'type', 'payload', 'frames', 'lock')
+    
+    def __init__(self, payload):
+        self.id = next(SSE_EVENT_IDS)
+        self.type = payload.get('type', 'message')
+        self.payload = payload
+        self.frames = {}  # {schema: bytes}
+        self.lock = threading.Lock()
+        SSE_ENCODING_STATS.record_event(self.type)
+    
+    def frame(self, schema=SSE_SCHEMA_LEGACY):
+        frame = self.frames.get(schema)
+        if frame is not None:
+            return frame
         
-        # Закрываем SSE соединение
-        with SSE_LOCK:
-            if username in SSE_CONNECTIONS:
-                try:
-                    SSE_CONNECTIONS.pop(username, None)
-                except:
-                    pass
+        with self.lock:
+            frame = self.frames.get(schema)
+            if frame is not None:
+                return frame
+            
+            started = time.time()
+            payload = encode_event(self.payload, schema)
+            unchanged = payload is self.payload
+            if unchanged:
+                # Схема не меняет событие - кадр общий со старой схемой
+                frame = self.frames.get(SSE_SCHEMA_LEGACY)
+            if frame is None:
+                frame = sse_frame(payload, self.id)
+                SSE_ENCODING_STATS.record_frame(self.type, time.time() - started, len(frame))
+                if unchanged:
+                    self.frames[SSE_SCHEMA_LEGACY] = frame
+            self.frames[schema] = frame
+            return frame
 
-def leave_private_chat(username):
-    """Пользователь выходит из приватного чата"""
-    chat_id = get_user_chat(username)
-    if chat_id:
-        with threading.RLock():
-            chat = PRIVATE_CHATS.get(chat_id)
-            if chat:
-                chat['users'].discard(username)
-                chat['last_activity'] = time.time()
-                chat['status'] = 'inactive'
-                
-                # Уведомляем второго пользователя
-                partner = get_chat_partner(username)
-                if partner:
-                    system_msg = {
-                        'id': str(uuid.uuid4()),
-                        'chat_id': chat_id,
-                        'login': 'Система',
-                        'text': f'{username} покинул чат',
-                        'ts': time.time(),
-                        'isvoice': False,
-                        'mediatype': 'system',
-                        'sound': LOGOUT_SOUND_DATA
-                    }
-                    
-                    # Сохраняем системное сообщение
-                    chat['messages'].append(system_msg)
-                    
-                    # Рассылаем уведомление
-                    broadcast_to_chat(chat_id, system_msg, exclude_login=username)
-                
-                # Очищаем запись о пользователе
-                USERS_IN_CHAT.pop(username, None)
-                
-                # Удаляем чат если оба пользователя вышли
-                if len(chat['users']) == 0:
-                    del PRIVATE_CHATS[chat_id]
-                    # Обновляем статус в БД
-                    threading.Thread(target=update_chat_status, args=(chat_id, 'closed'), daemon=True).start()
-                else:
-                    # Обновляем статус в БД
-                    threading.Thread(target=update_chat_status, args=(chat_id, 'inactive'), daemon=True).start()
-                
-                logger.info(f"Пользователь {username} покинул чат {chat_id}")
-                return True
+class SSEEventHistory:
+    """Кольцевые буферы последних событий пользователей: дозагрузка пропущенного по Last-Event-ID"""
+    def __init__(self, size=SSE_HISTORY_SIZE):
+        self.size = size
+        self.buffers = {}  # {login: deque[SSEEvent]}
+        self.evicted = {}  # {login: id последнего вытесненного события}
+        self.last_id = 0
+        self.replays = 0
+        self.replayed = 0
+        self.resyncs = 0
+        self.lock = threading.RLock()
+    
+    def append(self, login, event):
+        with self.lock:
+            buffer = self.buffers.get(login)
+            if buffer is None:
+                buffer = self.buffers[login] = deque()
+            if len(buffer) >= self.size:
+                self.evicted[login] = buffer.popleft().id
+            buffer.append(event)
+            self.last_id = max(self.last_id, event.id)
+    
+    def since(self, login, last_id):
+        """События после last_id; None - часть уже вытеснена, нужна полная синхронизация"""
+        with self.lock:
+            # id больше выданных - сервер перезапускался и нумерация началась заново
+            if last_id < self.evicted.get(login, 0) or last_id > self.last_id:
+                self.resyncs += 1
+                return None
+            
+            events = [event for event in self.buffers.get(login, ()) if event.id > last_id]
+            self.replays += 1
+            self.replayed += len(events)
+            return events
+    
+    def discard(self, login):
+        with self.lock:
+            self.buffers.pop(login, None)
+            self.evicted.pop(login, None)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'users': len(self.buffers),
+                'events': sum(len(buffer) for buffer in self.buffers.values()),
+                'last_id': self.last_id,
+                'replays': self.replays,
+                'replayed': self.replayed,
+                'resyncs': self.resyncs
+            }
+
+SSE_HISTORY = SSEEventHistory()
+
+def parse_event_id(value):
+    """Last-Event-ID из заголовка или параметра; None - если нет или некорректен"""
+    try:
+        event_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return event_id if event_id >= 0 else None
+
+SSE_QUEUE_MAX = 128  # Очередь подписчика; должна быть меньше SSE_HISTORY_SIZE, чтобы отставание дозагружалось
+SSE_COALESCE_TYPES = ('queue_position',)  # Статусы: важно только последнее значение
+SSE_CONNECTION_IDS = itertools.count(1)
+SSE_MAX_PER_IP = int(os.environ.get('SSE_MAX_PER_IP', 0))  # 0 - без лимита: за роутером PaaS у всех клиентов один адрес
+SSE_MAX_PER_LOGIN = 5  # Вкладки одного пользователя
+SSE_KEEPALIVE_INTERVAL = 15  # Тишина в потоке не дольше (сек)
+SSE_KEEPALIVE_SLOTS = 15  # Ячейки колеса таймеров: keepalive размазаны по интервалу
+SSE_RETRY_AFTER = 30
+SSE_KEEPALIVE = b":keepalive\n\n"
+
+class SSESubscriber:
+    """Ограниченная очередь подписчика SSE: статусы схлопываются, сообщения не теряются"""
+    def __init__(self, login, schema=SSE_SCHEMA_LEGACY, ip=None, max_depth=SSE_QUEUE_MAX):
+        self.conn_id = next(SSE_CONNECTION_IDS)
+        self.login = login
+        self.schema = schema
+        self.ip = ip
+        self.max_depth = max_depth
+        self.events = deque()  # SSEEvent или тип схлопываемого события
+        self.latest = {}  # {event_type: SSEEvent} - последнее значение статуса
+        self.connected_at = time.time()
+        self.last_active = self.connected_at
+        self.last_sent_id = 0
+        self.keepalive_due = False
+        self.closed = False
+        self.overflowed = False
+        self.sent = 0
+        self.coalesced = 0
+        self.peak_depth = 0
+        self.lock = threading.RLock()
+        self.ready = threading.Condition(self.lock)
+    
+    def put(self, event):
+        """Ставит событие в очередь; False - подписчик закрыт или слишком отстал"""
+        with self.lock:
+            if self.closed:
+                return False
+            
+            if event.type in SSE_COALESCE_TYPES:
+                # Статус заменяет еще не отправленный предыдущий и переезжает в конец очереди:
+                # события уходят строго по возрастанию id, иначе Last-Event-ID перескочит
+                # через сообщения, стоящие между старым и новым статусом
+                if event.type in self.latest:
+                    self.events.remove(event.type)
+                    self.coalesced += 1
+                self.events.append(event.type)
+                self.latest[event.type] = event
+            elif len(self.events) >= self.max_depth:
+                # Сообщения не выбрасываем: отключаем клиента, он дозагрузит их по Last-Event-ID
+                self.overflowed = True
+                self.closed = True
+                self.events.clear()
+                self.latest.clear()
+                self.ready.notify_all()
+                return False
+            else:
+                self.events.append(event)
+            
+            self.peak_depth = max(self.peak_depth, len(self.events))
+            self.ready.notify()
+            return True
+    
+    def get(self, timeout=None):
+        """Следующее событие, SSE_KEEPALIVE по сигналу таймера или None при закрытии"""
+        with self.lock:
+            # Своего таймаута нет: keepalive будит общий таймер хаба
+            while not self.events and not self.closed and not self.keepalive_due:
+                if not self.ready.wait(timeout):
+                    break
+            if self.closed:
+                return None
+            
+            self.last_active = time.time()
+            self.keepalive_due = False
+            if not self.events:
+                return SSE_KEEPALIVE
+            
+            item = self.events.popleft()
+            if isinstance(item, str):
+                item = self.latest.pop(item)
+            self.sent += 1
+            self.last_sent_id = item.id
+            return item
+    
+    def ping(self):
+        """Просьба таймера отправить keepalive"""
+        with self.lock:
+            if not self.closed:
+                self.keepalive_due = True
+                self.ready.notify()
+    
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.notify_all()
+    
+    def depth(self):
+        with self.lock:
+            return len(self.events)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'conn_id': self.conn_id,
+                'login': self.login,
+                'schema': self.schema,
+                'depth': len(self.events),
+                'peak_depth': self.peak_depth,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'age': round(time.time() - self.connected_at, 1)
+            }
+
+class SSEHub:
+    """Хаб SSE: несколько соединений на логин, лимиты по IP и логину, один таймер keepalive на всех"""
+    def __init__(self, max_connections=MAX_SSE_CONNECTIONS, max_per_ip=SSE_MAX_PER_IP,
+                 max_per_login=SSE_MAX_PER_LOGIN, keepalive=SSE_KEEPALIVE_INTERVAL, slots=SSE_KEEPALIVE_SLOTS):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.max_per_login = max_per_login
+        self.keepalive = keepalive
+        self.connections = {}  # {login: {conn_id: SSESubscriber}}
+        self.ips = {}  # {ip: число соединений}
+        self.wheel = [set() for _ in range(slots)]  # Колесо таймеров: ячейка обходится раз в тик
+        self.total = 0
+        self.peak = 0
+        self.overflows = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.keepalives = 0
+        self.thread = None
+        self.lock = threading.RLock()
+    
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True, name="sse_keepalive")
+            self.thread.start()
+    
+    def admit(self, subscriber):
+        """Регистрирует соединение; при превышении лимитов возвращает (код, сообщение), иначе None"""
+        with self.lock:
+            # Сверх лимита логина обычно брошенные вкладки - место освобождает самое старое соединение
+            own = self.connections.get(subscriber.login, {})
+            oldest = next(iter(own.values())) if len(own) >= self.max_per_login else None
+            freed_ip = 1 if oldest and oldest.ip == subscriber.ip else 0
+            
+            # Живых чужих пользователей не вытесняем - просим повторить позже
+            if self.total - (1 if oldest else 0) >= self.max_connections:
+                self.rejected += 1
+                return 503, 'Сервер перегружен, повторите подключение позже'
+            if self.max_per_ip and self.ips.get(subscriber.ip, 0) - freed_ip >= self.max_per_ip:
+                self.rejected += 1
+                return 429, 'Слишком много соединений с вашего адреса'
+            
+            if oldest:
+                self.evicted += 1
+                self.remove(oldest)
+            
+            self.connections.setdefault(subscriber.login, {})[subscriber.conn_id] = subscriber
+            self.ips[subscriber.ip] = self.ips.get(subscriber.ip, 0) + 1
+            self.wheel[subscriber.conn_id % len(self.wheel)].add(subscriber)
+            self.total += 1
+            self.peak = max(self.peak, self.total)
+        
+        self.start()
+        return None
+    
+    def remove(self, subscriber):
+        """Снимает с учета именно это соединение - остальные вкладки логина не затрагиваются"""
+        with self.lock:
+            subscribers = self.connections.get(subscriber.login)
+            if not subscribers or subscribers.pop(subscriber.conn_id, None) is None:
+                return False
+            if not subscribers:
+                del self.connections[subscriber.login]
+            self.forget(subscriber)
+        subscriber.close()
+        return True
+    
+    def forget(self, subscriber):
+        """Счетчики IP и колесо таймеров (под блокировкой хаба)"""
+        self.total -= 1
+        self.wheel[subscriber.conn_id % len(self.wheel)].discard(subscriber)
+        count = self.ips.get(subscriber.ip, 0) - 1
+        if count > 0:
+            self.ips[subscriber.ip] = count
+        else:
+            self.ips.pop(subscriber.ip, None)
+    
+    def close_login(self, login):
+        """Закрывает все соединения пользователя"""
+        with self.lock:
+            subscribers = self.connections.pop(login, {})
+            for subscriber in subscribers.values():
+                self.forget(subscriber)
+        for subscriber in subscribers.values():
+            subscriber.close()
+        return len(subscribers)
+    
+    def publish(self, login, event):
+        """Рассылает событие во все живые соединения логина; возвращает число доставок"""
+        with self.lock:
+            subscribers = list(self.connections.get(login, {}).values())
+            delivered = 0
+            for subscriber in subscribers:
+                if subscriber.put(event):
+                    delivered += 1
+                    continue
+                if subscriber.overflowed:
+                    self.overflows += 1
+                    logger.warning(f"SSE клиент {login} отстал на {subscriber.max_depth} событий - отключаем")
+                self.remove(subscriber)
+            return delivered
+    
+    def run(self):
+        """Колесо таймеров: за тик обходится одна ячейка, каждое соединение - дважды за интервал"""
+        tick = self.keepalive / 2 / len(self.wheel)
+        slot = 0
+        while True:
+            time.sleep(tick)
+            self.sweep(slot)
+            slot = (slot + 1) % len(self.wheel)
+    
+    def sweep(self, slot, now=None):
+        """Keepalive молчащим соединениям ячейки; возвращает число пингов"""
+        with self.lock:
+            bucket = list(self.wheel[slot])
+        
+        # Ячейка посещается раз в полинтервала: пропущенное соединение молчало меньше
+        # полинтервала и до следующего посещения успеет замолчать не дольше интервала
+        idle_since = (now or time.time()) - self.keepalive / 2
+        pinged = 0
+        for subscriber in bucket:
+            if subscriber.last_active <= idle_since:
+                subscriber.ping()
+                pinged += 1
+        if pinged:
+            with self.lock:
+                self.keepalives += pinged
+        return pinged
+    
+    def count(self, login):
+        with self.lock:
+            return len(self.connections.get(login, ()))
     
-    return False
+    def __contains__(self, login):
+        return login in self.connections
+    
+    def stats(self):
+        with self.lock:
+            subscribers = [s for conns in self.connections.values() for s in conns.values()]
+            per_login = {login: len(conns) for login, conns in self.connections.items()}
+            summary = {
+                'max_connections': self.max_connections,
+                'peak': self.peak,
+                'ips': len(self.ips),
+                'rejected': self.rejected,
+                'evicted': self.evicted,
+                'keepalives': self.keepalives,
+                'overflows': self.overflows
+            }
+        queues = [subscriber.stats() for subscriber in subscribers]
+        return {
+            'connections': len(queues),
+            'logins': len(per_login),
+            'per_login': per_login,
+            'max_depth': max((q['depth'] for q in queues), default=0),
+            **summary,
+            'queues': queues
+        }
+
+SSE_HUB = SSEHub()
 
 def broadcast_to_chat(chat_id, message, exclude_login=None):
     """Отправка сообщения всем участникам приватного чата"""
@@ -283,125 +1276,227 @@ def broadcast_to_chat(chat_id, message, exclude_login=None):
     if not chat:
         return
     
-    notification_data = {
+    # Одно событие на всех получателей: кадр сериализуется один раз
+    event = SSEEvent({
         'type': 'private_message',
         'chat_id': chat_id,
         'data': message,
         'sound': message.get('sound', NOTIFICATION_SOUND_DATA)
-    }
+    })
     
     for user in chat['users']:
         if user != exclude_login and user != message.get('login'):
-            send_push_notification(user, notification_data)
+            send_push_notification(user, event)
 
 def find_available_partner(username):
     """Найти свободного пользователя для чата с учетом предпочтений"""
     user_prefs = USER_PREFERENCES.get(username, {})
+    now = time.time()
     
-    with threading.RLock():
-        # Ищем пользователей без активного чата
-        for user in ONLINE_USERS:
-            if (user != username and 
+    def is_available(user):
+        return (user in ONLINE_USERS and
                 user not in USERS_IN_CHAT and
-                user in USER_PREFERENCES):
-                
-                partner_prefs = USER_PREFERENCES.get(user, {})
-                
-                # Проверяем совместимость по предпочтениям
-                if not is_compatible_by_preferences(user_prefs, partner_prefs):
-                    continue
-                
-                last_active = USER_LAST_ACTIVE.get(user, 0)
-                if time.time() - last_active < 300:  # Активен в последние 5 минут
-                    return user
-        
-        # Если не нашли, добавляем в очередь ожидания
+                user in USER_PREFERENCES and
+                now - USER_LAST_ACTIVE.get(user, 0) < 300)  # Активен в последние 5 минут
+    
+    # Просматриваем только корзины, совместимые по предпочтениям
+    partner = MATCHMAKING_INDEX.find_partner(username, user_prefs, accept=is_available)
+    if partner:
+        return partner
+    
+    # Если не нашли, добавляем в очередь ожидания
+    with STATE.locked(username):
         if username not in WAITING_USERS:
-            WAITING_USERS.append(username)
+            add_to_waiting(username)
             logger.info(f"Пользователь {username} добавлен в очередь ожидания. Размер очереди: {len(WAITING_USERS)}")
     
     return None
 
 def match_waiting_users():
-    """Сопоставление пользователей из очереди ожидания с учетом предпочтений"""
-    with threading.RLock():
-        # Создаем копию для безопасной итерации
-        waiting_users_copy = WAITING_USERS.copy()
+    """Пакетное сопоставление всей очереди ожидания за один проход"""
+    # Индекс содержит только ожидающих, поэтому проверка очереди не нужна
+    def is_waiting(user):
+        return user in ONLINE_USERS and user in USER_PREFERENCES
+    
+    pairs = MATCHMAKING_INDEX.plan_pairs(accept=is_waiting)
+    if not pairs:
+        return False
+    
+    # Создаем все чаты разом; пары, занятые параллельно, отбрасываются атомарно
+    created = create_private_chats(pairs)
+    
+    for chat_id, user1, user2 in created:
+        # Системное сообщение о создании чата
+        system_msg = {
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'login': 'Система',
+            'text': f'Чат создан между {user1} и {user2}',
+            'ts': time.time(),
+            'isvoice': False,
+            'mediatype': 'system',
+            'sound': NOTIFICATION_SOUND_DATA
+        }
         
-        for i, user1 in enumerate(waiting_users_copy):
-            if user1 not in WAITING_USERS or user1 not in ONLINE_USERS:
-                continue
-                
-            user1_prefs = USER_PREFERENCES.get(user1, {})
+        chat = PRIVATE_CHATS.get(chat_id)
+        if chat:
+            append_chat_message(chat, system_msg)
+        
+        # Отправляем уведомления обоим пользователям
+        broadcast_to_chat(chat_id, system_msg)
+    
+    logger.info(f"Сопоставлено из очереди пар: {len(created)}")
+    return bool(created)
+
+def cleanup_inactive_chats():
+    """Очистка неактивных приватных чатов"""
+    while True:
+        time.sleep(60)  # Проверка каждую минуту
+        try:
+            now = time.time()
+            inactive_chats = []
             
-            for j, user2 in enumerate(waiting_users_copy[i+1:], i+1):
-                if (user2 not in WAITING_USERS or 
-                    user2 not in ONLINE_USERS or
-                    user2 not in USER_PREFERENCES):
-                    continue
-                    
-                user2_prefs = USER_PREFERENCES.get(user2, {})
-                
-                # Проверяем совместимость
-                if is_compatible_by_preferences(user1_prefs, user2_prefs):
-                    # Удаляем из очереди
-                    try:
-                        WAITING_USERS.remove(user1)
-                        WAITING_USERS.remove(user2)
-                    except ValueError:
-                        continue
-                    
-                    # Создаем чат
-                    chat_id = create_private_chat(user1, user2)
-                    
-                    # Системное сообщение о создании чата
-                    system_msg = {
-                        'id': str(uuid.uuid4()),
-                        'chat_id': chat_id,
-                        'login': 'Система',
-                        'text': f'Чат создан между {user1} и {user2}',
-                        'ts': time.time(),
-                        'isvoice': False,
-                        'mediatype': 'system',
-                        'sound': NOTIFICATION_SOUND_DATA
-                    }
-                    
-                    if chat_id in PRIVATE_CHATS:
-                        PRIVATE_CHATS[chat_id]['messages'].append(system_msg)
-                    
-                    # Отправляем уведомления обоим пользователям
-                    broadcast_to_chat(chat_id, system_msg)
-                    
-                    logger.info(f"Сопоставлены пользователи {user1} и {user2} из очереди")
-                    return True
+            for chat_id, chat_data in list(PRIVATE_CHATS.items()):
+                # Чат неактивен более 15 минут
+                if now - chat_data.get('last_activity', 0) > 900:
+                    inactive_chats.append(chat_id)
+            
+            for chat_id in inactive_chats:
+                if STATE.drop_chat(chat_id, inactive_before=now - 900):
+                    logger.info(f"Удален неактивный чат {chat_id}")
+                        
+        except Exception as e:
+            logger.error(f"Ошибка очистки чатов: {e}")
+
+# ===== ПУЛ СОЕДИНЕНИЙ С БД =====
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 10  # Максимальное ожидание свободного соединения (сек)
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -8000',
+    'PRAGMA mmap_size = 67108864',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA busy_timeout = 5000',
+)
+
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite: PRAGMA применяются один раз при открытии"""
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()  # LIFO - переиспользуем "горячие" соединения
+        self.opened = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+        self.broken = 0
+        self.lock = threading.RLock()
+    
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=15, isolation_level=None)
+        try:
+            for pragma in DB_PRAGMAS:
+                conn.execute(pragma)
+        except Exception:
+            conn.close()
+            raise
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        
+        started = time.time()
+        try:
+            conn = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"Нет свободных соединений с БД за {self.timeout} сек")
+        waited = time.time() - started
+        with self.lock:
+            self.waits += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        return conn
     
-    return False
-
-def cleanup_inactive_chats():
-    """Очистка неактивных приватных чатов"""
-    while True:
-        time.sleep(60)  # Проверка каждую минуту
+    def _discard(self, conn):
+        with self.lock:
+            self.opened -= 1
+            self.broken += 1
         try:
-            now = time.time()
-            inactive_chats = []
-            
-            with threading.RLock():
-                for chat_id, chat_data in list(PRIVATE_CHATS.items()):
-                    # Чат неактивен более 15 минут
-                    if now - chat_data.get('last_activity', 0) > 900:
-                        inactive_chats.append(chat_id)
-            
-            for chat_id in inactive_chats:
-                with threading.RLock():
-                    chat = PRIVATE_CHATS.pop(chat_id, None)
-                    if chat:
-                        for user in chat['users']:
-                            USERS_IN_CHAT.pop(user, None)
-                        
-                        logger.info(f"Удален неактивный чат {chat_id}")
-                        
-        except Exception as e:
-            logger.error(f"Ошибка очистки чатов: {e}")
+            conn.close()
+        except Exception:
+            pass
+    
+    @contextmanager
+    def connection(self):
+        """Соединение из пула; незавершенная транзакция откатывается при возврате"""
+        conn = self._acquire()
+        started = time.time()
+        with self.lock:
+            self.checkouts += 1
+        healthy = True
+        try:
+            yield conn
+        except (sqlite3.InterfaceError, sqlite3.ProgrammingError):
+            healthy = False
+            raise
+        finally:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception:
+                healthy = False
+            with self.lock:
+                self.busy_time += time.time() - started
+            if healthy:
+                self.idle.put(conn)
+            else:
+                logger.warning("Соединение с БД исключено из пула")
+                self._discard(conn)
+    
+    @contextmanager
+    def transaction(self):
+        """Соединение с открытой транзакцией: COMMIT при успехе, ROLLBACK при ошибке"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'opened': self.opened,
+                'idle': self.idle.qsize(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'avg_wait_ms': round(self.wait_time / self.waits * 1000, 2) if self.waits else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+                'avg_checkout_ms': round(self.busy_time / self.checkouts * 1000, 2) if self.checkouts else 0,
+                'broken': self.broken
+            }
+
+DB_POOL = ConnectionPool(DB_PATH)
 
 # ===== ФУНКЦИИ ДЛЯ РАБОТЫ С БАЗОЙ ДАННЫХ =====
 def init_db():
@@ -409,11 +1504,8 @@ def init_db():
     conn = None
     try:
         conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
-        conn.execute('PRAGMA journal_mode = WAL')
-        conn.execute('PRAGMA synchronous = NORMAL')
-        conn.execute('PRAGMA cache_size = -2000')
-        conn.execute('PRAGMA foreign_keys = ON')
-        conn.execute('PRAGMA busy_timeout = 5000')
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
         
         c = conn.cursor()
         
@@ -433,14 +1525,23 @@ def init_db():
                 delivered INTEGER DEFAULT 0,
                 readcount INTEGER DEFAULT 0,
                 sound_data TEXT,
+                media_hash TEXT,  -- SHA-256 файла в хранилище медиа
+                media_mime TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         
+        # Миграция старых БД: медиа хранится в файлах, в строке только ссылка
+        columns = {row[1] for row in c.execute('PRAGMA table_info(messages)')}
+        for column in ('media_hash', 'media_mime'):
+            if column not in columns:
+                c.execute(f'ALTER TABLE messages ADD COLUMN {column} TEXT')
+        
         # Индексы для приватных чатов
         c.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, ts DESC)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts DESC)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_messages_login ON messages(login, ts DESC)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_media_hash ON messages(media_hash)')
         
         # Таблица приватных чатов
         c.execute('''
@@ -518,331 +1619,1394 @@ def init_db():
     threading.Thread(target=cleanup_old_sessions, daemon=True, name="cleanup_sessions").start()
     threading.Thread(target=rate_limiter.cleanup, daemon=True, name="rate_limiter_cleanup").start()
     threading.Thread(target=cleanup_inactive_chats, daemon=True, name="cleanup_chats").start()
-    threading.Thread(target=matchmaking_worker, daemon=True, name="matchmaking").start()
+    MATCHMAKING_SCHEDULER.start()
+    QUEUE_POSITION_NOTIFIER.start()
+    MESSAGE_WRITER.start()
+    HEARTBEAT_FLUSHER.start()
+    SSE_HUB.start()
+    UPLOADS.start()
     threading.Thread(target=cleanup_old_users, daemon=True, name="cleanup_old_users").start()
 
-def get_db_connection():
-    """Получение соединения с БД с улучшенной обработкой ошибок"""
-    conn = None
-    for attempt in range(3):
-        try:
-            conn = sqlite3.connect(
-                DB_PATH, 
-                check_same_thread=False, 
-                timeout=15,
-                isolation_level=None
-            )
-            conn.execute('PRAGMA busy_timeout = 5000')
-            conn.row_factory = sqlite3.Row
-            return conn
-        except sqlite3.OperationalError as e:
-            logger.warning(f"Попытка {attempt+1} подключения к БД: {e}")
-            if attempt == 2:
-                logger.error(f"Не удалось подключиться к БД: {e}")
-                try:
-                    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
-                    conn.row_factory = sqlite3.Row
-                    return conn
-                except Exception as e2:
-                    logger.critical(f"Критическая ошибка БД: {e2}")
-                    return None
-            time.sleep(0.5 * (attempt + 1))
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка БД: {e}")
-            return None
-    return None
-
-def save_private_chat(chat_id, user1, user2, created_at):
-    """Сохранение приватного чата в БД"""
-    conn = None
+def save_private_chats(chats):
+    """Сохранение приватных чатов в БД: [(chat_id, user1, user2, created_at), ...]"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO private_chats (chat_id, user1, user2, created_at, last_activity, status)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (chat_id, user1, user2, created_at, created_at, 'active'))
-        
-        # Обновляем информацию о пользователях
-        c.execute('''
-            UPDATE users SET current_chat = ?, chats_count = chats_count + 1 
-            WHERE login IN (?, ?)
-        ''', (chat_id, user1, user2))
-        
-        conn.commit()
-        
+        with DB_POOL.transaction() as conn:
+            c = conn.cursor()
+            c.executemany('''
+                INSERT INTO private_chats (chat_id, user1, user2, created_at, last_activity, status)
+                VALUES (?, ?, ?, ?, ?, 'active')
+            ''', [(chat_id, user1, user2, created_at, created_at) for chat_id, user1, user2, created_at in chats])
+            
+            # Обновляем информацию о пользователях
+            c.executemany('''
+                UPDATE users SET current_chat = ?, chats_count = chats_count + 1, waiting_since = NULL
+                WHERE login IN (?, ?)
+            ''', [(chat_id, user1, user2) for chat_id, user1, user2, _ in chats])
+            
     except Exception as e:
-        logger.error(f"Ошибка сохранения приватного чата: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Ошибка сохранения приватных чатов: {e}")
 
 def update_chat_status(chat_id, status):
     """Обновление статуса чата в БД"""
-    conn = None
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        
-        c = conn.cursor()
-        c.execute('''
-            UPDATE private_chats 
-            SET status = ?, last_activity = ?
-            WHERE chat_id = ?
-        ''', (status, time.time(), chat_id))
-        
-        conn.commit()
-        
+        with DB_POOL.connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                UPDATE private_chats 
+                SET status = ?, last_activity = ?
+                WHERE chat_id = ?
+            ''', (status, time.time(), chat_id))
+            
+            conn.commit()
+            
     except Exception as e:
         logger.error(f"Ошибка обновления статуса чата: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-def matchmaking_worker():
-    """Фоновый процесс для сопоставления пользователей"""
-    while True:
-        time.sleep(5)  # Проверяем каждые 5 секунд
-        try:
-            match_waiting_users()
-        except Exception as e:
-            logger.error(f"Ошибка в matchmaking_worker: {e}")
 
 def cleanup_old_users():
     """Очистка старых записей пользователей (более 30 дней)"""
     while True:
         time.sleep(86400)  # Каждые 24 часа
         try:
-            conn = get_db_connection()
-            if conn:
+            with DB_POOL.connection() as conn:
                 c = conn.cursor()
                 cutoff = time.time() - (30 * 24 * 3600)  # 30 дней
                 c.execute("DELETE FROM users WHERE last_seen < ?", (cutoff,))
                 deleted = c.rowcount
                 if deleted > 0:
                     logger.info(f"Очистка пользователей: удалено {deleted} старых записей")
-                conn.commit()
-                conn.close()
         except Exception as e:
             logger.error(f"Ошибка очистки пользователей: {e}")
 
 # ===== ФУНКЦИИ ДЛЯ РАБОТЫ С МЕДИА =====
-@lru_cache(maxsize=128)
-def compress_image(base64_data, max_size=(1200, 1200), quality=85):
-    """Оптимизированное сжатие изображений"""
+# Изображения, которые Pillow не открывает: отдаем как есть, без сжатия и вариантов
+IMAGE_PASSTHROUGH_TYPES = ('image/svg+xml', 'image/heic', 'image/heif')
+
+def compress_image_bytes(img_data, mime_type, max_size=(1200, 1200), quality=85):
+    """Сжатие изображения в байтах: (mime, bytes) или None, если сжимать не нужно"""
+    if mime_type in IMAGE_PASSTHROUGH_TYPES:
+        return None
+    
+    # Проверяем размер
+    if len(img_data) < IMAGE_COMPRESS_MIN_BYTES:
+        return None
+    
+    # Определяем формат
+    img_format = 'JPEG'
+    if mime_type == 'image/png':
+        img_format = 'PNG'
+    elif mime_type == 'image/webp':
+        img_format = 'WEBP'
+    
+    # Обрабатываем изображение
+    img = Image.open(io.BytesIO(img_data))
+    
+    if img_format == 'JPEG' and img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    
+    # Масштабируем
+    if max(img.size) > max(max_size):
+        ratio = min(max_size[0] / img.size[0], max_size[1] / img.size[1])
+        new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+    
+    # Сжимаем
+    output = io.BytesIO()
+    
+    if img_format == 'PNG':
+        img.save(output, format='PNG', optimize=True)
+    elif img_format == 'WEBP':
+        img.save(output, format='WEBP', quality=quality)
+    else:
+        img.save(output, format='JPEG', quality=quality, optimize=True)
+    
+    compressed = output.getvalue()
+    
+    if len(compressed) >= len(img_data):
+        return None
+    
+    mime_type = 'image/jpeg'
+    if img_format == 'PNG':
+        mime_type = 'image/png'
+    elif img_format == 'WEBP':
+        mime_type = 'image/webp'
+    
+    return mime_type, compressed
+
+def render_image_variant(img_data, max_side, quality, blur, webp):
+    """Вариант изображения: уменьшение, размытие, WebP или прогрессивный JPEG -> (mime, bytes)"""
+    img = Image.open(io.BytesIO(img_data))
+    img = img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    
+    # thumbnail только уменьшает и сохраняет пропорции
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+    
+    output = io.BytesIO()
+    if webp:
+        img.save(output, format='WEBP', quality=quality, method=4)
+        return 'image/webp', output.getvalue()
+    
+    if img.mode == 'RGBA':
+        # В JPEG нет прозрачности - кладем на белый фон
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        img = background
+    img.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return 'image/jpeg', output.getvalue()
+
+# ===== ПУЛ ОБРАБОТКИ ИЗОБРАЖЕНИЙ =====
+IMAGE_POOL_WORKERS = max(1, min(2, (os.cpu_count() or 1) - 1))
+IMAGE_POOL_MAX_PENDING = 8  # Больше задач в очереди - храним оригинал без сжатия
+IMAGE_JOB_TIMEOUT = 20  # Сек; дольше ждать не имеет смысла - отдаем оригинал
+
+def run_image_job(func, src_path, dst_path, *args):
+    """Выполняется в процессе пула: читает src_path, пишет результат func в dst_path.
+
+    Через канал пула идут только пути и MIME. Многомегабайтные bytes в канале под
+    gevent блокируют запись в pipe и замораживают хаб вместе с таймаутом ожидания.
+    """
+    started = time.time()
+    with open(src_path, 'rb') as f:
+        result = func(f.read(), *args)
+    if result is None:
+        return None, time.time() - started
+    
+    mime_type, data = result
+    with open(dst_path, 'wb') as f:
+        f.write(data)
+    return mime_type, time.time() - started
+
+def remove_file(path):
     try:
-        if not base64_data or not isinstance(base64_data, str):
-            return base64_data
-        
-        if not base64_data.startswith('data:'):
-            return base64_data
-        
-        parts = base64_data.split(',', 1)
-        if len(parts) != 2:
-            return base64_data
+        os.remove(path)
+    except OSError:
+        pass
+
+class ImageProcessor:
+    """Сжатие изображений в отдельных процессах: Pillow не блокирует gevent-воркер"""
+    def __init__(self, workers=IMAGE_POOL_WORKERS, max_pending=IMAGE_POOL_MAX_PENDING, timeout=IMAGE_JOB_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = None
+        self.pending = 0
+        self.jobs = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.work_time = 0.0
+        self.wait_time = 0.0
+        self.max_work = 0.0
+        self.lock = threading.RLock()
+    
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawn: форк процесса с активным gevent-хабом небезопасен
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self.executor
+    
+    def reset(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def compress(self, src_path, mime_type, max_size=(1200, 1200), quality=85):
+        """(mime, bytes) сжатого изображения или None - тогда сохраняется оригинал"""
+        return self.run(compress_image_bytes, src_path, mime_type, max_size, quality)
+    
+    def release(self, future=None):
+        with self.lock:
+            self.pending -= 1
+    
+    def run(self, func, src_path, *args):
+        """Выполняет func(содержимое src_path, *args) в пуле; None при перегрузке, таймауте или ошибке"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return None
+            self.pending += 1
+        
+        started = time.time()
+        dst_path = BLOB_STORE.temp_path()
+        executor = None
+        future = None
+        try:
+            executor = self.get_executor()
+            future = executor.submit(run_image_job, func, src_path, dst_path, *args)
+            # Задача занимает место в очереди, пока процесс действительно не закончит - даже после таймаута
+            future.add_done_callback(self.release)
+            mime_type, work = future.result(timeout=self.timeout)
+            if mime_type is None:
+                result = None
+            else:
+                with open(dst_path, 'rb') as f:
+                    result = mime_type, f.read()
+        except FuturesTimeoutError:
+            future.cancel()
+            # Опоздавший результат никому не нужен - файл удалим, когда задача завершится
+            future.add_done_callback(lambda f, path=dst_path: remove_file(path))
+            dst_path = None
+            with self.lock:
+                self.timeouts += 1
+            logger.warning(f"Обработка изображения не уложилась в {self.timeout} сек")
+            return None
+        except BrokenProcessPool as e:
+            logger.error(f"Пул обработки изображений упал: {e}")
+            with self.lock:
+                self.errors += 1
+            if executor:
+                self.reset(executor)
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка обработки изображения: {e}")
+            with self.lock:
+                self.errors += 1
+            return None
+        finally:
+            if future is None:
+                self.release()
+            if dst_path:
+                remove_file(dst_path)
         
-        header, data = parts
+        elapsed = time.time() - started
+        with self.lock:
+            self.jobs += 1
+            self.work_time += work
+            self.wait_time += max(0.0, elapsed - work)
+            self.max_work = max(self.max_work, work)
+        return result
+    
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'jobs': self.jobs,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+                'avg_work_ms': round(self.work_time / self.jobs * 1000, 2) if self.jobs else 0,
+                'avg_overhead_ms': round(self.wait_time / self.jobs * 1000, 2) if self.jobs else 0,
+                'max_work_ms': round(self.max_work * 1000, 2)
+            }
+
+IMAGE_PROCESSOR = ImageProcessor()
+atexit.register(IMAGE_PROCESSOR.shutdown)
+
+# ===== ХРАНИЛИЩЕ МЕДИА =====
+MEDIA_DIR = os.environ.get('MEDIA_DIR', 'media')
+MEDIA_GC_GRACE = 3600  # Свежие файлы не удаляются: ссылка на них может быть еще в очереди записи
+MEDIA_CACHE_MAX_AGE = 31536000  # Год: адрес по хэшу неизменяем
+MEDIA_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MEDIA_LIMITS_MB = {'voice': 10, 'video': 50, 'image': 20, 'music': 30, 'file': 64}
+ALLOWED_MEDIA_TYPES = (
+    'image/', 'video/', 'audio/',
+    'application/pdf', 'text/plain',
+    'application/zip', 'application/x-rar-compressed'
+)
+
+class FileTooLargeError(ValueError):
+    """Файл больше допустимого размера"""
+
+class BlobStore:
+    """Контентно-адресуемое хранилище файлов: media/ab/cd/<sha256>, одинаковые файлы хранятся один раз"""
+    def __init__(self, root=MEDIA_DIR):
+        self.root = os.path.abspath(root)  # send_file считает относительные пути от папки приложения
+        self.mimes = OrderedDict()  # Недавние {sha256: mime}, пока ссылка еще не записана в БД
+        self.writes = 0
+        self.dedup_hits = 0
+        self.deleted = 0
+        self.lock = threading.RLock()
+    
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+    
+    def exists(self, digest):
+        return os.path.isfile(self.path(digest))
+    
+    def remember_mime(self, digest, mime_type):
+        with self.lock:
+            self.mimes[digest] = mime_type
+            self.mimes.move_to_end(digest)
+            while len(self.mimes) > 1024:
+                self.mimes.popitem(last=False)
+    
+    def recent_mime(self, digest):
+        with self.lock:
+            return self.mimes.get(digest)
+    
+    def temp_path(self):
+        """Путь для временного файла внутри хранилища (тот же диск - os.replace атомарен)"""
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        return os.path.join(tmp_dir, f"{uuid.uuid4().hex}.tmp")
+    
+    def put_file(self, tmp_path, digest):
+        """Переносит готовый временный файл в хранилище под его хэшем"""
+        path = self.path(digest)
+        if os.path.isfile(path):
+            # Обновляем mtime, чтобы сборщик мусора не удалил файл до записи ссылки
+            os.utime(path, None)
+            os.remove(tmp_path)
+            with self.lock:
+                self.dedup_hits += 1
+            return digest
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.writes += 1
+        return digest
+    
+    def put_bytes(self, data):
+        """Сохраняет байты и возвращает их SHA-256"""
+        tmp_path = self.temp_path()
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            return self.put_file(tmp_path, hashlib.sha256(data).hexdigest())
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def put_stream(self, stream, max_size, chunk_size=UPLOAD_CHUNK_SIZE, inspect=None):
+        """Потоково пишет данные на диск, считая SHA-256 на лету: (хэш, размер).
+        inspect(head) получает первые байты и может отклонить файл исключением"""
+        hasher = hashlib.sha256()
+        size = 0
+        head = b''
+        tmp_path = self.temp_path()
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise FileTooLargeError("Превышен размер файла")
+                    if inspect and len(head) < SNIFF_BYTES:
+                        head += chunk[:SNIFF_BYTES - len(head)]
+                        if len(head) == SNIFF_BYTES:
+                            inspect(head)
+                    hasher.update(chunk)
+                    f.write(chunk)
+            if inspect and len(head) < SNIFF_BYTES:
+                if not head:
+                    raise ValueError("Отсутствуют данные файла")
+                inspect(head)
+            return self.put_file(tmp_path, hasher.hexdigest()), size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def put_path(self, src_path, chunk_size=UPLOAD_CHUNK_SIZE):
+        """Забирает готовый файл в хранилище, посчитав его хэш: (хэш, размер)"""
+        hasher = hashlib.sha256()
+        size = 0
+        with open(src_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                hasher.update(chunk)
+        tmp_path = self.temp_path()
+        os.replace(src_path, tmp_path)
+        try:
+            return self.put_file(tmp_path, hasher.hexdigest()), size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def iter_hashes(self):
+        """Все хранимые хэши с временем изменения файла"""
+        if not os.path.isdir(self.root):
+            return
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                # Только файлы хранилища (ab/cd/<sha256>), не кэш и не загрузки
+                if MEDIA_HASH_RE.match(name) and path == self.path(name):
+                    try:
+                        yield name, os.path.getmtime(path)
+                    except OSError:
+                        continue
+    
+    def collect_garbage(self, referenced, grace=MEDIA_GC_GRACE):
+        """Удаляет файлы без ссылок, не тронутые дольше grace секунд"""
+        cutoff = time.time() - grace
+        removed = 0
+        for digest, mtime in list(self.iter_hashes()):
+            if digest in referenced or mtime > cutoff:
+                continue
+            try:
+                os.remove(self.path(digest))
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Не удалось удалить медиафайл {digest}: {e}")
+        
+        # Временные файлы оборванных загрузок
+        tmp_dir = os.path.join(self.root, 'tmp')
+        if os.path.isdir(tmp_dir):
+            for name in os.listdir(tmp_dir):
+                tmp_path = os.path.join(tmp_dir, name)
+                try:
+                    if os.path.getmtime(tmp_path) < cutoff:
+                        os.remove(tmp_path)
+                except OSError:
+                    continue
+        with self.lock:
+            self.deleted += removed
+        return removed
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'writes': self.writes,
+                'dedup_hits': self.dedup_hits,
+                'deleted': self.deleted
+            }
+
+BLOB_STORE = BlobStore()
+
+def parse_data_uri(data, default_mime='application/octet-stream'):
+    """Разбирает data URI (или чистый base64): возвращает (mime, bytes)"""
+    mime_type = default_mime
+    if data.startswith('data:'):
+        header, data = data.split(',', 1)
+        mime_match = re.match(r'data:(.+);base64', header)
+        if mime_match:
+            mime_type = mime_match.group(1)
+    return mime_type, base64.b64decode(data)
+
+def set_media_ref(msg, digest, mime_type, size):
+    """Ссылка на файл из хранилища вместо самих данных"""
+    BLOB_STORE.remember_mime(digest, mime_type)
+    msg['media_hash'] = digest
+    msg['media_mime'] = mime_type
+    msg['media_url'] = f"/media/{digest}"
+    msg['filesize'] = size
+    if mime_type.startswith('image/') and mime_type not in IMAGE_PASSTHROUGH_TYPES:
+        # Варианты создаются лениво при первом запросе
+        for variant in IMAGE_VARIANTS:
+            msg[f'{variant}_url'] = f"/media/{digest}/{variant}"
+    # В событиях и ответах - только ссылка, сами байты отдает GET /media/<id>
+    msg.pop('mediadata', None)
+    return msg
+
+def media_mime_type(digest):
+    """MIME файла из хранилища: сначала недавние загрузки, затем БД"""
+    mime_type = BLOB_STORE.recent_mime(digest)
+    if mime_type:
+        return mime_type
+    try:
+        with DB_POOL.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT media_mime FROM messages WHERE media_hash = ? AND media_mime IS NOT NULL LIMIT 1", (digest,))
+            row = c.fetchone()
+            if row:
+                BLOB_STORE.remember_mime(digest, row['media_mime'])
+                return row['media_mime']
+    except Exception as e:
+        logger.error(f"Ошибка получения типа медиа {digest}: {e}")
+    return 'application/octet-stream'
+
+# Сигнатуры файлов: (условия, MIME), условия - пары (смещение, байты), должны совпасть все.
+# Порядок важен: частные сигнатуры стоят раньше общих
+BMP_DIB_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+HEIC_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis')
+HEIF_BRANDS = (b'mif1', b'msf1')
+MAGIC_SIGNATURES = (
+    (((0, b'\xff\xd8\xff'),), 'image/jpeg'),
+    (((0, b'\x89PNG\r\n\x1a\n'),), 'image/png'),
+    (((0, b'GIF87a'),), 'image/gif'),
+    (((0, b'GIF89a'),), 'image/gif'),
+    # "BM" встречается и в обычном тексте - проверяем еще нулевые резервные поля и размер DIB-заголовка
+    *((((0, b'BM'), (6, b'\x00\x00\x00\x00'), (14, struct.pack('<I', size))), 'image/bmp')
+      for size in BMP_DIB_HEADER_SIZES),
+    (((0, b'RIFF'), (8, b'WEBP')), 'image/webp'),
+    (((0, b'RIFF'), (8, b'WAVE')), 'audio/wav'),
+    (((0, b'RIFF'), (8, b'AVI ')), 'video/x-msvideo'),
+    (((0, b'\x1a\x45\xdf\xa3'),), 'video/webm'),  # EBML: WebM/Matroska, аудио или видео
+    # HEIC/HEIF (фото с iOS) - тоже ISO BMFF, отличаются основным брендом
+    *((((4, b'ftyp'), (8, brand)), 'image/heic') for brand in HEIC_BRANDS),
+    *((((4, b'ftyp'), (8, brand)), 'image/heif') for brand in HEIF_BRANDS),
+    (((4, b'ftyp'),), 'video/mp4'),  # ISO BMFF: MP4/M4A/MOV, аудио или видео
+    (((0, b'OggS'),), 'audio/ogg'),
+    (((0, b'ID3'),), 'audio/mpeg'),
+    (((0, b'\xff\xfb'),), 'audio/mpeg'),
+    (((0, b'\xff\xf3'),), 'audio/mpeg'),
+    (((0, b'\xff\xf2'),), 'audio/mpeg'),
+    (((0, b'fLaC'),), 'audio/flac'),
+    (((0, b'%PDF-'),), 'application/pdf'),
+    (((0, b'PK\x03\x04'),), 'application/zip'),
+    (((0, b'Rar!\x1a\x07'),), 'application/x-rar-compressed'),
+)
+# Контейнеры, по сигнатуре которых не отличить аудио от видео
+AMBIGUOUS_CONTAINERS = ('video/webm', 'video/mp4', 'audio/ogg')
+# Какие типы содержимого допустимы для каждого вида сообщения
+MEDIA_KIND_TYPES = {
+    'voice': ('audio/', 'video/webm', 'video/mp4', 'video/ogg'),
+    'video': ('video/',),
+    'image': ('image/',),
+    'music': ('audio/',),
+    'file': ALLOWED_MEDIA_TYPES
+}
+SNIFF_BYTES = 32
+
+def sniff_mime(head):
+    """MIME по магическим байтам начала файла или None"""
+    for conditions, mime_type in MAGIC_SIGNATURES:
+        if all(head[offset:offset + len(magic)] == magic for offset, magic in conditions):
+            return mime_type
+    return None
+
+def resolve_media_mime(head, claimed, mediatype):
+    """Настоящий тип файла: сигнатура важнее заявленного клиентом типа"""
+    sniffed = sniff_mime(head)
+    
+    if sniffed is None:
+        # Без сигнатуры принимаем только обычные файлы (отдаются с nosniff)
+        if mediatype != 'file':
+            raise ValueError("Содержимое файла не соответствует его типу")
+        if claimed == 'text/plain' and b'\x00' not in head:
+            return claimed
+        return 'application/octet-stream'
+    
+    if sniffed in AMBIGUOUS_CONTAINERS:
+        family = claimed.split('/')[0]
+        if family in ('audio', 'video'):
+            sniffed = f"{family}/{sniffed.split('/')[1]}"
+    
+    if not sniffed.startswith(ALLOWED_MEDIA_TYPES) or not sniffed.startswith(MEDIA_KIND_TYPES[mediatype]):
+        raise ValueError("Недопустимый тип файла")
+    return sniffed
+
+class MediaSniffer:
+    """inspect-колбэк для BLOB_STORE.put_stream: тип файла по первым байтам"""
+    def __init__(self, claimed, mediatype):
+        self.claimed = claimed
+        self.mediatype = mediatype
+        self.mime = None
+    
+    def __call__(self, head):
+        self.mime = resolve_media_mime(head, self.claimed, self.mediatype)
+
+BASE64_WHITESPACE_RE = re.compile(r'\s+')
+
+class Base64Reader:
+    """Файлоподобное чтение base64-строки: декодирует кусками, не копируя строку целиком.
+    Переносы строк (MIME-base64 по 76 символов) пропускаются, остальной алфавит проверяется строго"""
+    def __init__(self, text, start=0, chunk_chars=UPLOAD_CHUNK_SIZE // 3 * 4):
+        self.text = text
+        self.pos = start
+        self.chunk_chars = chunk_chars
+        self.tail = ''  # Символы, не добравшие до группы из 4, ждут следующего куска
+    
+    def read(self, size=-1):
+        chunk = self.tail
+        while len(chunk) < 4 and self.pos < len(self.text):
+            piece = self.text[self.pos:self.pos + self.chunk_chars]
+            self.pos += len(piece)
+            chunk += BASE64_WHITESPACE_RE.sub('', piece)
+        if not chunk:
+            return b''
+        
+        # Декодируем только полные группы, остаток - в следующий вызов
+        if self.pos < len(self.text):
+            cut = len(chunk) - len(chunk) % 4
+            chunk, self.tail = chunk[:cut], chunk[cut:]
+        else:
+            self.tail = ''
+        try:
+            return base64.b64decode(chunk, validate=True)
+        except (binascii.Error, ValueError):
+            raise ValueError("Неверный формат base64")
+
+def store_base64_media(data, mediatype, default_mime, max_size_mb):
+    """Однопроходный прием base64: размер по длине строки, сигнатура по первому куску,
+    декодирование сразу в хранилище -> (хэш, mime, размер)"""
+    if not data or not isinstance(data, str):
+        raise ValueError("Отсутствуют данные файла")
+    
+    claimed = default_mime
+    start = 0
+    if data.startswith('data:'):
+        start = data.find(',') + 1
+        if not start:
+            raise ValueError("Неверный формат data URI")
+        header = data[:start - 1]
+        if 'base64' not in header:
+            raise ValueError("Неверный формат data URI")
+        mime_match = re.match(r'data:([^;,]+)', header)
+        if mime_match:
+            claimed = mime_match.group(1)
+    
+    # Размер известен по длине строки - отказываем до декодирования
+    max_size = max_size_mb * 1024 * 1024
+    encoded_chars = len(data) - start - data.count('\n', start) - data.count('\r', start)
+    if encoded_chars * 3 // 4 > max_size + 2:
+        raise ValueError("Превышен размер файла")
+    
+    sniffer = MediaSniffer(claimed, mediatype)
+    digest, size = BLOB_STORE.put_stream(Base64Reader(data, start), max_size, inspect=sniffer)
+    return digest, sniffer.mime, size
+
+# ===== КЭШ ПРЕОБРАЗОВАНИЙ =====
+TRANSFORM_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TRANSFORM_CACHE_DIR = os.path.join(MEDIA_DIR, 'cache')  # Дисковый уровень; None - только память
+TRANSFORM_CACHE_DISK_TTL = 7 * 24 * 3600
+IMAGE_COMPRESS_MIN_BYTES = 102400  # Меньшие изображения не сжимаем
+IMAGE_VARIANTS = {
+    'placeholder': {'max_side': 24, 'quality': 30, 'blur': 2},  # Размытая заглушка в несколько сотен байт
+    'thumb': {'max_side': 320, 'quality': 70, 'blur': 0},  # Миниатюра для пузыря чата
+    'full': {'max_side': 1200, 'quality': 82, 'blur': 0}
+}
+
+def transform_key(digest, name, *params):
+    """Ключ кэша: хэш исходных данных + преобразование и его параметры"""
+    return f"{digest}:{name}:{':'.join(str(param) for param in params)}"
+
+class TransformCache:
+    """LRU-кэш результатов преобразований (mime, bytes), ограниченный суммарным размером"""
+    def __init__(self, max_bytes=TRANSFORM_CACHE_MAX_BYTES, disk_dir=TRANSFORM_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()  # {key: (mime, bytes)}
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+    
+    def disk_path(self, key):
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.disk_dir, name[:2], name)
+    
+    def get(self, key):
+        """(найдено, значение)"""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, value
         
-        if 'image/svg+xml' in header:
-            return base64_data
+        if self.disk_dir:
+            try:
+                with open(self.disk_path(key), 'rb') as f:
+                    mime_type, _, data = f.read().partition(b'\n')
+                value = (mime_type.decode(), data)
+                self.remember(key, value)
+                with self.lock:
+                    self.disk_hits += 1
+                return True, value
+            except OSError:
+                pass
         
+        with self.lock:
+            self.misses += 1
+        return False, None
+    
+    def remember(self, key, value):
+        weight = len(value[1])
+        if weight > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = value
+            self.size += weight
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[1])
+                self.evictions += 1
+    
+    def put(self, key, value):
+        self.remember(key, value)
+        if not self.disk_dir:
+            return
+        path = self.disk_path(key)
         try:
-            img_data = base64.b64decode(data)
-        except Exception:
-            return base64_data
-        
-        # Проверяем размер
-        if len(img_data) < 102400:
-            return base64_data
-        
-        # Определяем формат
-        img_format = 'JPEG'
-        if 'image/png' in header:
-            img_format = 'PNG'
-        elif 'image/webp' in header:
-            img_format = 'WEBP'
-        
-        # Обрабатываем изображение
-        img = Image.open(io.BytesIO(img_data))
-        
-        if img_format == 'JPEG' and img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
-        
-        # Масштабируем
-        if max(img.size) > max(max_size):
-            ratio = min(max_size[0] / img.size[0], max_size[1] / img.size[1])
-            new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
-        
-        # Сжимаем
-        output = io.BytesIO()
-        
-        if img_format == 'PNG':
-            img.save(output, format='PNG', optimize=True)
-        elif img_format == 'WEBP':
-            img.save(output, format='WEBP', quality=quality)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(value[0].encode() + b'\n' + value[1])
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Не удалось записать кэш преобразования: {e}")
+    
+    def prune_disk(self, max_age=TRANSFORM_CACHE_DISK_TTL):
+        """Удаляет давно не использованные файлы дискового уровня"""
+        if not self.disk_dir or not os.path.isdir(self.disk_dir):
+            return 0
+        cutoff = time.time() - max_age
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.disk_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getatime(path) < cutoff and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+TRANSFORM_CACHE = TransformCache()
+
+def compress_image_data(digest, mime_type, max_size=(1200, 1200), quality=85):
+    """Сжатие файла из хранилища через кэш преобразований и пул процессов: (mime, bytes) или None"""
+    path = BLOB_STORE.path(digest)
+    if os.path.getsize(path) < IMAGE_COMPRESS_MIN_BYTES or mime_type in IMAGE_PASSTHROUGH_TYPES:
+        return None
+    
+    key = transform_key(digest, 'compress', max_size, quality)
+    found, result = TRANSFORM_CACHE.get(key)
+    if found:
+        return result
+    
+    # Процесс пула читает файл сам - через канал идет только путь
+    result = IMAGE_PROCESSOR.compress(path, mime_type, max_size, quality)
+    # Отказ пула (None) не кэшируем - в следующий раз может получиться
+    if result:
+        TRANSFORM_CACHE.put(key, result)
+    return result
+
+# ===== ДОЗАГРУЖАЕМЫЕ ЗАГРУЗКИ =====
+UPLOADS_DIR = os.path.join(MEDIA_DIR, 'uploads')
+UPLOAD_TTL = 24 * 3600  # Незавершенная загрузка живет сутки с последнего куска
+UPLOAD_CHUNK_HINT = 2 * 1024 * 1024  # Рекомендуемый размер куска для клиента
+UPLOAD_MAX_CHUNK = 8 * 1024 * 1024
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadConflictError(ValueError):
+    """Загрузка занята другим запросом: идет запись куска или завершение"""
+
+def merge_ranges(ranges, start, end):
+    """Добавляет полуоткрытый диапазон [start, end) к отсортированному списку и склеивает соседние"""
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
         else:
-            img.save(output, format='JPEG', quality=quality, optimize=True)
+            merged.append([range_start, range_end])
+    return merged
+
+class UploadManager:
+    """Частичные загрузки на диске: <id>.part с данными и <id>.json с уже полученными диапазонами"""
+    def __init__(self, root=UPLOADS_DIR, ttl=UPLOAD_TTL):
+        self.root = root
+        self.ttl = ttl
+        self.uploads = {}  # {upload_id: метаданные} - кэш поверх .json (воркер мог перезапуститься)
+        self.writing = {}  # {upload_id: число кусков, которые пишутся прямо сейчас}
+        self.finalizing = set()  # Загрузки, которые уже переносятся в хранилище
+        self.thread = None
+        self.created = 0
+        self.completed = 0
+        self.expired = 0
+        self.lock = threading.RLock()
+    
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True, name="uploads_cleanup")
+            self.thread.start()
+    
+    def paths(self, upload_id):
+        base = os.path.join(self.root, upload_id)
+        return f"{base}.part", f"{base}.json"
+    
+    def save(self, upload):
+        _, meta_path = self.paths(upload['upload_id'])
+        tmp_path = f"{meta_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(upload, f, ensure_ascii=False)
+        os.replace(tmp_path, meta_path)
+    
+    def create(self, login, chat_id, mediatype, filename, mime_type, size):
+        now = time.time()
+        upload = {
+            'upload_id': uuid.uuid4().hex,
+            'login': login,
+            'chat_id': chat_id,
+            'mediatype': mediatype,
+            'filename': filename,
+            'mime': mime_type,
+            'size': size,
+            'received': [],
+            'created_at': now,
+            'expires_at': now + self.ttl
+        }
+        
+        os.makedirs(self.root, exist_ok=True)
+        part_path, _ = self.paths(upload['upload_id'])
+        with open(part_path, 'wb') as f:
+            f.truncate(size)  # Разреженный файл: куски пишутся по смещениям в любом порядке
+        
+        with self.lock:
+            self.save(upload)
+            self.uploads[upload['upload_id']] = upload
+            self.created += 1
+        return upload
+    
+    def get(self, upload_id):
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            return None
+        
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if not upload:
+                _, meta_path = self.paths(upload_id)
+                try:
+                    with open(meta_path, encoding='utf-8') as f:
+                        upload = json.load(f)
+                except (OSError, ValueError):
+                    return None
+                self.uploads[upload_id] = upload
+            
+            if upload['expires_at'] < time.time():
+                self.discard(upload_id)
+                self.expired += 1
+                return None
+            return upload
+    
+    def write_chunk(self, upload, start, length, stream):
+        """Пишет кусок по смещению потоково; возвращает список полученных диапазонов"""
+        upload_id = upload['upload_id']
+        part_path, _ = self.paths(upload_id)
         
-        compressed = output.getvalue()
+        with self.lock:
+            # Пока файл хэшируется и переносится в хранилище, писать в него нельзя
+            if upload_id in self.finalizing or upload_id not in self.uploads:
+                raise UploadConflictError("Загрузка уже завершается")
+            self.writing[upload_id] = self.writing.get(upload_id, 0) + 1
         
-        if len(compressed) >= len(img_data):
-            return base64_data
+        try:
+            written = 0
+            with open(part_path, 'r+b') as f:
+                f.seek(start)
+                while written < length:
+                    chunk = stream.read(min(UPLOAD_CHUNK_SIZE, length - written))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    written += len(chunk)
+            
+            if written != length:
+                raise ValueError("Кусок получен не полностью")
+            
+            with self.lock:
+                upload['received'] = merge_ranges(upload['received'], start, start + length)
+                upload['expires_at'] = time.time() + self.ttl
+                self.save(upload)
+                return upload['received']
+        finally:
+            with self.lock:
+                count = self.writing.pop(upload_id) - 1
+                if count:
+                    self.writing[upload_id] = count
+    
+    def is_complete(self, upload):
+        return upload['received'] == [[0, upload['size']]]
+    
+    def read_head(self, upload, size=SNIFF_BYTES):
+        part_path, _ = self.paths(upload['upload_id'])
+        with open(part_path, 'rb') as f:
+            return f.read(size)
+    
+    def finalize(self, upload):
+        """Переносит собранный файл в хранилище медиа: (хэш, размер)"""
+        upload_id = upload['upload_id']
+        part_path, meta_path = self.paths(upload_id)
         
-        mime_type = 'image/jpeg'
-        if img_format == 'PNG':
-            mime_type = 'image/png'
-        elif img_format == 'WEBP':
-            mime_type = 'image/webp'
+        with self.lock:
+            # Повторный finalize того же id не пройдет
+            if upload_id in self.finalizing or upload_id not in self.uploads:
+                raise ValueError("Загрузка уже завершена")
+            # Недописанный кусок изменил бы файл во время хэширования
+            if self.writing.get(upload_id):
+                raise UploadConflictError("Кусок загрузки еще записывается, повторите позже")
+            self.finalizing.add(upload_id)
+            del self.uploads[upload_id]
+            os.remove(meta_path)
+            self.completed += 1
         
-        return f"data:{mime_type};base64,{base64.b64encode(compressed).decode()}"
+        try:
+            return BLOB_STORE.put_path(part_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            with self.lock:
+                self.finalizing.discard(upload_id)
+    
+    def discard(self, upload_id):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+            for path in self.paths(upload_id):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
     
-    except Exception as e:
-        logger.error(f"Ошибка сжатия изображения: {e}")
-        return base64_data
-
-def validate_base64_data(data, max_size_mb=100):
-    """Валидация base64 данных"""
-    if not data:
-        return False
+    def expire(self):
+        """Удаляет просроченные незавершенные загрузки"""
+        if not os.path.isdir(self.root):
+            return 0
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.root):
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.part' or not UPLOAD_ID_RE.match(upload_id):
+                continue
+            _, meta_path = self.paths(upload_id)
+            try:
+                with open(meta_path, encoding='utf-8') as f:
+                    expires_at = json.load(f)['expires_at']
+            except (OSError, ValueError, KeyError):
+                # Данные без метаданных - ориентируемся на время изменения файла
+                try:
+                    expires_at = os.path.getmtime(os.path.join(self.root, name)) + self.ttl
+                except OSError:
+                    continue
+            if expires_at < now:
+                self.discard(upload_id)
+                removed += 1
+        with self.lock:
+            self.expired += removed
+        if removed:
+            logger.info(f"Удалено {removed} просроченных загрузок")
+        return removed
     
-    try:
-        estimated_size = len(data) * 3 / 4
-        if estimated_size > max_size_mb * 1024 * 1024:
-            return False
-        
-        if data.startswith('data:'):
-            if ',' not in data:
-                return False
-            header, b64 = data.split(',', 1)
-            if 'base64' not in header:
-                return False
-            
-            # Проверяем MIME тип
-            mime_match = re.match(r'data:(.+);base64', header)
-            if mime_match:
-                mime_type = mime_match.group(1)
-                allowed_types = [
-                    'image/', 'video/', 'audio/',
-                    'application/pdf', 'text/plain',
-                    'application/zip', 'application/x-rar-compressed'
-                ]
-                if not any(mime_type.startswith(allowed) for allowed in allowed_types):
-                    return False
-            
-            decoded = base64.b64decode(b64, validate=True)
-            
-            if len(decoded) > max_size_mb * 1024 * 1024:
-                return False
-                
-            return True
-        else:
-            decoded = base64.b64decode(data, validate=True)
-            if len(decoded) > max_size_mb * 1024 * 1024:
-                return False
-            return True
-    except Exception:
-        return False
+    def run(self):
+        while True:
+            time.sleep(600)  # Каждые 10 минут
+            try:
+                self.expire()
+            except Exception as e:
+                logger.error(f"Ошибка очистки загрузок: {e}")
+    
+    def status(self, upload):
+        return {
+            'upload_id': upload['upload_id'],
+            'size': upload['size'],
+            'received': upload['received'],
+            'complete': self.is_complete(upload),
+            'chunk_size': UPLOAD_CHUNK_HINT,
+            'max_chunk': UPLOAD_MAX_CHUNK,
+            'expires_at': upload['expires_at']
+        }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'active': len(self.uploads),
+                'created': self.created,
+                'completed': self.completed,
+                'expired': self.expired
+            }
+
+UPLOADS = UploadManager()
 
 # ===== ФУНКЦИИ ДЛЯ РАБОТЫ С СООБЩЕНИЯМИ =====
 def update_message_status(msgid, status_type, login=None):
     """Обновление статуса сообщения"""
-    conn = None
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
-        
-        c = conn.cursor()
-        
-        if status_type == 'delivered':
-            c.execute("UPDATE messages SET delivered = 1 WHERE id = ?", (msgid,))
-                    
-        elif status_type == 'read' and login:
-            c.execute("""
-                UPDATE messages 
-                SET readcount = readcount + 1 
-                WHERE id = ?
-                RETURNING readcount
-            """, (msgid,))
+        with DB_POOL.connection() as conn:
+            c = conn.cursor()
+            
+            if status_type == 'delivered':
+                c.execute("UPDATE messages SET delivered = 1 WHERE id = ?", (msgid,))
+                        
+            elif status_type == 'read' and login:
+                c.execute("""
+                    UPDATE messages 
+                    SET readcount = readcount + 1 
+                    WHERE id = ?
+                    RETURNING readcount
+                """, (msgid,))
+                
+                result = c.fetchone()
+            
+            conn.commit()
             
-            result = c.fetchone()
-        
-        conn.commit()
-        
     except Exception as e:
         logger.error(f"Ошибка обновления статуса сообщения {msgid}: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 def send_push_notification(login, notification_data):
-    """Отправка пуш-уведомления пользователю"""
+    """Отправка пуш-уведомления пользователю (словарь или готовое SSEEvent)"""
+    if not isinstance(notification_data, SSEEvent):
+        notification_data = SSEEvent(notification_data)
+    
     try:
-        with SSE_LOCK:
-            if login in SSE_CONNECTIONS:
-                try:
-                    sse_queue = SSE_CONNECTIONS[login]
-                    sse_queue.put(notification_data)
-                    return True
-                except Exception as e:
-                    logger.error(f"Ошибка отправки push-уведомления {login}: {e}")
-                    # Удаляем нерабочую очередь
-                    SSE_CONNECTIONS.pop(login, None)
-                    return False
-        return False
+        with SSE_HUB.lock:
+            # История пишется и без соединения: переподключившийся клиент дозагрузит пропущенное
+            if login in ONLINE_USERS:
+                SSE_HISTORY.append(login, notification_data)
+            
+            return SSE_HUB.publish(login, notification_data) > 0
     except Exception as e:
         logger.error(f"Ошибка отправки пуш-уведомления: {e}")
         return False
 
-def save_message(msg):
-    """Сохранение сообщения в БД"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Не удалось подключиться к БД для сохранения сообщения")
-            return
-        
+def message_row(msg):
+    """Строка для INSERT в таблицу messages"""
+    filesize = msg.get('filesize', 0)
+    if not filesize and msg.get('mediadata'):
+        filesize = len(msg['mediadata']) * 3 // 4
+    
+    # Медиа из хранилища не дублируем в строке
+    mediadata = '' if msg.get('media_hash') else msg.get('mediadata', '')
+    
+    return (
+        msg['id'], msg.get('chat_id'), msg['login'], msg.get('text', ''),
+        msg['ts'], int(msg.get('isvoice', 0)),
+        msg.get('mediatype'), mediadata,
+        msg.get('filename', ''), filesize,
+        int(msg.get('delivered', 0)),
+        int(msg.get('readcount', 0)),
+        msg.get('sound'),
+        msg.get('media_hash'), msg.get('media_mime')
+    )
+
+def save_messages(messages):
+    """Сохранение пакета сообщений в БД одной транзакцией"""
+    # Счетчики чатов агрегируются: один UPDATE на чат вместо одного на сообщение
+    chat_updates = {}
+    for msg in messages:
+        if msg.get('chat_id'):
+            count, last_ts = chat_updates.get(msg['chat_id'], (0, 0))
+            chat_updates[msg['chat_id']] = (count + 1, max(last_ts, msg['ts']))
+    
+    with DB_POOL.transaction() as conn:
         c = conn.cursor()
+        c.executemany('''
+            INSERT INTO messages (id, chat_id, login, text, ts, isvoice, mediatype,
+                               mediadata, filename, filesize, delivered, readcount, sound_data,
+                               media_hash, media_mime)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [message_row(msg) for msg in messages])
+        
+        # Обновляем счетчики сообщений в чатах
+        c.executemany('''
+            UPDATE private_chats
+            SET messages_count = messages_count + ?, last_activity = MAX(last_activity, ?)
+            WHERE chat_id = ?
+        ''', [(count, last_ts, chat_id) for chat_id, (count, last_ts) in chat_updates.items()])
+
+# ===== ОТЛОЖЕННАЯ ЗАПИСЬ СООБЩЕНИЙ =====
+MESSAGE_BATCH_SIZE = 200
+MESSAGE_FLUSH_INTERVAL = 0.2  # Максимальная задержка записи пакета (сек)
+
+class MessageWriter:
+    """Единый фоновый писатель: собирает сообщения в пакеты и пишет их групповым коммитом"""
+    def __init__(self, batch_size=MESSAGE_BATCH_SIZE, flush_interval=MESSAGE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue()
+        self.thread = None
+        self.stopped = False
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.flush_time = 0.0
+        self.max_flush = 0.0
+        self.max_lag = 0.0
+        self.lock = threading.RLock()
+    
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run, daemon=True, name="message_writer")
+            self.thread.start()
+    
+    def submit(self, msg):
+        """Ставит сообщение в очередь записи (не блокирует запрос)"""
+        # Проверка и постановка под одной блокировкой: stop() не вклинится между ними,
+        # иначе сообщение встанет в очередь после завершающего None и потеряется
+        with self.lock:
+            if not self.stopped:
+                self.start()
+                self.pending.put((time.time(), msg))
+                return
+        # Писатель уже остановлен - пишем синхронно, чтобы не потерять сообщение
+        self.flush([(time.time(), msg)])
+    
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            deadline = time.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            self.flush(batch)
+            if stop:
+                break
         
-        filesize = 0
-        if msg.get('mediadata'):
-            filesize = len(msg['mediadata']) * 3 // 4
+        # Дописываем всё, что успели поставить до остановки
+        rest = []
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                rest.append(item)
+        for i in range(0, len(rest), self.batch_size):
+            self.flush(rest[i:i + self.batch_size])
+    
+    def flush(self, batch):
+        started = time.time()
+        messages = [msg for _, msg in batch]
+        try:
+            save_messages(messages)
+            written, failed = len(messages), 0
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи {len(messages)} сообщений: {e}")
+            # Пишем по одному, чтобы одна плохая строка не потеряла весь пакет
+            written = failed = 0
+            for msg in messages:
+                try:
+                    save_messages([msg])
+                    written += 1
+                except Exception as e2:
+                    failed += 1
+                    logger.error(f"Ошибка сохранения сообщения {msg.get('id')}: {e2}")
         
-        c.execute('''
-            INSERT INTO messages (id, chat_id, login, text, ts, isvoice, mediatype, 
-                               mediadata, filename, filesize, delivered, readcount, sound_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            msg['id'], msg.get('chat_id'), msg['login'], msg.get('text', ''),
-            msg['ts'], int(msg.get('isvoice', 0)),
-            msg.get('mediatype'), msg.get('mediadata', ''),
-            msg.get('filename', ''), filesize,
-            int(msg.get('delivered', 0)),
-            int(msg.get('readcount', 0)),
-            msg.get('sound')
-        ))
-        
-        # Обновляем счетчик сообщений в чате
-        if msg.get('chat_id'):
-            c.execute('''
-                UPDATE private_chats 
-                SET messages_count = messages_count + 1, last_activity = ?
-                WHERE chat_id = ?
-            ''', (msg['ts'], msg['chat_id']))
+        finished = time.time()
+        with self.lock:
+            self.batches += 1
+            self.written += written
+            self.failed += failed
+            self.flush_time += finished - started
+            self.max_flush = max(self.max_flush, finished - started)
+            self.max_lag = max(self.max_lag, finished - batch[0][0])
+    
+    def stop(self, timeout=10):
+        """Останавливает писателя, дописав очередь"""
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            thread = self.thread
+        if thread and thread.is_alive():
+            self.pending.put(None)
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning(f"Очередь записи сообщений не опустела: {self.pending.qsize()}")
+        logger.info(f"Запись сообщений остановлена: записано {self.written}, ошибок {self.failed}")
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.pending.qsize(),
+                'batches': self.batches,
+                'written': self.written,
+                'failed': self.failed,
+                'avg_batch': round(self.written / self.batches, 1) if self.batches else 0,
+                'avg_flush_ms': round(self.flush_time / self.batches * 1000, 2) if self.batches else 0,
+                'max_flush_ms': round(self.max_flush * 1000, 2),
+                'max_lag_ms': round(self.max_lag * 1000, 2)
+            }
+
+MESSAGE_WRITER = MessageWriter()
+atexit.register(MESSAGE_WRITER.stop)
+
+# ===== ЗАПИСЬ СЕРДЦЕБИЕНИЙ =====
+HEARTBEAT_FLUSH_INTERVAL = 15  # Период сброса сердцебиений в БД (сек)
+
+class HeartbeatFlusher:
+    """Копит последние сердцебиения в памяти и раз в N секунд пишет их одной транзакцией"""
+    def __init__(self, interval=HEARTBEAT_FLUSH_INTERVAL):
+        self.interval = interval
+        self.dirty = {}  # {login: (ts, ip_address, user_agent)}
+        self.thread = None
+        self.flushes = 0
+        self.rows = 0
+        self.heartbeats = 0
+        self.flush_time = 0.0
+        self.last_flush_ms = 0.0
+        self.lock = threading.RLock()
+    
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True, name="heartbeat_flusher")
+            self.thread.start()
+    
+    def mark(self, login, ts, ip_address, user_agent):
+        """Запоминает сердцебиение; повторные до сброса перезаписывают друг друга"""
+        with self.lock:
+            self.dirty[login] = (ts, ip_address, user_agent)
+            self.heartbeats += 1
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+    
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
         
-        conn.commit()
+        # Вышедшие и отключенные пользователи уже удалены из сессий - не воскрешаем их
+        rows = [(login,) + entry for login, entry in dirty.items() if login in ONLINE_USERS]
+        if not rows:
+            return
         
-    except Exception as e:
-        logger.error(f"Ошибка сохранения сообщения: {e}")
-    finally:
-        if conn:
-            conn.close()
+        started = time.time()
+        try:
+            with DB_POOL.transaction() as conn:
+                c = conn.cursor()
+                c.executemany('''
+                    UPDATE user_sessions
+                    SET last_activity = ?, ip_address = ?, user_agent = ?
+                    WHERE login = ?
+                ''', [(ts, ip, ua, login) for login, ts, ip, ua in rows])
+                
+                # Если сессии нет - создаем (на случай восстановления)
+                c.executemany('''
+                    INSERT INTO user_sessions
+                    (session_id, login, ip_address, user_agent, last_activity)
+                    SELECT ?, ?, ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM user_sessions WHERE login = ?)
+                ''', [(str(uuid.uuid4()), login, ip, ua, ts, login) for login, ts, ip, ua in rows])
+                
+                c.executemany('''
+                    UPDATE users
+                    SET last_heartbeat = ?, ip_address = ?, user_agent = ?
+                    WHERE login = ?
+                ''', [(ts, ip, ua, login) for login, ts, ip, ua in rows])
+        except Exception as e:
+            logger.error(f"Ошибка записи сердцебиений ({len(rows)}): {e}")
+            # Возвращаем записи, если за это время не пришли более свежие
+            with self.lock:
+                for login, ts, ip, ua in rows:
+                    self.dirty.setdefault(login, (ts, ip, ua))
+            return
+        
+        elapsed = time.time() - started
+        with self.lock:
+            self.flushes += 1
+            self.rows += len(rows)
+            self.flush_time += elapsed
+            self.last_flush_ms = round(elapsed * 1000, 2)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'dirty': len(self.dirty),
+                'heartbeats': self.heartbeats,
+                'flushes': self.flushes,
+                'rows': self.rows,
+                'avg_flush_ms': round(self.flush_time / self.flushes * 1000, 2) if self.flushes else 0,
+                'last_flush_ms': self.last_flush_ms
+            }
+
+HEARTBEAT_FLUSHER = HeartbeatFlusher()
+atexit.register(HEARTBEAT_FLUSHER.flush)
+
+# ===== ДОЛГИЙ ОПРОС =====
+LONG_POLL_MAX_WAIT = 25  # Дольше не держим: прокси рвут молчащие запросы около 30 сек
+
+class ChatWaiters:
+    """Долгий опрос: запросы ждут нового сообщения на Condition своего чата"""
+    def __init__(self):
+        self.conditions = {}  # {chat_id: [Condition, число ожидающих]}
+        self.waits = 0
+        self.woken = 0
+        self.timeouts = 0
+        self.peak_waiting = 0
+        self.lock = threading.RLock()
+    
+    def wait(self, chat_id, ready, timeout):
+        """Ждет, пока ready() не станет истинным или не истечет timeout; возвращает ready()"""
+        with self.lock:
+            entry = self.conditions.get(chat_id)
+            if entry is None:
+                entry = self.conditions[chat_id] = [threading.Condition(self.lock), 0]
+            entry[1] += 1
+            self.waits += 1
+            self.peak_waiting = max(self.peak_waiting, sum(e[1] for e in self.conditions.values()))
+            try:
+                result = entry[0].wait_for(ready, timeout)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.conditions[chat_id]
+            
+            if result:
+                self.woken += 1
+            else:
+                self.timeouts += 1
+            return result
+    
+    def notify(self, chat_id):
+        """Будит ожидающих чата (новое сообщение, выход собеседника)"""
+        with self.lock:
+            entry = self.conditions.get(chat_id)
+            if entry:
+                entry[0].notify_all()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'waiting': sum(entry[1] for entry in self.conditions.values()),
+                'chats': len(self.conditions),
+                'peak_waiting': self.peak_waiting,
+                'waits': self.waits,
+                'woken': self.woken,
+                'timeouts': self.timeouts
+            }
+
+CHAT_WAITERS = ChatWaiters()
 
 def save_and_broadcast_message(msg):
     """Сохранение и рассылка сообщения (обновлено для приватных чатов)"""
@@ -857,18 +3021,17 @@ def save_and_broadcast_message(msg):
         if msg['login'] not in chat['users']:
             raise ValueError("Вы не состоите в этом чате")
         
-        with threading.RLock():
+        with STATE.chat_locked(chat):
+            # Буфер сам вытесняет старые сообщения сверх MESSAGE_HISTORY_LIMIT
             chat['messages'].append(msg)
             chat['last_activity'] = time.time()
-            
-            if len(chat['messages']) > MESSAGE_HISTORY_LIMIT * 2:
-                chat['messages'] = chat['messages'][-MESSAGE_HISTORY_LIMIT:]
         
         # Рассылаем в приватный чат
         broadcast_to_chat(chat_id, msg, exclude_login=msg['login'])
+        CHAT_WAITERS.notify(chat_id)
     
-    # Сохраняем в БД
-    threading.Thread(target=save_message, args=(msg,), daemon=True).start()
+    # Сохраняем в БД (пакетно, в фоне)
+    MESSAGE_WRITER.submit(msg)
     
     return msg
 
@@ -882,50 +3045,30 @@ def cleanup_inactive_users():
             expired_users = []
             
             # Собираем неактивных пользователей
-            with threading.RLock():
-                users_to_check = list(USER_LAST_ACTIVE.items())
+            users_to_check = list(USER_LAST_ACTIVE.items())
             
             for user, last_active in users_to_check:
                 if now - last_active > INACTIVITY_TIMEOUT:
                     expired_users.append(user)
             
-            # Обрабатываем истекших пользователей
+            # Обрабатываем истекших пользователей (кроме успевших проявить активность)
+            expired_users = [
+                user for user in expired_users
+                if remove_user_from_all_queues(user, inactive_before=now - INACTIVITY_TIMEOUT)
+            ]
+            
             if expired_users:
                 logger.info(f"Автомосвобождение: {len(expired_users)} пользователей")
                 
-                for user in expired_users:
-                    with threading.RLock():
-                        if user in ONLINE_USERS:
-                            ONLINE_USERS.discard(user)
-                            USER_LAST_ACTIVE.pop(user, None)
-                            USER_PREFERENCES.pop(user, None)
-                    
-                    # Выходим из чата если пользователь в нем
-                    leave_private_chat(user)
-                    
-                    # Удаляем из очереди ожидания
-                    if user in WAITING_USERS:
-                        WAITING_USERS.remove(user)
-                    
-                    # Закрываем SSE соединение
-                    with SSE_LOCK:
-                        if user in SSE_CONNECTIONS:
-                            SSE_CONNECTIONS.pop(user, None)
-                
                 # Удаляем сессии из БД
-                conn = None
                 try:
-                    conn = get_db_connection()
-                    if conn:
+                    with DB_POOL.connection() as conn:
                         c = conn.cursor()
                         placeholders = ','.join('?' for _ in expired_users)
                         c.execute(f"DELETE FROM user_sessions WHERE login IN ({placeholders})", expired_users)
                         conn.commit()
                 except Exception as e:
                     logger.error(f"Ошибка очистки сессий: {e}")
-                finally:
-                    if conn:
-                        conn.close()
                     
         except Exception as e:
             logger.error(f"Ошибка очистки пользователей: {e}")
@@ -935,16 +3078,13 @@ def cleanup_old_sessions():
     while True:
         time.sleep(3600)  # Каждый час
         try:
-            conn = get_db_connection()
-            if conn:
+            with DB_POOL.connection() as conn:
                 c = conn.cursor()
                 cutoff = time.time() - (7 * 24 * 3600)  # 7 дней
                 c.execute("DELETE FROM user_sessions WHERE last_activity < ?", (cutoff,))
                 deleted = c.rowcount
                 if deleted > 0:
                     logger.info(f"Очистка сессий: удалено {deleted} старых сессий")
-                conn.commit()
-                conn.close()
         except Exception as e:
             logger.error(f"Ошибка очистки сессий: {e}")
 
@@ -952,55 +3092,55 @@ def auto_cleanup_old_messages():
     """Автоматическая очистка старых сообщений"""
     while True:
         time.sleep(3600)  # Каждый час
-        conn = None
         try:
-            conn = get_db_connection()
-            if not conn:
-                continue
+            with DB_POOL.connection() as conn:
+                c = conn.cursor()
+                cutoff = time.time() - (30 * 24 * 3600)  # 30 дней
+                c.execute("DELETE FROM messages WHERE ts < ?", (cutoff,))
+                deleted_count = c.rowcount
+                
+                if deleted_count > 0:
+                    logger.info(f"Автоочистка: удалено {deleted_count} старых сообщений")
+                    conn.commit()
+                
+                # Удаляем медиафайлы, на которые больше не ссылается ни одно сообщение
+                c.execute("SELECT DISTINCT media_hash FROM messages WHERE media_hash IS NOT NULL")
+                referenced = {row[0] for row in c.fetchall()}
+                removed = BLOB_STORE.collect_garbage(referenced)
+                if removed > 0:
+                    logger.info(f"Автоочистка: удалено {removed} медиафайлов без ссылок")
+                TRANSFORM_CACHE.prune_disk()
+                
+                # Оптимизация БД
+                c.execute("VACUUM")
                 
-            c = conn.cursor()
-            cutoff = time.time() - (30 * 24 * 3600)  # 30 дней
-            c.execute("DELETE FROM messages WHERE ts < ?", (cutoff,))
-            deleted_count = c.rowcount
-            
-            if deleted_count > 0:
-                logger.info(f"Автоочистка: удалено {deleted_count} старых сообщений")
-                conn.commit()
-            
-            # Оптимизация БД
-            c.execute("VACUUM")
-            
         except Exception as e:
             logger.error(f"Ошибка автоочистки сообщений: {e}")
-        finally:
-            if conn:
-                conn.close()
 
 # ===== ВАЛИДАЦИЯ И УТИЛИТЫ =====
-def require_online_user(silent=True):
+def require_online_user(silent=True, login=None):
     """Проверка онлайн пользователя с проверкой активности"""
-    data = request.get_json(silent=True) or {}
-    login = data.get('login', '').strip()
+    if login is None:
+        data = request.get_json(silent=True) or {}
+        login = data.get('login', '').strip()
     
     if not login:
         return jsonify({'error': 'Не авторизован'}), 401
     
     now = time.time()
     
-    with threading.RLock():
+    with STATE.locked(login):
         if login not in ONLINE_USERS:
             return jsonify({'error': 'Пользователь не в сети'}), 401
         
         last_active = USER_LAST_ACTIVE.get(login, 0)
-        if now - last_active > INACTIVITY_TIMEOUT:
-            ONLINE_USERS.discard(login)
-            USER_LAST_ACTIVE.pop(login, None)
-            USER_PREFERENCES.pop(login, None)
-            leave_private_chat(login)
-            
-            return jsonify({'error': 'Сессия истекла из-за неактивности'}), 401
-        
-        USER_LAST_ACTIVE[login] = now
+        expired = now - last_active > INACTIVITY_TIMEOUT
+        if not expired:
+            USER_LAST_ACTIVE[login] = now
+    
+    if expired:
+        remove_user_from_all_queues(login, inactive_before=now - INACTIVITY_TIMEOUT)
+        return jsonify({'error': 'Сессия истекла из-за неактивности'}), 401
     
     return None
 
@@ -1049,18 +3189,15 @@ def health_check():
     """Проверка здоровья сервера"""
     db_status = 'error'
     try:
-        conn = get_db_connection()
-        if conn:
+        with DB_POOL.connection() as conn:
             conn.execute('SELECT 1')
-            conn.close()
             db_status = 'ok'
     except:
         pass
     
-    with threading.RLock():
-        online_count = len(ONLINE_USERS)
-        private_chats_count = len(PRIVATE_CHATS)
-        waiting_count = len(WAITING_USERS)
+    online_count = len(ONLINE_USERS)
+    private_chats_count = len(PRIVATE_CHATS)
+    waiting_count = len(WAITING_USERS)
     
     return jsonify({
         'status': 'ok',
@@ -1071,6 +3208,18 @@ def health_check():
         'online_users': online_count,
         'private_chats': private_chats_count,
         'waiting_users': waiting_count,
+        'matchmaking': MATCHMAKING_SCHEDULER.stats(),
+        'db_pool': DB_POOL.stats(),
+        'message_writer': MESSAGE_WRITER.stats(),
+        'heartbeats': HEARTBEAT_FLUSHER.stats(),
+        'media': BLOB_STORE.stats(),
+        'uploads': UPLOADS.stats(),
+        'image_pool': IMAGE_PROCESSOR.stats(),
+        'transform_cache': TRANSFORM_CACHE.stats(),
+        'sse_encoding': SSE_ENCODING_STATS.stats(),
+        'sse_history': SSE_HISTORY.stats(),
+        'sse_connections': SSE_HUB.stats(),
+        'long_poll': CHAT_WAITERS.stats(),
         'inactivity_timeout': INACTIVITY_TIMEOUT
     })
 
@@ -1086,10 +3235,9 @@ def check_nick():
         if not valid:
             return jsonify(available=False, reason=reason)
         
-        with threading.RLock():
-            nick_lower = nick.lower()
-            if any(user.lower() == nick_lower for user in ONLINE_USERS):
-                return jsonify(available=False, reason="Этот ник уже используется")
+        nick_lower = nick.lower()
+        if any(user.lower() == nick_lower for user in list(ONLINE_USERS)):
+            return jsonify(available=False, reason="Этот ник уже используется")
         
         return jsonify(available=True, nick=nick)
         
@@ -1131,21 +3279,24 @@ def join():
         
         nick = format_username(nick)
         
-        with threading.RLock():
-            nick_lower = nick.lower()
-            
-            # Проверяем, можно ли занять ник
-            now = time.time()
-            for user in list(ONLINE_USERS):
-                if user.lower() == nick_lower:
-                    last_active = USER_LAST_ACTIVE.get(user, 0)
-                    if now - last_active > 30:
-                        # Освобождаем неактивный ник
-                        remove_user_from_all_queues(user)
-                        leave_private_chat(user)
-                        logger.info(f"Освобождение неактивного ника: {user}")
-                    else:
-                        return jsonify(success=False, reason="Этот ник уже используется")
+        nick_lower = nick.lower()
+        
+        # Проверяем, можно ли занять ник
+        now = time.time()
+        for user in list(ONLINE_USERS):
+            if user.lower() == nick_lower:
+                last_active = USER_LAST_ACTIVE.get(user, 0)
+                if now - last_active > 30:
+                    # Освобождаем неактивный ник
+                    remove_user_from_all_queues(user, inactive_before=now - 30)
+                    logger.info(f"Освобождение неактивного ника: {user}")
+                else:
+                    return jsonify(success=False, reason="Этот ник уже используется")
+        
+        # Занимаем ник атомарно: параллельный вход с тем же ником получит отказ
+        with STATE.locked(nick_lower, nick):
+            if any(user.lower() == nick_lower for user in list(ONLINE_USERS)):
+                return jsonify(success=False, reason="Этот ник уже используется")
             
             ONLINE_USERS.add(nick)
             USER_LAST_ACTIVE[nick] = now
@@ -1155,62 +3306,59 @@ def join():
                 'search_gender': search_gender,
                 'search_age': search_age
             }
+        
+        # Автоматически ищем собеседника
+        partner = find_available_partner(nick)
+        chat_id = create_private_chat(nick, partner) if partner else None
+        if chat_id:
+            # Системное сообщение о создании чата
+            system_msg = {
+                'id': str(uuid.uuid4()),
+                'chat_id': chat_id,
+                'login': 'Система',
+                'text': f'Вы подключены к {partner}',
+                'ts': now,
+                'isvoice': False,
+                'mediatype': 'system',
+                'sound': NOTIFICATION_SOUND_DATA,
+                'delivered': True,
+                'readcount': 0
+            }
             
-            # Автоматически ищем собеседника
-            partner = find_available_partner(nick)
-            if partner:
-                chat_id = create_private_chat(nick, partner)
-                
-                # Системное сообщение о создании чата
-                system_msg = {
-                    'id': str(uuid.uuid4()),
-                    'chat_id': chat_id,
-                    'login': 'Система',
-                    'text': f'Вы подключены к {partner}',
-                    'ts': now,
-                    'isvoice': False,
-                    'mediatype': 'system',
-                    'sound': NOTIFICATION_SOUND_DATA,
-                    'delivered': True,
-                    'readcount': 0
-                }
-                
-                if chat_id in PRIVATE_CHATS:
-                    PRIVATE_CHATS[chat_id]['messages'].append(system_msg)
-                
-                # Отправляем уведомления обоим пользователям
-                broadcast_to_chat(chat_id, system_msg)
-                
-                logger.info(f"Создан автоматический чат между {nick} и {partner}")
-                
-                result = {
-                    'success': True, 
-                    'nick': nick,
-                    'in_chat': True,
-                    'partner': partner,
-                    'chat_id': chat_id,
-                    'message': f'Вы подключены к {partner}'
-                }
-            else:
-                # Добавляем в очередь ожидания
-                if nick not in WAITING_USERS:
-                    WAITING_USERS.append(nick)
-                
-                result = {
-                    'success': True, 
-                    'nick': nick,
-                    'in_chat': False,
-                    'partner': None,
-                    'chat_id': None,
-                    'message': 'Ищем собеседника...',
-                    'waiting_position': len(WAITING_USERS)
-                }
+            chat = PRIVATE_CHATS.get(chat_id)
+            if chat:
+                append_chat_message(chat, system_msg)
+            
+            # Отправляем уведомления обоим пользователям
+            broadcast_to_chat(chat_id, system_msg)
+            
+            logger.info(f"Создан автоматический чат между {nick} и {partner}")
+            
+            result = {
+                'success': True, 
+                'nick': nick,
+                'in_chat': True,
+                'partner': partner,
+                'chat_id': chat_id,
+                'message': f'Вы подключены к {partner}'
+            }
+        else:
+            # Добавляем в очередь ожидания
+            add_to_waiting(nick)
+            
+            result = {
+                'success': True, 
+                'nick': nick,
+                'in_chat': False,
+                'partner': None,
+                'chat_id': None,
+                'message': 'Ищем собеседника...',
+                'waiting_position': WAITING_USERS.position(nick)
+            }
         
         # Сохраняем сессию и данные пользователя
-        conn = None
         try:
-            conn = get_db_connection()
-            if conn:
+            with DB_POOL.connection() as conn:
                 c = conn.cursor()
                 ip_address = request.remote_addr
                 user_agent = request.headers.get('User-Agent', '')
@@ -1233,9 +3381,6 @@ def join():
                 conn.commit()
         except Exception as e:
             logger.error(f"Ошибка сохранения сессии: {e}")
-        finally:
-            if conn:
-                conn.close()
         
         logger.info(f"Пользователь вошел: {nick} (пол: {gender}, возраст: {age_group})")
         return jsonify(result)
@@ -1264,16 +3409,17 @@ def update_preferences():
         if search_age not in ['any', 'under18', '18-25', '26-35', '35plus']:
             search_age = 'any'
         
-        with threading.RLock():
+        with STATE.locked(login):
             if login in USER_PREFERENCES:
                 USER_PREFERENCES[login]['search_gender'] = search_gender
                 USER_PREFERENCES[login]['search_age'] = search_age
+                MATCHMAKING_INDEX.update(login, USER_PREFERENCES[login])
+                if login in MATCHMAKING_INDEX:
+                    MATCHMAKING_SCHEDULER.notify()
         
         # Обновляем в БД
-        conn = None
         try:
-            conn = get_db_connection()
-            if conn:
+            with DB_POOL.connection() as conn:
                 c = conn.cursor()
                 c.execute('''
                     UPDATE users SET search_gender = ?, search_age = ?
@@ -1282,9 +3428,6 @@ def update_preferences():
                 conn.commit()
         except Exception as e:
             logger.error(f"Ошибка обновления предпочтений: {e}")
-        finally:
-            if conn:
-                conn.close()
         
         return jsonify({'success': True, 'message': 'Предпочтения обновлены'})
         
@@ -1316,10 +3459,9 @@ def find_partner():
         
         # Ищем доступного собеседника
         partner = find_available_partner(login)
+        chat_id = create_private_chat(login, partner) if partner else None
         
-        if partner:
-            chat_id = create_private_chat(login, partner)
-            
+        if chat_id:
             # Системное сообщение
             system_msg = {
                 'id': str(uuid.uuid4()),
@@ -1332,17 +3474,15 @@ def find_partner():
                 'sound': NOTIFICATION_SOUND_DATA
             }
             
-            with threading.RLock():
-                if chat_id in PRIVATE_CHATS:
-                    PRIVATE_CHATS[chat_id]['messages'].append(system_msg)
+            chat = PRIVATE_CHATS.get(chat_id)
+            if chat:
+                append_chat_message(chat, system_msg)
             
             broadcast_to_chat(chat_id, system_msg)
             
             # Обновляем информацию о пользователе в БД
-            conn = None
             try:
-                conn = get_db_connection()
-                if conn:
+                with DB_POOL.connection() as conn:
                     c = conn.cursor()
                     c.execute('''
                         UPDATE users 
@@ -1352,9 +3492,6 @@ def find_partner():
                     conn.commit()
             except Exception as e:
                 logger.error(f"Ошибка обновления пользователя: {e}")
-            finally:
-                if conn:
-                    conn.close()
             
             return jsonify({
                 'success': True,
@@ -1364,29 +3501,23 @@ def find_partner():
             })
         else:
             # Добавляем в очередь ожидания
-            with threading.RLock():
-                if login not in WAITING_USERS:
-                    WAITING_USERS.append(login)
+            with STATE.locked(login):
+                add_to_waiting(login)
             
             # Обновляем время ожидания в БД
-            conn = None
             try:
-                conn = get_db_connection()
-                if conn:
+                with DB_POOL.connection() as conn:
                     c = conn.cursor()
                     c.execute('UPDATE users SET waiting_since = ? WHERE login = ?', 
                              (time.time(), login))
                     conn.commit()
             except Exception as e:
                 logger.error(f"Ошибка обновления ожидания: {e}")
-            finally:
-                if conn:
-                    conn.close()
             
             return jsonify({
                 'success': False,
                 'reason': 'Нет доступных собеседников. Вы в очереди ожидания.',
-                'waiting_position': len(WAITING_USERS)
+                'waiting_position': WAITING_USERS.position(login)
             })
         
     except Exception as e:
@@ -1406,24 +3537,18 @@ def leave_chat():
         login = data.get('login', '').strip()
         
         # Удаляем из очереди ожидания, если пользователь там
-        with threading.RLock():
-            if login in WAITING_USERS:
-                WAITING_USERS.remove(login)
+        with STATE.locked(login):
+            remove_from_waiting(login)
         
         if leave_private_chat(login):
             # Обновляем информацию о пользователе в БД
-            conn = None
             try:
-                conn = get_db_connection()
-                if conn:
+                with DB_POOL.connection() as conn:
                     c = conn.cursor()
                     c.execute('UPDATE users SET current_chat = NULL, waiting_since = NULL WHERE login = ?', (login,))
                     conn.commit()
             except Exception as e:
                 logger.error(f"Ошибка обновления пользователя: {e}")
-            finally:
-                if conn:
-                    conn.close()
             
             return jsonify({
                 'success': True,
@@ -1452,23 +3577,17 @@ def stop_search():
         login = data.get('login', '').strip()
         
         # Удаляем из очереди ожидания
-        with threading.RLock():
-            if login in WAITING_USERS:
-                WAITING_USERS.remove(login)
+        with STATE.locked(login):
+            remove_from_waiting(login)
         
         # Обновляем в БД
-        conn = None
         try:
-            conn = get_db_connection()
-            if conn:
+            with DB_POOL.connection() as conn:
                 c = conn.cursor()
                 c.execute('UPDATE users SET waiting_since = NULL WHERE login = ?', (login,))
                 conn.commit()
         except Exception as e:
             logger.error(f"Ошибка обновления поиска: {e}")
-        finally:
-            if conn:
-                conn.close()
         
         return jsonify({
             'success': True,
@@ -1518,51 +3637,199 @@ def send_private_message():
             'readcount': 0
         }
         
-        saved_msg = save_and_broadcast_message(msg)
-        return jsonify(saved_msg)
+        saved_msg = save_and_broadcast_message(msg)
+        return jsonify(saved_msg)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Ошибка отправки приватного сообщения: {e}")
+        return jsonify({'error': 'Ошибка сервера'}), 500
+
+@app.route('/poll_private', methods=['GET'])
+@rate_limit
+def poll_private_messages():
+    """Опрос приватных сообщений"""
+    try:
+        login = request.args.get('login', '')
+        chat_id = request.args.get('chat_id', '')
+        since_seq = request.args.get('since_seq', type=int)
+        try:
+            since = float(request.args.get('since', 0))
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            return jsonify({'error': 'Некорректные параметры'}), 400
+        # nan проходит через min/max и превращается в ожидание без срока
+        if not math.isfinite(since) or not math.isfinite(wait):
+            return jsonify({'error': 'Некорректные параметры'}), 400
+        wait = min(max(wait, 0), LONG_POLL_MAX_WAIT)
+        
+        if not chat_id:
+            return jsonify({'error': 'Не указан ID чата'}), 400
+        
+        # Проверяем доступ к чату
+        chat = PRIVATE_CHATS.get(chat_id)
+        if not chat or login not in chat['users']:
+            return jsonify({'error': 'Доступ к чату запрещен'}), 403
+        
+        ring = chat['messages']
+        users_count = len(chat['users'])
+        
+        def has_news():
+            if since_seq is not None:
+                return ring.last_seq > since_seq
+            last = ring.last()
+            return last is not None and last.get('ts', 0) > since
+        
+        if wait:
+            def ready():
+                # Новое сообщение, выход из чата или удаление чата
+                if len(chat['users']) != users_count or PRIVATE_CHATS.get(chat_id) is not chat:
+                    return True
+                with STATE.chat_locked(chat):
+                    return has_news()
+            
+            CHAT_WAITERS.wait(chat_id, ready, wait)
+            if PRIVATE_CHATS.get(chat_id) is not chat or login not in chat['users']:
+                return jsonify({'error': 'Доступ к чату запрещен'}), 403
+        
+        # Содержимое ответа определяется номером последнего сообщения и составом чата
+        partner = get_chat_partner(login)
+        with STATE.chat_locked(chat):
+            last_seq = ring.last_seq
+            first_seq = ring.first_seq
+            etag = f"{last_seq}.{len(chat['users'])}"
+            if request.if_none_match.contains(etag):
+                new_msgs = None
+            elif since_seq is not None:
+                new_msgs = ring.since(since_seq)
+            else:
+                # Старые клиенты присылают время последнего сообщения
+                new_msgs = [m for m in ring if m.get('ts', 0) > since]
+        
+        if new_msgs is None:
+            response = make_response('', 304)
+        else:
+            response = jsonify({
+                'messages': new_msgs,
+                'chat_id': chat_id,
+                'last_seq': last_seq,
+                # Часть запрошенного уже вытеснена из буфера чата - ее отдает /history
+                'truncated': since_seq is not None and since_seq + 1 < first_seq,
+                'partner': partner,
+                'timestamp': time.time()
+            })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Ошибка отправки приватного сообщения: {e}")
+        logger.error(f"Ошибка опроса приватных сообщений: {e}")
         return jsonify({'error': 'Ошибка сервера'}), 500
 
-@app.route('/poll_private', methods=['GET'])
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 100
+INLINE_MEDIA_TYPES = ('voice', 'video', 'image', 'music', 'file')
+
+def parse_history_cursor(value):
+    """Курсор "<ts>:<id>" (или просто ts) - граница страницы истории; None - с конца"""
+    if not value:
+        return None
+    ts, _, msg_id = value.partition(':')
+    return float(ts), msg_id or None
+
+def history_message(row):
+    """Сообщение истории из строки БД: медиа только ссылкой"""
+    msg = {
+        'id': row['id'],
+        'chat_id': row['chat_id'],
+        'login': row['login'],
+        'text': row['text'] or '',
+        'ts': row['ts'],
+        'isvoice': bool(row['isvoice']),
+        'mediatype': row['mediatype'],
+        'filename': row['filename'] or '',
+        'filesize': row['filesize'] or 0
+    }
+    if row['media_hash']:
+        set_media_ref(msg, row['media_hash'], row['media_mime'] or 'application/octet-stream', msg['filesize'])
+    elif row['mediatype'] in INLINE_MEDIA_TYPES:
+        # Старые сообщения с данными в строке отдает GET /media/<id сообщения>
+        msg['media_url'] = f"/media/{row['id']}"
+    return msg
+
+def is_chat_member(chat_id, login):
+    """Участник чата: в памяти или, для выгруженных чатов, по БД"""
+    chat = PRIVATE_CHATS.get(chat_id)
+    if chat and login in chat['users']:
+        return True
+    with DB_POOL.connection() as conn:
+        row = conn.execute(
+            'SELECT 1 FROM private_chats WHERE chat_id = ? AND (user1 = ? OR user2 = ?)',
+            (chat_id, login, login)
+        ).fetchone()
+    return row is not None
+
+@app.route('/history', methods=['GET'])
 @rate_limit
-def poll_private_messages():
-    """Опрос приватных сообщений"""
+def get_chat_history():
+    """История чата из БД постранично: курсор по (ts, id) вместо OFFSET"""
+    login = request.args.get('login', '').strip()
+    error = require_online_user(login=login)
+    if error:
+        return error
+    
     try:
-        login = request.args.get('login', '')
         chat_id = request.args.get('chat_id', '')
-        since = float(request.args.get('since', 0))
-        
         if not chat_id:
             return jsonify({'error': 'Не указан ID чата'}), 400
         
-        # Проверяем доступ к чату
-        chat = PRIVATE_CHATS.get(chat_id)
-        if not chat or login not in chat['users']:
+        try:
+            cursor = parse_history_cursor(request.args.get('before', ''))
+            limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'Некорректные параметры'}), 400
+        limit = min(max(limit, 1), HISTORY_MAX_PAGE_SIZE)
+        
+        if not is_chat_member(chat_id, login):
             return jsonify({'error': 'Доступ к чату запрещен'}), 403
         
-        # Получаем сообщения из чата
-        with threading.RLock():
-            chat_messages = chat.get('messages', [])
-            new_msgs = []
-            
-            for m in chat_messages[-100:]:
-                if m.get('ts', 0) > since:
-                    msg_copy = m.copy()
-                    new_msgs.append(msg_copy)
+        # mediadata не читаем: тяжелые старые строки не должны тормозить выборку
+        query = '''
+            SELECT id, chat_id, login, text, ts, isvoice, mediatype, filename, filesize, media_hash, media_mime
+            FROM messages
+            WHERE chat_id = ?
+        '''
+        params = [chat_id]
+        if cursor:
+            ts, msg_id = cursor
+            if msg_id:
+                # ts <= ? задает диапазон по индексу idx_messages_chat_id, id разрешает равные ts
+                query += ' AND ts <= ? AND (ts < ? OR id < ?)'
+                params += [ts, ts, msg_id]
+            else:
+                query += ' AND ts < ?'
+                params.append(ts)
+        query += ' ORDER BY ts DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+        
+        with DB_POOL.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        messages = [history_message(row) for row in reversed(rows)]
         
         return jsonify({
-            'messages': new_msgs,
+            'messages': messages,
             'chat_id': chat_id,
-            'partner': get_chat_partner(login),
-            'timestamp': time.time()
+            'has_more': has_more,
+            # Курсор следующей (более старой) страницы
+            'next_before': f"{rows[-1]['ts']!r}:{rows[-1]['id']}" if has_more else None
         })
         
     except Exception as e:
-        logger.error(f"Ошибка опроса приватных сообщений: {e}")
+        logger.error(f"Ошибка загрузки истории чата: {e}")
         return jsonify({'error': 'Ошибка сервера'}), 500
 
 @app.route('/chat_status', methods=['GET'])
@@ -1583,12 +3850,11 @@ def get_chat_status():
                     'partner': partner,
                     'created_at': chat.get('created_at'),
                     'last_activity': chat.get('last_activity'),
-                    'message_count': len(chat.get('messages', []))
+                    'message_count': chat['messages'].last_seq
                 })
         
         # Проверяем, в очереди ли пользователь
-        with threading.RLock():
-            waiting_position = WAITING_USERS.index(login) + 1 if login in WAITING_USERS else 0
+        waiting_position = WAITING_USERS.position(login)
         
         return jsonify({
             'in_chat': False,
@@ -1610,26 +3876,18 @@ def logout():
         nick = data.get('nick', '').strip()
         
         if nick:
-            # Выходим из чата
-            leave_private_chat(nick)
-            
-            # Полностью удаляем пользователя из системы
+            # Полностью удаляем пользователя из системы (включая выход из чата)
             remove_user_from_all_queues(nick)
             
             # Обновляем БД
-            conn = None
             try:
-                conn = get_db_connection()
-                if conn:
+                with DB_POOL.connection() as conn:
                     c = conn.cursor()
                     c.execute("DELETE FROM user_sessions WHERE login = ?", (nick,))
                     c.execute("UPDATE users SET current_chat = NULL, waiting_since = NULL WHERE login = ?", (nick,))
                     conn.commit()
             except Exception as e:
                 logger.error(f"Ошибка очистки данных пользователя: {e}")
-            finally:
-                if conn:
-                    conn.close()
             
             logger.info(f"Полный выход пользователя: {nick}")
         
@@ -1661,36 +3919,117 @@ def force_logout():
 def force_user_logout(nick):
     """Фоновая функция для принудительного выхода"""
     try:
-        # Выходим из чата
-        leave_private_chat(nick)
-        
-        # Полностью удаляем пользователя из системы
+        # Полностью удаляем пользователя из системы (включая выход из чата)
         remove_user_from_all_queues(nick)
         
         # Обновляем БД
-        conn = None
         try:
-            conn = get_db_connection()
-            if conn:
+            with DB_POOL.connection() as conn:
                 c = conn.cursor()
                 c.execute("DELETE FROM user_sessions WHERE login = ?", (nick,))
                 c.execute("UPDATE users SET current_chat = NULL, waiting_since = NULL WHERE login = ?", (nick,))
                 conn.commit()
         except Exception as e:
             logger.error(f"Ошибка очистки данных пользователя: {e}")
-        finally:
-            if conn:
-                conn.close()
         
         logger.info(f"Принудительный выход завершен: {nick}")
         
     except Exception as e:
         logger.error(f"Ошибка в force_user_logout: {e}")
 
+def publish_media(login, chat_id, mediatype, filename, mime_type, digest, size):
+    """Сообщение о файле, уже лежащем в хранилище: сжатие картинок, сохранение и рассылка"""
+    if mediatype == 'image' and mime_type.startswith('image/'):
+        try:
+            compressed = compress_image_data(digest, mime_type)
+            if compressed:
+                # Оригинал без ссылок удалит сборщик мусора
+                mime_type, data = compressed
+                digest, size = BLOB_STORE.put_bytes(data), len(data)
+        except Exception as e:
+            logger.error(f"Ошибка сжатия изображения: {e}")
+    
+    msg = {
+        'id': str(uuid.uuid4()),
+        'chat_id': chat_id,
+        'login': login,
+        'text': '',
+        'ts': time.time(),
+        'isvoice': mediatype == 'voice',
+        'mediatype': mediatype,
+        'filename': filename,
+        'delivered': False,
+        'readcount': 0
+    }
+    set_media_ref(msg, digest, mime_type, size)
+    
+    return save_and_broadcast_message(msg)
+
+def receive_media_upload(kind):
+    """Бинарная загрузка: тело запроса - сами байты, метаданные в заголовках X-*"""
+    login = unquote(request.headers.get('X-Login', '')).strip()
+    error = require_online_user(login=login)
+    if error:
+        return error
+    
+    try:
+        chat_id = unquote(request.headers.get('X-Chat-Id', '')).strip()
+        if not chat_id:
+            return jsonify({'error': 'Не указан ID чата'}), 400
+        
+        if kind == 'media':
+            mediatype = request.headers.get('X-Media-Type', 'file')
+            if mediatype not in ('image', 'video', 'music', 'file'):
+                mediatype = 'file'
+            filename = unquote(request.headers.get('X-Filename', '')).strip() or 'file'
+        else:
+            mediatype = kind
+            filename = f'{kind}.webm'
+        
+        mime_type = request.mimetype
+        if not mime_type or mime_type == 'application/octet-stream':
+            mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if kind != 'media' and not mime_type.startswith(('audio/', 'video/')):
+            mime_type = 'audio/webm' if kind == 'voice' else 'video/webm'
+        if kind == 'media' and mime_type != 'application/octet-stream' and not mime_type.startswith(ALLOWED_MEDIA_TYPES):
+            return jsonify({'error': 'Недопустимый тип файла'}), 400
+        
+        # Лимит проверяем по заголовку - до чтения тела
+        max_size_mb = MEDIA_LIMITS_MB[mediatype]
+        if request.content_length is None:
+            return jsonify({'error': 'Требуется заголовок Content-Length'}), 411
+        if request.content_length == 0:
+            return jsonify({'error': 'Отсутствуют данные файла'}), 400
+        if request.content_length > max_size_mb * 1024 * 1024:
+            return jsonify({'error': f'Превышен размер файла (макс. {max_size_mb}MB)'}), 413
+        
+        # Проверяем, что пользователь в этом чате
+        chat = PRIVATE_CHATS.get(chat_id)
+        if not chat or login not in chat['users']:
+            return jsonify({'error': 'Вы не состоите в этом чате'}), 403
+        
+        sniffer = MediaSniffer(mime_type, mediatype)
+        try:
+            digest, size = BLOB_STORE.put_stream(request.stream, max_size_mb * 1024 * 1024, inspect=sniffer)
+        except FileTooLargeError:
+            return jsonify({'error': f'Превышен размер файла (макс. {max_size_mb}MB)'}), 413
+        
+        saved_msg = publish_media(login, chat_id, mediatype, filename, sniffer.mime, digest, size)
+        return jsonify(saved_msg)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Ошибка загрузки медиа: {e}")
+        return jsonify({'error': 'Ошибка сервера'}), 500
+
 @app.route('/voice', methods=['POST'])
 @rate_limit
 def send_voice():
     """Отправка голосового сообщения в приватный чат"""
+    if not request.is_json:
+        return receive_media_upload('voice')
+    
     error = require_online_user()
     if error:
         return error
@@ -1707,34 +4046,17 @@ def send_voice():
         if not audio_b64:
             return jsonify({'error': 'Отсутствуют аудиоданные'}), 400
         
-        if not validate_base64_data(audio_b64, max_size_mb=10):
-            return jsonify({'error': 'Неверный формат аудио или превышен размер (макс. 10MB)'}), 400
-        
         # Проверяем, что пользователь в этом чате
         chat = PRIVATE_CHATS.get(chat_id)
         if not chat or login not in chat['users']:
             return jsonify({'error': 'Вы не состоите в этом чате'}), 403
         
-        if not audio_b64.startswith('data:'):
-            formatted = f"data:audio/webm;base64,{audio_b64}"
-        else:
-            formatted = audio_b64
-        
-        msg = {
-            'id': str(uuid.uuid4()),
-            'chat_id': chat_id,
-            'login': login,
-            'text': '',
-            'ts': time.time(),
-            'isvoice': True,
-            'mediatype': 'voice',
-            'mediadata': formatted,
-            'filename': 'voice.webm',
-            'delivered': False,
-            'readcount': 0
-        }
+        try:
+            digest, mime_type, size = store_base64_media(audio_b64, 'voice', 'audio/webm', MEDIA_LIMITS_MB['voice'])
+        except ValueError:
+            return jsonify({'error': 'Неверный формат аудио или превышен размер (макс. 10MB)'}), 400
         
-        saved_msg = save_and_broadcast_message(msg)
+        saved_msg = publish_media(login, chat_id, 'voice', 'voice.webm', mime_type, digest, size)
         return jsonify(saved_msg)
         
     except ValueError as e:
@@ -1747,6 +4069,9 @@ def send_voice():
 @rate_limit
 def send_video():
     """Отправка видео-записи в приватный чат"""
+    if not request.is_json:
+        return receive_media_upload('video')
+    
     error = require_online_user()
     if error:
         return error
@@ -1763,34 +4088,17 @@ def send_video():
         if not video_b64:
             return jsonify({'error': 'Отсутствуют видеоданные'}), 400
         
-        if not validate_base64_data(video_b64, max_size_mb=50):
-            return jsonify({'error': 'Неверный формат видео или превышен размер (макс. 50MB)'}), 400
-        
         # Проверяем, что пользователь в этом чате
         chat = PRIVATE_CHATS.get(chat_id)
         if not chat or login not in chat['users']:
             return jsonify({'error': 'Вы не состоите в этом чате'}), 403
         
-        if not video_b64.startswith('data:'):
-            formatted = f"data:video/webm;base64,{video_b64}"
-        else:
-            formatted = video_b64
-        
-        msg = {
-            'id': str(uuid.uuid4()),
-            'chat_id': chat_id,
-            'login': login,
-            'text': '',
-            'ts': time.time(),
-            'isvoice': False,
-            'mediatype': 'video',
-            'mediadata': formatted,
-            'filename': 'video.webm',
-            'delivered': False,
-            'readcount': 0
-        }
+        try:
+            digest, mime_type, size = store_base64_media(video_b64, 'video', 'video/webm', MEDIA_LIMITS_MB['video'])
+        except ValueError:
+            return jsonify({'error': 'Неверный формат видео или превышен размер (макс. 50MB)'}), 400
         
-        saved_msg = save_and_broadcast_message(msg)
+        saved_msg = publish_media(login, chat_id, 'video', 'video.webm', mime_type, digest, size)
         return jsonify(saved_msg)
         
     except ValueError as e:
@@ -1803,6 +4111,9 @@ def send_video():
 @rate_limit
 def send_media():
     """Отправка медиафайла в приватный чат"""
+    if not request.is_json:
+        return receive_media_upload('media')
+    
     error = require_online_user()
     if error:
         return error
@@ -1826,54 +4137,278 @@ def send_media():
         if not chat or login not in chat['users']:
             return jsonify({'error': 'Вы не состоите в этом чате'}), 403
         
-        max_size_mb = 64
-        if mediatype == 'image':
-            max_size_mb = 20
-        elif mediatype == 'video':
-            max_size_mb = 50
-        elif mediatype == 'music':
-            max_size_mb = 30
+        if mediatype not in MEDIA_LIMITS_MB or mediatype == 'voice':
+            mediatype = 'file'
+        max_size_mb = MEDIA_LIMITS_MB[mediatype]
+        default_mime = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
         
-        if not validate_base64_data(media_data, max_size_mb=max_size_mb):
+        try:
+            digest, mime_type, size = store_base64_media(media_data, mediatype, default_mime, max_size_mb)
+        except ValueError:
             return jsonify({'error': f'Неверный формат или превышен размер (макс. {max_size_mb}MB)'}), 400
         
-        formatted = media_data
+        saved_msg = publish_media(login, chat_id, mediatype, filename, mime_type, digest, size)
+        return jsonify(saved_msg)
         
-        if media_data.startswith('data:'):
-            header, b64_data = media_data.split(',', 1)
-            mime_match = re.match(r'data:(.+);base64', header)
-            
-            if mime_match:
-                mime_type = mime_match.group(1)
-                
-                if mediatype == 'image' and mime_type.startswith('image/'):
-                    formatted = compress_image(media_data)
-        else:
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Ошибка отправки медиа: {e}")
+        return jsonify({'error': 'Ошибка сервера'}), 500
+
+@app.route('/uploads', methods=['POST'])
+@rate_limit
+def create_upload():
+    """Создание дозагружаемой загрузки для большого файла"""
+    error = require_online_user()
+    if error:
+        return error
+    
+    try:
+        data = request.get_json() or {}
+        login = data.get('login', '').strip()
+        chat_id = data.get('chat_id')
+        mediatype = data.get('type', 'video')
+        filename = str(data.get('filename', '')).strip() or 'file'
+        
+        if not chat_id:
+            return jsonify({'error': 'Не указан ID чата'}), 400
+        
+        if mediatype not in MEDIA_LIMITS_MB:
+            return jsonify({'error': 'Неверный тип файла'}), 400
+        
+        try:
+            size = int(data.get('size', 0))
+        except (TypeError, ValueError):
+            size = 0
+        max_size_mb = MEDIA_LIMITS_MB[mediatype]
+        if size <= 0:
+            return jsonify({'error': 'Не указан размер файла'}), 400
+        if size > max_size_mb * 1024 * 1024:
+            return jsonify({'error': f'Превышен размер файла (макс. {max_size_mb}MB)'}), 413
+        
+        mime_type = str(data.get('mime', '')).split(';')[0].strip()
+        if not mime_type or mime_type == 'application/octet-stream':
             mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-            formatted = f"data:{mime_type};base64,{media_data}"
+        if mime_type != 'application/octet-stream' and not mime_type.startswith(ALLOWED_MEDIA_TYPES):
+            return jsonify({'error': 'Недопустимый тип файла'}), 400
         
-        msg = {
-            'id': str(uuid.uuid4()),
-            'chat_id': chat_id,
-            'login': login,
-            'text': '',
-            'ts': time.time(),
-            'isvoice': False,
-            'mediatype': mediatype,
-            'mediadata': formatted,
-            'filename': filename,
-            'delivered': False,
-            'readcount': 0
-        }
+        # Проверяем, что пользователь в этом чате
+        chat = PRIVATE_CHATS.get(chat_id)
+        if not chat or login not in chat['users']:
+            return jsonify({'error': 'Вы не состоите в этом чате'}), 403
         
-        saved_msg = save_and_broadcast_message(msg)
+        upload = UPLOADS.create(login, chat_id, mediatype, filename, mime_type, size)
+        return jsonify(UPLOADS.status(upload)), 201
+        
+    except Exception as e:
+        logger.error(f"Ошибка создания загрузки: {e}")
+        return jsonify({'error': 'Ошибка сервера'}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload_status(upload_id):
+    """Какие диапазоны байт сервер уже получил"""
+    login = request.args.get('login', '').strip()
+    error = require_online_user(login=login)
+    if error:
+        return error
+    
+    upload = UPLOADS.get(upload_id)
+    if not upload:
+        return jsonify({'error': 'Загрузка не найдена или истекла'}), 404
+    if upload['login'] != login:
+        return jsonify({'error': 'Чужая загрузка'}), 403
+    
+    return jsonify(UPLOADS.status(upload))
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """Прием куска: Content-Range: bytes start-end/total (или X-Upload-Offset)"""
+    login = unquote(request.headers.get('X-Login', '')).strip()
+    error = require_online_user(login=login)
+    if error:
+        return error
+    
+    try:
+        upload = UPLOADS.get(upload_id)
+        if not upload:
+            return jsonify({'error': 'Загрузка не найдена или истекла'}), 404
+        if upload['login'] != login:
+            return jsonify({'error': 'Чужая загрузка'}), 403
+        
+        length = request.content_length
+        if not length:
+            return jsonify({'error': 'Требуется заголовок Content-Length'}), 411
+        if length > UPLOAD_MAX_CHUNK:
+            return jsonify({'error': f'Кусок больше {UPLOAD_MAX_CHUNK // (1024 * 1024)}MB'}), 413
+        
+        content_range = request.headers.get('Content-Range', '')
+        if content_range:
+            match = re.match(r'^bytes (\d+)-(\d+)/(\d+)$', content_range.strip())
+            if not match:
+                return jsonify({'error': 'Неверный заголовок Content-Range'}), 400
+            start, end, total = (int(value) for value in match.groups())
+            if total != upload['size'] or end - start + 1 != length:
+                return jsonify({'error': 'Content-Range не совпадает с загрузкой'}), 400
+        else:
+            try:
+                start = int(request.headers.get('X-Upload-Offset', ''))
+            except ValueError:
+                return jsonify({'error': 'Требуется Content-Range или X-Upload-Offset'}), 400
+        
+        if start < 0 or start + length > upload['size']:
+            return jsonify({'error': 'Кусок выходит за размер файла'}), 416
+        
+        UPLOADS.write_chunk(upload, start, length, request.stream)
+        return jsonify(UPLOADS.status(upload))
+        
+    except UploadConflictError as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Ошибка приема куска загрузки {upload_id}: {e}")
+        return jsonify({'error': 'Ошибка сервера'}), 500
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@rate_limit
+def finalize_upload(upload_id):
+    """Завершение загрузки: файл уходит в хранилище и в чат сообщением"""
+    error = require_online_user()
+    if error:
+        return error
+    
+    try:
+        data = request.get_json() or {}
+        login = data.get('login', '').strip()
+        
+        upload = UPLOADS.get(upload_id)
+        if not upload:
+            return jsonify({'error': 'Загрузка не найдена или истекла'}), 404
+        if upload['login'] != login:
+            return jsonify({'error': 'Чужая загрузка'}), 403
+        
+        if not UPLOADS.is_complete(upload):
+            return jsonify({'error': 'Файл получен не полностью', **UPLOADS.status(upload)}), 409
+        
+        # Проверяем, что пользователь все еще в этом чате
+        chat = PRIVATE_CHATS.get(upload['chat_id'])
+        if not chat or login not in chat['users']:
+            return jsonify({'error': 'Вы не состоите в этом чате'}), 403
+        
+        # Тип файла - по сигнатуре собранного файла, а не по заявлению клиента
+        mime_type = resolve_media_mime(UPLOADS.read_head(upload), upload['mime'], upload['mediatype'])
+        
+        digest, size = UPLOADS.finalize(upload)
+        saved_msg = publish_media(login, upload['chat_id'], upload['mediatype'],
+                                  upload['filename'], mime_type, digest, size)
         return jsonify(saved_msg)
         
+    except UploadConflictError as e:
+        return jsonify({'error': str(e)}), 409
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Ошибка отправки медиа: {e}")
+        logger.error(f"Ошибка завершения загрузки {upload_id}: {e}")
+        return jsonify({'error': 'Ошибка сервера'}), 500
+
+@app.route('/media/<media_id>/<variant>', methods=['GET'])
+def get_media_variant(media_id, variant):
+    """Превью изображения: заглушка, миниатюра или полный размер; создается при первом запросе"""
+    media_id = media_id.strip().lower()
+    spec = IMAGE_VARIANTS.get(variant)
+    if not spec or not MEDIA_HASH_RE.match(media_id) or not BLOB_STORE.exists(media_id):
+        return jsonify({'error': 'Файл не найден'}), 404
+    
+    mime_type = media_mime_type(media_id)
+    if not mime_type.startswith('image/') or mime_type in IMAGE_PASSTHROUGH_TYPES:
+        return get_media(media_id)
+    
+    # WebP только тем, кто явно его принимает; остальным - прогрессивный JPEG
+    webp = 'image/webp' in request.headers.get('Accept', '')
+    image_format = 'webp' if webp else 'jpeg'
+    
+    key = transform_key(media_id, 'variant', variant, image_format)
+    found, result = TRANSFORM_CACHE.get(key)
+    if not found:
+        result = IMAGE_PROCESSOR.run(
+            render_image_variant, BLOB_STORE.path(media_id),
+            spec['max_side'], spec['quality'], spec['blur'], webp
+        )
+        if not result:
+            # Пул занят или файл не читается - отдаем оригинал, не кэшируя перенаправление
+            response = redirect(f"/media/{media_id}")
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        TRANSFORM_CACHE.put(key, result)
+    
+    variant_mime, data = result
+    response = send_file(
+        io.BytesIO(data),
+        mimetype=variant_mime,
+        conditional=True,
+        etag=f"{media_id}-{variant}-{image_format}",
+        max_age=MEDIA_CACHE_MAX_AGE
+    )
+    response.headers['Cache-Control'] = f'public, max-age={MEDIA_CACHE_MAX_AGE}, immutable'
+    response.headers['Vary'] = 'Accept'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+@app.route('/media/<media_id>', methods=['GET'])
+def get_media(media_id):
+    """Отдача медиафайла с диска: Range/206, ETag и долгий кэш для адресов по хэшу"""
+    media_id = media_id.strip().lower()
+    
+    if MEDIA_HASH_RE.match(media_id):
+        if not BLOB_STORE.exists(media_id):
+            return jsonify({'error': 'Файл не найден'}), 404
+        
+        response = send_file(
+            BLOB_STORE.path(media_id),
+            mimetype=media_mime_type(media_id),
+            conditional=True,
+            etag=media_id,
+            max_age=MEDIA_CACHE_MAX_AGE
+        )
+        # Содержимое по хэшу никогда не меняется
+        response.headers['Cache-Control'] = f'public, max-age={MEDIA_CACHE_MAX_AGE}, immutable'
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        return response
+    
+    # Старые сообщения: медиа хранится в строке БД
+    try:
+        with DB_POOL.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT mediadata, media_hash FROM messages WHERE id = ?", (media_id,))
+            row = c.fetchone()
+    except Exception as e:
+        logger.error(f"Ошибка получения медиа {media_id}: {e}")
         return jsonify({'error': 'Ошибка сервера'}), 500
+    
+    if not row:
+        return jsonify({'error': 'Файл не найден'}), 404
+    
+    if row['media_hash']:
+        return get_media(row['media_hash'])
+    
+    if not row['mediadata']:
+        return jsonify({'error': 'Файл не найден'}), 404
+    
+    try:
+        mime_type, raw = parse_data_uri(row['mediadata'])
+    except Exception:
+        return jsonify({'error': 'Поврежденные данные файла'}), 500
+    
+    response = send_file(
+        io.BytesIO(raw),
+        mimetype=mime_type,
+        conditional=True,
+        etag=media_id,
+        max_age=MEDIA_CACHE_MAX_AGE
+    )
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
 
 @app.route('/events')
 def sse_events():
@@ -1882,37 +4417,64 @@ def sse_events():
     if not login:
         return jsonify({'error': 'Требуется логин'}), 400
     
+    schema = sse_schema(request.args.get('v'))
+    # Браузер сам присылает Last-Event-ID при автопереподключении, клиент - параметром при ручном
+    last_event_id = parse_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    
+    # Регистрируем до начала потока, чтобы отказ ушел обычным ответом с Retry-After
+    subscriber = SSESubscriber(login, schema, ip=request.remote_addr)
+    missed = []
+    
+    with SSE_HUB.lock:
+        rejected = SSE_HUB.admit(subscriber)
+        
+        # Регистрация и снимок истории под одной блокировкой - без пропусков и повторов
+        if not rejected and last_event_id is not None:
+            missed = SSE_HISTORY.since(login, last_event_id)
+        
+        # Точка отсчета для подсказки resync, если переполнение случится до первой отправки:
+        # присланный клиентом id, а для нового клиента - последнее событие на момент подключения
+        subscriber.last_sent_id = SSE_HISTORY.last_id if last_event_id is None else last_event_id
+    
+    if rejected:
+        status, error = rejected
+        response = jsonify({'error': error})
+        response.status_code = status
+        response.headers['Retry-After'] = str(SSE_RETRY_AFTER)
+        return response
+    
     def event_stream():
         """Генератор событий SSE"""
-        user_queue = queue.Queue()
-        
-        with SSE_LOCK:
-            # Проверяем лимит соединений
-            if len(SSE_CONNECTIONS) >= MAX_SSE_CONNECTIONS:
-                # Удаляем самое старое соединение
-                if SSE_CONNECTIONS:
-                    oldest = list(SSE_CONNECTIONS.keys())[0]
-                    SSE_CONNECTIONS.pop(oldest, None)
-            
-            SSE_CONNECTIONS[login] = user_queue
-        
         try:
-            yield f"data: {json.dumps({'type': 'connected', 'timestamp': time.time()})}\n\n"
+            yield sse_frame({'type': 'connected', 'timestamp': time.time(), 'v': schema})
+            
+            if missed is None:
+                # Буфер уже перезаписан - клиент должен перечитать состояние целиком
+                yield sse_frame({'type': 'resync', 'reason': 'history_overflow', 'timestamp': time.time()}, SSE_HISTORY.last_id)
+            else:
+                for event in missed:
+                    subscriber.last_sent_id = event.id
+                    yield event.frame(schema)
             
             while True:
-                try:
-                    notification = user_queue.get(timeout=30)
-                    yield f"data: {json.dumps(notification)}\n\n"
-                except queue.Empty:
-                    yield ":keepalive\n\n"
+                event = subscriber.get()
+                if event is SSE_KEEPALIVE:
+                    yield event
+                elif event is not None:
+                    yield event.frame(schema)
+                elif subscriber.overflowed:
+                    # Подсказка клиенту: переподключиться с последним полученным id
+                    yield sse_frame({'type': 'resync', 'reason': 'slow_consumer', 'last_event_id': subscriber.last_sent_id})
+                    break
+                else:
+                    break
         except GeneratorExit:
             logger.info(f"SSE соединение закрыто для {login}")
         finally:
-            with SSE_LOCK:
-                if login in SSE_CONNECTIONS:
-                    del SSE_CONNECTIONS[login]
+            # Снимаем только свое соединение: новая вкладка того же логина остается
+            SSE_HUB.remove(subscriber)
     
-    return Response(
+    response = Response(
         event_stream(),
         mimetype='text/event-stream',
         headers={
@@ -1921,6 +4483,9 @@ def sse_events():
             'Connection': 'keep-alive'
         }
     )
+    # Генератор может так и не запуститься, если клиент ушел сразу
+    response.call_on_close(lambda: SSE_HUB.remove(subscriber))
+    return response
 
 @app.route('/online')
 @rate_limit
@@ -1928,14 +4493,13 @@ def get_online_users():
     """Список онлайн пользователей"""
     current_time = time.time()
     
-    with threading.RLock():
-        active_users = []
-        for user in ONLINE_USERS:
-            last_active = USER_LAST_ACTIVE.get(user, 0)
-            if current_time - last_active <= INACTIVITY_TIMEOUT:
-                active_users.append(user)
-        
-        users = sorted(active_users)
+    active_users = []
+    for user in list(ONLINE_USERS):
+        last_active = USER_LAST_ACTIVE.get(user, 0)
+        if current_time - last_active <= INACTIVITY_TIMEOUT:
+            active_users.append(user)
+    
+    users = sorted(active_users)
     
     return jsonify(users=users, count=len(users), timestamp=current_time)
 
@@ -1952,7 +4516,7 @@ def heartbeat_ping():
         
         now = time.time()
         
-        with threading.RLock():
+        with STATE.locked(login):
             if login not in ONLINE_USERS:
                 # Проверяем, не был ли он отключен недавно
                 last_active = USER_LAST_ACTIVE.get(login, 0)
@@ -1967,54 +4531,18 @@ def heartbeat_ping():
             
             # Обновляем время активности
             USER_LAST_ACTIVE[login] = now
-            
-            # Обновляем сессию в БД
-            conn = None
-            try:
-                conn = get_db_connection()
-                if conn:
-                    c = conn.cursor()
-                    ip_address = request.remote_addr
-                    user_agent = request.headers.get('User-Agent', '')
-                    
-                    # Обновляем сессию
-                    c.execute('''
-                        UPDATE user_sessions 
-                        SET last_activity = ?, ip_address = ?, user_agent = ?
-                        WHERE login = ?
-                    ''', (now, ip_address, user_agent, login))
-                    
-                    # Если сессии нет - создаем (на случай восстановления)
-                    if c.rowcount == 0:
-                        session_id = str(uuid.uuid4())
-                        c.execute('''
-                            INSERT INTO user_sessions 
-                            (session_id, login, ip_address, user_agent, last_activity)
-                            VALUES (?, ?, ?, ?, ?)
-                        ''', (session_id, login, ip_address, user_agent, now))
-                    
-                    # Обновляем пользователя
-                    c.execute('''
-                        UPDATE users 
-                        SET last_heartbeat = ?, ip_address = ?, user_agent = ?
-                        WHERE login = ?
-                    ''', (now, ip_address, user_agent, login))
-                    
-                    conn.commit()
-            except Exception as e:
-                logger.error(f"Ошибка обновления heartbeat: {e}")
-            finally:
-                if conn:
-                    conn.close()
-            
-            return jsonify({
-                'status': 'ok', 
-                'timestamp': now,
-                'online': True,
-                'inactivity_timeout': INACTIVITY_TIMEOUT,
-                'inactivity_minutes': INACTIVITY_TIMEOUT // 60
-            })
-                
+        
+        # Сессия и пользователь пишутся в БД пакетно
+        HEARTBEAT_FLUSHER.mark(login, now, request.remote_addr, request.headers.get('User-Agent', ''))
+        
+        return jsonify({
+            'status': 'ok', 
+            'timestamp': now,
+            'online': True,
+            'inactivity_timeout': INACTIVITY_TIMEOUT,
+            'inactivity_minutes': INACTIVITY_TIMEOUT // 60
+        })
+    
     except Exception as e:
         logger.error(f"Ошибка heartbeat: {e}")
         return jsonify({'status': 'error'}), 500
@@ -9,3 +9,9 @@ max_requests_jitter = 100
 loglevel = "info"
 accesslog = "-"
 errorlog = "-"
+
+
+def worker_exit(server, worker):
+    """Дописываем очередь сообщений в БД перед завершением воркера"""
+    from app import MESSAGE_WRITER
+    MESSAGE_WRITER.stop()
@@ -6,6 +6,9 @@ class CloudChat {
         this.chatId = null;
         this.partner = null;
         this.lastTs = 0;
+        this.lastSeq = 0;
+        this.lastEventId = null;
+        this.sseRetryDelay = 5000;
         this.isRecording = false;
         this.isSending = false;
         this.connectionStatus = 'disconnected';
@@ -43,6 +46,7 @@ class CloudChat {
         this.recordingType = null;
         this.recordingSeconds = 0;
         this.recordingMaxSeconds = 60;
+        this.CHUNKED_UPLOAD_THRESHOLD = 5 * 1024 * 1024; // Большие файлы грузим кусками с дозагрузкой
         
         // DOM элементы
         this.elements = {};
@@ -507,10 +511,7 @@ class CloudChat {
                 this.clearChat();
                 
                 // Останавливаем опрос чата
-                if (this.chatPollInterval) {
-                    clearInterval(this.chatPollInterval);
-                    this.chatPollInterval = null;
-                }
+                this.stopChatPolling();
                 
                 // Останавливаем проверку очереди
                 if (this.waitingCheckInterval) {
@@ -609,83 +610,126 @@ class CloudChat {
     startWaitingForPartner() {
         if (this.waitingCheckInterval) clearInterval(this.waitingCheckInterval);
         
-        this.waitingCheckInterval = setInterval(async () => {
-            if (!this.login) return;
+        // Позиция и найденный собеседник приходят через SSE, опрос - только страховка
+        this.waitingCheckInterval = setInterval(() => {
+            if (this.sseConnection && this.sseConnection.readyState === EventSource.OPEN) return;
+            this.checkWaitingStatus();
+        }, 3000);
+    }
+    
+    async checkWaitingStatus() {
+        if (!this.login || this.chatId) return;
+        
+        try {
+            const response = await fetch(`/chat_status?login=${this.login}`);
+            const status = await response.json();
             
-            try {
-                const response = await fetch(`/chat_status?login=${this.login}`);
-                const status = await response.json();
+            if (status.in_chat) {
+                // Найден собеседник
+                clearInterval(this.waitingCheckInterval);
+                this.waitingCheckInterval = null;
                 
-                if (status.in_chat) {
-                    // Найден собеседник
-                    clearInterval(this.waitingCheckInterval);
-                    this.waitingCheckInterval = null;
-                    
-                    this.chatId = status.chat_id;
-                    this.partner = status.partner;
-                    this.updateChatUI(true);
-                    this.showToast(`Соединено с ${this.partner}`, 'success');
-                    
-                    // Очищаем чат и начинаем опрос
-                    this.clearChat();
-                    this.startChatPolling();
-                    
-                    // Скрываем кнопку остановки поиска
-                    this.elements.stopSearchBtn.classList.add('hidden');
-                }
-            } catch (error) {
-                console.error('Ошибка проверки очереди:', error);
+                this.chatId = status.chat_id;
+                this.partner = status.partner;
+                this.updateChatUI(true);
+                this.showToast(`Соединено с ${this.partner}`, 'success');
+                
+                // Очищаем чат и начинаем опрос
+                this.clearChat();
+                this.startChatPolling();
+                
+                // Скрываем кнопку остановки поиска
+                this.elements.stopSearchBtn.classList.add('hidden');
+            } else if (status.waiting_position) {
+                this.updateWaitingPosition(status.waiting_position);
             }
-        }, 3000);
+        } catch (error) {
+            console.error('Ошибка проверки очереди:', error);
+        }
+    }
+    
+    updateWaitingPosition(position) {
+        if (this.chatId) return;
+        this.updateChatStatus('connecting', `Поиск собеседника... Позиция: ${position}`);
     }
     
     startChatPolling() {
-        if (this.chatPollInterval) clearInterval(this.chatPollInterval);
+        // Цикл долгого опроса: сервер держит запрос, пока не появится новое сообщение
+        this.stopChatPolling();
+        const token = {};
+        this.chatPollInterval = token;
+        this.runChatPolling(token);
+    }
+    
+    stopChatPolling() {
+        this.chatPollInterval = null;
+    }
+    
+    async runChatPolling(token) {
+        const pause = (ms) => new Promise(resolve => setTimeout(resolve, ms));
         
-        this.chatPollInterval = setInterval(async () => {
-            if (!this.login || !this.chatId) return;
+        while (this.chatPollInterval === token) {
+            // Пока открыт SSE, сообщения приходят по нему - опрос не нужен
+            if (!this.login || !this.chatId ||
+                (this.sseConnection && this.sseConnection.readyState === EventSource.OPEN)) {
+                await pause(2000);
+                continue;
+            }
             
-            try {
-                const response = await fetch(`/poll_private?login=${this.login}&chat_id=${this.chatId}&since=${this.lastTs}`);
-                const data = await response.json();
-                
-                if (data.error) {
-                    // Ошибка доступа к чату
-                    if (data.error.includes('Доступ к чату запрещен') || data.error.includes('Вы не состоите в этом чате')) {
-                        this.chatId = null;
-                        this.partner = null;
-                        this.updateChatUI(false);
-                        this.showToast('Собеседник покинул чат', 'warning');
-                        clearInterval(this.chatPollInterval);
-                        this.chatPollInterval = null;
-                        return;
-                    }
+            const ok = await this.pollChat(25);
+            if (!ok) {
+                await pause(2000);
+            }
+        }
+    }
+    
+    async pollChat(wait = 0) {
+        if (!this.login || !this.chatId) return false;
+        
+        try {
+            // Браузер сам пришлет If-None-Match: без новых сообщений сервер ответит 304 без тела
+            const response = await fetch(`/poll_private?login=${this.login}&chat_id=${this.chatId}&since_seq=${this.lastSeq}&wait=${wait}`);
+            const data = await response.json();
+            
+            if (data.error) {
+                // Ошибка доступа к чату
+                if (data.error.includes('Доступ к чату запрещен') || data.error.includes('Вы не состоите в этом чате')) {
+                    this.chatId = null;
+                    this.partner = null;
+                    this.updateChatUI(false);
+                    this.showToast('Собеседник покинул чат', 'warning');
+                    this.stopChatPolling();
                 }
-                
-                if (data.messages?.length) {
-                    data.messages.forEach(msg => {
-                        if (msg.ts > this.lastTs) {
-                            this.renderMessage(msg);
-                            this.lastTs = msg.ts;
-                            
-                            // Воспроизводим звук для новых сообщений (кроме своих)
-                            if (msg.login !== this.login && msg.login !== 'Система') {
-                                this.playNotificationSound();
-                            }
+                return false;
+            }
+            
+            if (data.messages?.length) {
+                data.messages.forEach(msg => {
+                    if (!this.messageCache.has(msg.id)) {
+                        this.renderMessage(msg);
+                        
+                        // Воспроизводим звук для новых сообщений (кроме своих)
+                        if (msg.login !== this.login && msg.login !== 'Система') {
+                            this.playNotificationSound();
                         }
-                    });
-                }
-                
-                // Обновляем информацию о партнере
-                if (data.partner && data.partner !== this.partner) {
-                    this.partner = data.partner;
-                    this.updateChatUI(true);
-                }
-                
-            } catch (error) {
-                console.error('Ошибка опроса чата:', error);
+                    }
+                });
+            }
+            if (data.last_seq) {
+                this.lastSeq = Math.max(this.lastSeq, data.last_seq);
+            }
+            
+            // Обновляем информацию о партнере
+            if (data.partner && data.partner !== this.partner) {
+                this.partner = data.partner;
+                this.updateChatUI(true);
             }
-        }, 2000);
+            
+            return response.ok;
+        } catch (error) {
+            console.error('Ошибка опроса чата:', error);
+            return false;
+        }
     }
     
     // ===== ЗАПИСЬ МЕДИА =====
@@ -827,15 +871,17 @@ class CloudChat {
             type: this.recordingType === 'voice' ? 'audio/webm' : 'video/webm'
         });
         
-        const base64 = await this.blobToBase64(blob);
         const endpoint = this.recordingType === 'voice' ? '/voice' : '/video';
         
         try {
-            await this.apiRequest(endpoint, {
-                login: this.login,
-                chat_id: this.chatId,
-                [this.recordingType]: base64.split(',')[1]
-            });
+            if (blob.size > this.CHUNKED_UPLOAD_THRESHOLD) {
+                await this.uploadResumable(blob, this.recordingType, `${this.recordingType}.webm`);
+            } else {
+                await this.apiUpload(endpoint, blob, {
+                    'X-Login': encodeURIComponent(this.login),
+                    'X-Chat-Id': this.chatId
+                });
+            }
             
             this.showToast(`${this.recordingType === 'voice' ? 'Голосовое' : 'Видео'} сообщение отправлено`, 'success');
             
@@ -990,8 +1036,11 @@ class CloudChat {
             this.autoScroll();
         }
         
-        // Обновление времени последнего сообщения
+        // Обновление времени и номера последнего сообщения
         this.lastTs = Math.max(this.lastTs, msg.ts);
+        if (msg.seq) {
+            this.lastSeq = Math.max(this.lastSeq, msg.seq);
+        }
     }
     
     createMessageElement(msg, isMine, isSystem) {
@@ -1059,6 +1108,11 @@ class CloudChat {
         }
     }
     
+    getMediaSrc(msg) {
+        // Новые сообщения ссылаются на файл, старые несут data URI
+        return msg.media_url || msg.mediadata;
+    }
+    
     createVoiceMessage(msg) {
         return `
             <div class="telegram-voice-message" data-voice-id="${msg.id}">
@@ -1071,7 +1125,7 @@ class CloudChat {
                     </div>
                     <span class="voice-duration">0:00</span>
                 </div>
-                <audio src="${msg.mediadata}" preload="metadata"></audio>
+                <audio src="${this.getMediaSrc(msg)}" preload="metadata"></audio>
             </div>
         `;
     }
@@ -1083,7 +1137,7 @@ class CloudChat {
             return `
                 <div class="telegram-video-circle" data-video-id="${msg.id}">
                     <video class="video-circle-player" muted playsinline preload="metadata" style="transform: scaleX(-1);">
-                        <source src="${msg.mediadata}" type="video/webm">
+                        <source src="${this.getMediaSrc(msg)}" type="video/webm">
                     </video>
                     <div class="video-circle-overlay">
                         <button class="video-circle-play-btn" type="button">▶</button>
@@ -1100,7 +1154,7 @@ class CloudChat {
             return `
                 <div class="telegram-video-file" data-video-id="${msg.id}">
                     <video class="video-file-player" preload="metadata" playsinline>
-                        <source src="${msg.mediadata}" type="video/mp4">
+                        <source src="${this.getMediaSrc(msg)}" type="video/mp4">
                     </video>
                     <div class="video-file-controls">
                         <button class="video-file-play-btn" type="button">▶</button>
@@ -1137,23 +1191,30 @@ class CloudChat {
                     </div>
                     <div class="audio-time">0:00 / 0:00</div>
                 </div>
-                <audio src="${msg.mediadata}" preload="metadata"></audio>
+                <audio src="${this.getMediaSrc(msg)}" preload="metadata"></audio>
             </div>
         `;
     }
     
     createImageMessage(msg) {
+        // Миниатюра поверх размытой заглушки; полный размер грузится только по клику
+        const src = this.getMediaSrc(msg);
+        const placeholder = msg.placeholder_url
+            ? `style="background: url('${msg.placeholder_url}') center / cover no-repeat;"`
+            : '';
         return `
             <div class="image-message-container">
-                <img src="${msg.mediadata}" 
+                <img src="${msg.thumb_url || src}" 
+                     data-full="${msg.full_url || src}"
                      class="telegram-photo" 
                      alt="Фото" 
                      loading="lazy"
-                     onclick="window.cloudChat.showFullscreenImage(this.src)">
+                     ${placeholder}
+                     onclick="window.cloudChat.showFullscreenImage(this.dataset.full)">
                 <div class="file-menu">
                     <button class="file-menu-btn" type="button">⋮</button>
                     <div class="file-menu-dropdown">
-                        <a href="${msg.mediadata}" 
+                        <a href="${src}" 
                            download="${msg.filename || 'image.jpg'}" 
                            class="download-link">
                             Скачать
@@ -1165,7 +1226,7 @@ class CloudChat {
     }
     
     createFileMessage(msg) {
-        const fileSize = this.formatFileSize(msg.mediadata ? msg.mediadata.length * 3 / 4 : 0);
+        const fileSize = this.formatFileSize(msg.filesize || (msg.mediadata ? msg.mediadata.length * 3 / 4 : 0));
         return `
             <div class="telegram-file">
                 <div class="file-icon">📄</div>
@@ -1176,7 +1237,7 @@ class CloudChat {
                 <div class="file-menu">
                     <button class="file-menu-btn" type="button">⋮</button>
                     <div class="file-menu-dropdown">
-                        <a href="${msg.mediadata}" 
+                        <a href="${this.getMediaSrc(msg)}" 
                            download="${msg.filename || 'file'}" 
                            class="download-link">
                             Скачать
@@ -1530,21 +1591,40 @@ class CloudChat {
             this.sseConnection.close();
         }
         
-        this.sseConnection = new EventSource(`/events?login=${this.login}`);
+        // Номер последнего события - сервер дошлет пропущенное за время обрыва (0 - тоже номер)
+        const resume = this.lastEventId != null ? `&last_event_id=${this.lastEventId}` : '';
+        this.sseConnection = new EventSource(`/events?login=${encodeURIComponent(this.login)}&v=2${resume}`);
         
         this.sseConnection.onopen = () => {
             console.log('SSE соединение установлено');
             this.updateConnectionStatus('connected');
+            this.sseRetryDelay = 5000;
         };
         
         this.sseConnection.onmessage = (event) => {
             try {
                 const data = JSON.parse(event.data);
+                if (event.lastEventId) {
+                    this.lastEventId = Number(event.lastEventId);
+                }
                 
                 if (data.type === 'private_message') {
                     this.handlePrivateMessage(data);
+                } else if (data.type === 'queue_position') {
+                    this.updateWaitingPosition(data.position);
                 } else if (data.type === 'connected') {
                     console.log('SSE подключен');
+                } else if (data.type === 'resync') {
+                    if (data.reason === 'slow_consumer') {
+                        // Сервер отключил нас за отставание - сразу переподключаемся с id из подсказки
+                        if (data.last_event_id != null) {
+                            this.lastEventId = data.last_event_id;
+                        }
+                        this.connectSSE();
+                    } else {
+                        // Пропущенные события уже не восстановить - перечитываем состояние
+                        this.resyncState();
+                    }
                 }
             } catch (e) {
                 console.error('Ошибка обработки SSE:', e);
@@ -1559,10 +1639,21 @@ class CloudChat {
             if (this.sseConnection) {
                 this.sseConnection.close();
             }
-            setTimeout(() => this.connectSSE(), 5000);
+            // Экспоненциальная задержка: перегруженный сервер отвечает 503 и просит подождать
+            setTimeout(() => this.connectSSE(), this.sseRetryDelay);
+            this.sseRetryDelay = Math.min(this.sseRetryDelay * 2, 60000);
         };
     }
     
+    resyncState() {
+        if (!this.chatId) {
+            this.checkWaitingStatus();
+        } else {
+            // Разовый опрос дозагрузит сообщения после lastSeq (since_seq)
+            this.pollChat();
+        }
+    }
+    
     handlePrivateMessage(data) {
         const message = data.data;
         
@@ -1570,6 +1661,9 @@ class CloudChat {
         if (message.chat_id === this.chatId) {
             this.renderMessage(message);
             this.playNotificationSound();
+        } else if (!this.chatId && this.waitingCheckInterval) {
+            // Нас сопоставили из очереди - забираем данные чата
+            this.checkWaitingStatus();
         }
     }
     
@@ -1798,6 +1892,76 @@ class CloudChat {
         return await response.json();
     }
     
+    async apiUpload(endpoint, body, headers) {
+        // Файл уходит как есть, без base64: метаданные в заголовках
+        const response = await fetch(endpoint, {
+            method: 'POST',
+            headers: { 'Content-Type': body.type || 'application/octet-stream', ...headers },
+            body
+        });
+        
+        if (!response.ok) {
+            const errorText = await response.text();
+            throw new Error(`HTTP ${response.status}: ${errorText}`);
+        }
+        
+        return await response.json();
+    }
+    
+    async uploadResumable(blob, mediaType, filename) {
+        // Загрузка кусками: после обрыва досылаем только то, чего нет на сервере
+        const upload = await this.apiRequest('/uploads', {
+            login: this.login,
+            chat_id: this.chatId,
+            type: mediaType,
+            filename: filename,
+            size: blob.size,
+            mime: blob.type
+        });
+        
+        const uploadUrl = `/uploads/${upload.upload_id}`;
+        let received = upload.received;
+        
+        for (let attempt = 0; ; attempt++) {
+            try {
+                for (let start = 0; start < blob.size; start += upload.chunk_size) {
+                    const end = Math.min(start + upload.chunk_size, blob.size);
+                    if (received.some(([from, to]) => from <= start && end <= to)) continue;
+                    
+                    const response = await fetch(uploadUrl, {
+                        method: 'PUT',
+                        headers: {
+                            'Content-Type': 'application/octet-stream',
+                            'Content-Range': `bytes ${start}-${end - 1}/${blob.size}`,
+                            'X-Login': encodeURIComponent(this.login)
+                        },
+                        body: blob.slice(start, end)
+                    });
+                    
+                    if (!response.ok) {
+                        throw new Error(`HTTP ${response.status}: ${await response.text()}`);
+                    }
+                    received = (await response.json()).received;
+                }
+                break;
+            } catch (error) {
+                if (attempt >= 5) throw error;
+                console.warn('Обрыв загрузки, повтор:', error);
+                await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)));
+                
+                // Узнаем, какие диапазоны сервер уже получил
+                const status = await fetch(`${uploadUrl}?login=${encodeURIComponent(this.login)}`).catch(() => null);
+                if (status && status.ok) {
+                    received = (await status.json()).received;
+                } else if (status && status.status === 404) {
+                    throw error;
+                }
+            }
+        }
+        
+        return await this.apiRequest(`${uploadUrl}/finalize`, { login: this.login });
+    }
+    
     escapeHtml(text) {
         const div = document.createElement('div');
         div.textContent = text;
@@ -1819,23 +1983,6 @@ class CloudChat {
         return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
     }
     
-    async blobToBase64(blob) {
-        return new Promise((resolve) => {
-            const reader = new FileReader();
-            reader.onload = () => resolve(reader.result);
-            reader.readAsDataURL(blob);
-        });
-    }
-    
-    async readFileAsBase64(file) {
-        return new Promise((resolve, reject) => {
-            const reader = new FileReader();
-            reader.onload = () => resolve(reader.result);
-            reader.onerror = reject;
-            reader.readAsDataURL(file);
-        });
-    }
-    
     async selectMedia() {
         if (!this.login || !this.chatId || this.isRecording) return;
 
@@ -1854,16 +2001,18 @@ class CloudChat {
                 }
                 
                 try {
-                    const base64 = await this.readFileAsBase64(file);
                     const mediaType = this.detectMediaType(file);
                     
-                    await this.apiRequest('/media', {
-                        login: this.login,
-                        chat_id: this.chatId,
-                        type: mediaType,
-                        data: base64.split(',')[1],
-                        filename: file.name
-                    });
+                    if (file.size > this.CHUNKED_UPLOAD_THRESHOLD) {
+                        await this.uploadResumable(file, mediaType, file.name);
+                    } else {
+                        await this.apiUpload('/media', file, {
+                            'X-Login': encodeURIComponent(this.login),
+                            'X-Chat-Id': this.chatId,
+                            'X-Media-Type': mediaType,
+                            'X-Filename': encodeURIComponent(file.name)
+                        });
+                    }
                     
                     this.showToast('Файл отправлен', 'success');
                 } catch (error) {
@@ -1925,6 +2074,7 @@ class CloudChat {
         this.messageStatus.clear();
         this.pendingMessages.clear();
         this.lastTs = 0;
+        this.lastSeq = 0;
     }
     
     showWelcomeMessage() {
@@ -2004,7 +2154,7 @@ class CloudChat {
         // Очищаем интервалы
         if (this.heartbeatInterval) clearInterval(this.heartbeatInterval);
         if (this.recordingTimerInterval) clearInterval(this.recordingTimerInterval);
-        if (this.chatPollInterval) clearInterval(this.chatPollInterval);
+        this.stopChatPolling();
         if (this.waitingCheckInterval) clearInterval(this.waitingCheckInterval);
         if (this.inactivityTimer) clearTimeout(this.inactivityTimer);
         
@@ -2034,6 +2184,8 @@ class CloudChat {
         this.chatId = null;
         this.partner = null;
         this.lastTs = 0;
+        this.lastSeq = 0;
+        this.lastEventId = null;
         this.autoScrollEnabled = true;
         
         // Очищаем интерфейс
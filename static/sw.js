@@ -51,7 +51,8 @@ self.addEventListener('fetch', (event) => {
       url.pathname.startsWith('/send') ||
       url.pathname.startsWith('/voice') ||
       url.pathname.startsWith('/video') ||
-      url.pathname.startsWith('/media')) {
+      url.pathname.startsWith('/media') ||
+      url.pathname.startsWith('/uploads')) {
     return fetch(event.request);
   }
   
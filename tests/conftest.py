@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """Модуль app с БД и медиа во временном каталоге"""
+    pytest.importorskip('flask')
+    pytest.importorskip('PIL')
+    
+    work = tmp_path_factory.mktemp('cloudchat')
+    os.chdir(work)
+    os.environ['MEDIA_DIR'] = str(work / 'media')
+    
+    import app
+    app.init_db()
+    yield app
+    app.MESSAGE_WRITER.stop()
+    app.IMAGE_PROCESSOR.shutdown()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,143 @@
+import itertools
+import time
+import uuid
+
+import pytest
+
+PAIR_IDS = itertools.count(1)
+
+
+@pytest.fixture
+def chat(app_module):
+    """Свежий приватный чат двух онлайн-пользователей: (chat_id, user1, user2)"""
+    n = next(PAIR_IDS)
+    user1, user2 = f'chat_user_a{n}', f'chat_user_b{n}'
+    for user in (user1, user2):
+        app_module.ONLINE_USERS.add(user)
+        app_module.USER_LAST_ACTIVE[user] = time.time()
+    chat_id = app_module.create_private_chat(user1, user2)
+    assert chat_id
+    yield chat_id, user1, user2
+    for user in (user1, user2):
+        app_module.remove_user_from_all_queues(user)
+
+
+@pytest.mark.parametrize('param', ['wait', 'since'])
+@pytest.mark.parametrize('value', ['nan', 'inf', '-inf', 'abc'])
+def test_poll_rejects_non_finite_params(client, chat, param, value):
+    chat_id, user1, _ = chat
+    started = time.time()
+    response = client.get(f'/poll_private?login={user1}&chat_id={chat_id}&since_seq=0&{param}={value}')
+    assert response.status_code == 400
+    assert time.time() - started < 5
+
+
+def chat_message(chat_id, login, text, ts=None, msg_id=None):
+    return {
+        'id': msg_id or str(uuid.uuid4()),
+        'chat_id': chat_id,
+        'login': login,
+        'text': text,
+        'ts': time.time() if ts is None else ts
+    }
+
+
+def test_message_ring_wraps_around(app_module):
+    ring = app_module.MessageRing(capacity=4)
+    for n in range(6):
+        assert ring.append({'n': n}) == n + 1
+
+    assert len(ring) == 4
+    assert ring.first_seq == 3
+    assert [m['seq'] for m in ring] == [3, 4, 5, 6]
+    assert [m['n'] for m in ring.since(4)] == [4, 5]
+    # Вытесненное не возвращается, запрос с начала отдает то, что осталось
+    assert [m['seq'] for m in ring.since(0)] == [3, 4, 5, 6]
+    assert ring.since(6) == []
+    assert ring.last()['seq'] == 6
+
+
+def test_poll_since_seq_and_truncated(app_module, client, chat):
+    chat_id, user1, user2 = chat
+    room = app_module.PRIVATE_CHATS[chat_id]
+    room['messages'] = app_module.MessageRing(capacity=3)
+    for n in range(5):
+        app_module.append_chat_message(room, chat_message(chat_id, user2, f'msg {n}'))
+
+    data = client.get(f'/poll_private?login={user1}&chat_id={chat_id}&since_seq=3').get_json()
+    assert [m['seq'] for m in data['messages']] == [4, 5]
+    assert data['last_seq'] == 5
+    assert data['truncated'] is False
+
+    data = client.get(f'/poll_private?login={user1}&chat_id={chat_id}&since_seq=0').get_json()
+    assert [m['text'] for m in data['messages']] == ['msg 2', 'msg 3', 'msg 4']
+    assert data['truncated'] is True
+
+
+def test_poll_etag_not_modified(app_module, client, chat):
+    chat_id, user1, user2 = chat
+    room = app_module.PRIVATE_CHATS[chat_id]
+    app_module.append_chat_message(room, chat_message(chat_id, user2, 'hello'))
+    url = f'/poll_private?login={user1}&chat_id={chat_id}&since_seq=0'
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    cached = client.get(url, headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == etag
+
+    # Новое сообщение меняет ETag
+    app_module.append_chat_message(room, chat_message(chat_id, user2, 'again'))
+    fresh = client.get(url, headers={'If-None-Match': etag})
+    assert fresh.status_code == 200
+    assert fresh.headers['ETag'] != etag
+    assert [m['text'] for m in fresh.get_json()['messages']] == ['hello', 'again']
+
+
+def test_parse_history_cursor(app_module):
+    assert app_module.parse_history_cursor('') is None
+    assert app_module.parse_history_cursor('1700000000.5') == (1700000000.5, None)
+    assert app_module.parse_history_cursor('1700000000.5:abc') == (1700000000.5, 'abc')
+    with pytest.raises(ValueError):
+        app_module.parse_history_cursor('yesterday:abc')
+
+
+def test_history_pages_equal_ts_exactly_once(app_module, client, chat):
+    chat_id, user1, user2 = chat
+    base = 1700000000.25
+    # Много сообщений с одинаковым ts: граница страницы проходит внутри группы
+    messages = [
+        chat_message(chat_id, user1 if n % 2 else user2, f'msg {n}', ts=base + n // 4, msg_id=f'{chat_id}-{n:03d}')
+        for n in range(11)
+    ]
+    app_module.save_messages(messages)
+
+    seen = []
+    before = ''
+    pages = 0
+    while True:
+        response = client.get(f'/history?login={user1}&chat_id={chat_id}&limit=3&before={before}')
+        assert response.status_code == 200
+        data = response.get_json()
+        page = [m['id'] for m in data['messages']]
+        assert len(page) <= 3
+        # Внутри страницы - от старых к новым, страницы идут от новых к старым
+        seen = page + seen
+        pages += 1
+        if not data['has_more']:
+            assert data['next_before'] is None
+            break
+        before = data['next_before']
+
+    expected = sorted((m['ts'], m['id']) for m in messages)
+    assert seen == [msg_id for _, msg_id in expected]
+    assert pages == 4
+
+
+def test_history_rejects_bad_params(client, chat):
+    chat_id, user1, _ = chat
+    assert client.get(f'/history?login={user1}&chat_id={chat_id}&before=abc:1').status_code == 400
+    assert client.get(f'/history?login={user1}&chat_id={chat_id}&limit=x').status_code == 400
+    assert client.get(f'/history?login=stranger&chat_id={chat_id}').status_code == 401
@@ -0,0 +1,112 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT
+
+# Под gevent задачи с многомегабайтными файлами не должны замораживать хаб
+GEVENT_SCRIPT = '''
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import os
+import sys
+import time
+
+import gevent
+
+os.chdir(sys.argv[1])
+os.environ['MEDIA_DIR'] = os.path.join(sys.argv[1], 'media')
+sys.path.insert(0, sys.argv[2])
+
+import app
+from PIL import Image
+
+digests = []
+for seed in range(3):
+    img = Image.frombytes('RGB', (2400, 2400), os.urandom(2400 * 2400 * 3))
+    path = os.path.join(sys.argv[1], f'{seed}.jpg')
+    img.save(path, format='JPEG', quality=95)
+    with open(path, 'rb') as f:
+        digests.append(app.BLOB_STORE.put_bytes(f.read()))
+    app.BLOB_STORE.remember_mime(digests[-1], 'image/jpeg')
+
+ticks = [0]
+def ticker():
+    while True:
+        gevent.sleep(0.05)
+        ticks[0] += 1
+gevent.spawn(ticker)
+
+started = time.time()
+jobs = [gevent.spawn(app.compress_image_data, digest, 'image/jpeg') for digest in digests]
+# Варианты через маршрут: процесс пула сам читает оригинал из хранилища
+client = app.app.test_client()
+def fetch_variant(digest):
+    response = client.get(f'/media/{digest}/thumb')
+    return response.status_code == 200 and response.mimetype == 'image/jpeg'
+jobs += [gevent.spawn(fetch_variant, digest) for digest in digests]
+gevent.joinall(jobs, timeout=60)
+
+print(json.dumps({
+    'done': sum(job.ready() for job in jobs),
+    'results': sum(bool(job.value) for job in jobs),
+    'elapsed': time.time() - started,
+    'ticks': ticks[0],
+    'pending': app.IMAGE_PROCESSOR.stats()['pending'],
+    'sizes': [os.path.getsize(app.BLOB_STORE.path(d)) for d in digests]
+}))
+app.IMAGE_PROCESSOR.shutdown()
+'''
+
+
+def test_concurrent_jobs_under_gevent(tmp_path):
+    pytest.importorskip('gevent')
+    pytest.importorskip('PIL')
+    pytest.importorskip('flask')
+    
+    proc = subprocess.run(
+        [sys.executable, '-c', GEVENT_SCRIPT, str(tmp_path), ROOT],
+        capture_output=True, text=True, timeout=120,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    report = json.loads(proc.stdout.strip().splitlines()[-1])
+    
+    assert min(report['sizes']) > 2 * 1024 * 1024
+    assert report['done'] == 6
+    assert report['results'] == 6
+    assert report['pending'] == 0
+    # Хаб жил все время обработки: тикер успевал просыпаться
+    assert report['ticks'] >= report['elapsed'] / 0.05 / 4
+
+
+def slow_job(data, delay):
+    time.sleep(delay)
+    return 'application/octet-stream', data
+
+
+def test_timed_out_job_stays_pending_until_finished(app_module, tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(b'x' * 1024)
+    processor = app_module.ImageProcessor(workers=1, timeout=30)
+    try:
+        # Прогреваем пул, чтобы таймаут пришелся на работу, а не на запуск процесса
+        assert processor.run(slow_job, str(src), 0) == ('application/octet-stream', b'x' * 1024)
+        
+        processor.timeout = 0.2
+        assert processor.run(slow_job, str(src), 1.5) is None
+        assert processor.stats()['timeouts'] == 1
+        assert processor.stats()['pending'] == 1
+        
+        deadline = time.time() + 10
+        while processor.stats()['pending'] and time.time() < deadline:
+            time.sleep(0.05)
+        assert processor.stats()['pending'] == 0
+    finally:
+        processor.shutdown()
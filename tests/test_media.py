@@ -0,0 +1,89 @@
+import base64
+import os
+import struct
+
+import pytest
+
+
+def bmp_head(dib_size=40):
+    return b'BM' + struct.pack('<IHHI', 1078, 0, 0, 54) + struct.pack('<I', dib_size) + b'\x00' * 14
+
+
+def ftyp_head(brand):
+    return struct.pack('>I', 24) + b'ftyp' + brand + b'\x00\x00\x00\x00' + b'mif1heic'
+
+
+def test_bmp_requires_dib_header(app_module):
+    assert app_module.sniff_mime(bmp_head()) == 'image/bmp'
+    assert app_module.sniff_mime(bmp_head(124)) == 'image/bmp'
+    # Текст, который начинается с "BM", картинкой не считается
+    assert app_module.sniff_mime(b'BMW is a car manufacturer from Munich') is None
+    assert app_module.resolve_media_mime(b'BMW is a car manufacturer', 'text/plain', 'file') == 'text/plain'
+
+
+def test_riff_subtypes_require_riff(app_module):
+    assert app_module.sniff_mime(b'RIFF\x24\x00\x00\x00WAVEfmt ') == 'audio/wav'
+    assert app_module.sniff_mime(b'RIFF\x24\x00\x00\x00AVI LIST') == 'video/x-msvideo'
+    assert app_module.sniff_mime(b'RIFF\x24\x00\x00\x00WEBPVP8 ') == 'image/webp'
+    assert app_module.sniff_mime(b'hello, WAVE and AVI world') is None
+    assert app_module.sniff_mime(b'12345678WAVEfmt ') is None
+
+
+@pytest.mark.parametrize('brand, mime', [
+    (b'heic', 'image/heic'),
+    (b'heix', 'image/heic'),
+    (b'mif1', 'image/heif'),
+])
+def test_heic_accepted_as_image(app_module, brand, mime):
+    head = ftyp_head(brand)
+    assert app_module.resolve_media_mime(head, 'image/heic', 'image') == mime
+    with pytest.raises(ValueError):
+        app_module.resolve_media_mime(head, 'video/mp4', 'video')
+
+
+def test_mp4_still_ambiguous_container(app_module):
+    head = ftyp_head(b'isom')
+    assert app_module.resolve_media_mime(head, 'video/mp4', 'video') == 'video/mp4'
+    assert app_module.resolve_media_mime(head, 'audio/mp4', 'voice') == 'audio/mp4'
+    with pytest.raises(ValueError):
+        app_module.resolve_media_mime(head, 'image/jpeg', 'image')
+
+
+def test_heic_is_not_transformed(app_module):
+    digest = app_module.BLOB_STORE.put_bytes(ftyp_head(b'heic') + b'\x00' * 200000)
+    app_module.BLOB_STORE.remember_mime(digest, 'image/heic')
+    assert app_module.compress_image_data(digest, 'image/heic') is None
+
+
+def read_all(reader):
+    parts = []
+    while True:
+        part = reader.read()
+        if not part:
+            return b''.join(parts)
+        parts.append(part)
+
+
+def test_base64_reader_accepts_mime_wrapped_input(app_module):
+    payload = os.urandom(5000)
+    wrapped = base64.encodebytes(payload).decode()  # По 76 символов в строке
+    assert '\n' in wrapped
+    # Маленькие куски - группы из 4 символов рвутся переносами на границах кусков
+    for chunk_chars in (7, 64, 1000, 65536):
+        reader = app_module.Base64Reader(wrapped, chunk_chars=chunk_chars)
+        assert read_all(reader) == payload
+    crlf = wrapped.replace('\n', '\r\n')
+    assert read_all(app_module.Base64Reader(crlf, chunk_chars=50)) == payload
+
+
+def test_base64_reader_rejects_foreign_alphabet(app_module):
+    with pytest.raises(ValueError):
+        read_all(app_module.Base64Reader('QUJD*EVG', chunk_chars=4))
+
+
+def test_store_wrapped_base64_image(app_module):
+    head = b'\x89PNG\r\n\x1a\n' + b'\x00' * 300
+    data = 'data:image/png;base64,' + base64.encodebytes(head).decode()
+    digest, mime_type, size = app_module.store_base64_media(data, 'image', 'image/png', 1)
+    assert mime_type == 'image/png'
+    assert size == len(head)
@@ -0,0 +1,27 @@
+import threading
+import time
+
+
+def test_submit_racing_stop_is_not_lost(app_module, monkeypatch):
+    saved = []
+    monkeypatch.setattr(app_module, 'save_messages', lambda messages: saved.extend(messages))
+
+    class RacingWriter(app_module.MessageWriter):
+        def start(self):
+            super().start()
+            # stop() приходит между проверкой stopped и постановкой в очередь
+            if not getattr(self, 'raced', False):
+                self.raced = True
+                threading.Thread(target=self.stop).start()
+                time.sleep(0.3)
+
+    writer = RacingWriter(flush_interval=0.01)
+    writer.submit({'id': 'race-1'})
+    deadline = time.time() + 5
+    while writer.thread.is_alive() and time.time() < deadline:
+        time.sleep(0.01)
+    assert [msg['id'] for msg in saved] == ['race-1']
+
+    # После остановки сообщения пишутся синхронно
+    writer.submit({'id': 'race-2'})
+    assert [msg['id'] for msg in saved] == ['race-1', 'race-2']
@@ -0,0 +1,117 @@
+import json
+import time
+
+
+def read_frames(response, count):
+    """Первые count кадров потока SSE: [(id или None, payload)]"""
+    frames = []
+    buffer = b''
+    for chunk in response.response:
+        buffer += chunk
+        while b'\n\n' in buffer and len(frames) < count:
+            raw, buffer = buffer.split(b'\n\n', 1)
+            event_id, payload = None, None
+            for line in raw.decode().splitlines():
+                if line.startswith('id: '):
+                    event_id = int(line[4:])
+                elif line.startswith('data: '):
+                    payload = json.loads(line[6:])
+            if payload is not None:
+                frames.append((event_id, payload))
+        if len(frames) >= count:
+            break
+    return frames
+
+
+def notify(app_module, login, n):
+    app_module.send_push_notification(login, {'type': 'chat_event', 'n': n})
+
+
+def test_overflow_before_first_delivery_replays_from_history(app_module, client):
+    login = 'sse_overflow_user'
+    app_module.ONLINE_USERS.add(login)
+    try:
+        # Событие до подключения: клиенту оно не нужно, но last_id в истории уже не 0
+        notify(app_module, login, -1)
+        baseline = app_module.SSE_HISTORY.last_id
+
+        response = client.get(f'/events?login={login}&v=2', buffered=False)
+        assert read_frames(response, 1)[0][1]['type'] == 'connected'
+
+        # Очередь переполняется раньше, чем генератор успел отправить хоть одно событие
+        total = app_module.SSE_QUEUE_MAX + 5
+        for n in range(total):
+            notify(app_module, login, n)
+
+        _, resync = read_frames(response, 1)[0]
+        response.close()
+        assert resync['type'] == 'resync'
+        assert resync['reason'] == 'slow_consumer'
+        assert resync['last_event_id'] == baseline
+
+        # Переподключение с подсказкой дозагружает все пропущенное из истории
+        response = client.get(f"/events?login={login}&v=2&last_event_id={resync['last_event_id']}", buffered=False)
+        frames = read_frames(response, total + 1)
+        response.close()
+        assert frames[0][1]['type'] == 'connected'
+        assert [payload['n'] for _, payload in frames[1:]] == list(range(total))
+    finally:
+        app_module.ONLINE_USERS.discard(login)
+        app_module.SSE_HISTORY.discard(login)
+
+
+def test_coalesced_status_does_not_overtake_messages(app_module):
+    subscriber = app_module.SSESubscriber('sse_order_user', max_depth=4)
+    status_1 = app_module.SSEEvent({'type': 'queue_position', 'position': 3})
+    message = app_module.SSEEvent({'type': 'chat_event', 'n': 1})
+    status_2 = app_module.SSEEvent({'type': 'queue_position', 'position': 2})
+    for event in (status_1, message, status_2):
+        assert subscriber.put(event)
+
+    # Сообщение уходит раньше статуса с большим id, и Last-Event-ID его не перескакивает
+    assert subscriber.get(0) is message
+    assert subscriber.last_sent_id == message.id
+    assert subscriber.coalesced == 1
+
+    # Переполнение сразу после первой отправки: подсказка resync не дальше неотправленного статуса
+    while subscriber.put(app_module.SSEEvent({'type': 'chat_event', 'n': 2})):
+        pass
+    assert subscriber.overflowed
+    assert subscriber.last_sent_id < status_2.id
+
+
+
+def test_keepalive_silence_bounded_by_interval(app_module):
+    hub = app_module.SSEHub(keepalive=15, slots=15)
+    subscriber = app_module.SSESubscriber('sse_keepalive_user')
+    assert hub.admit(subscriber) is None
+    slot = subscriber.conn_id % len(hub.wheel)
+    now = time.time()
+    period = hub.keepalive / 2  # Ячейка посещается дважды за интервал
+
+    # Пропущенное на этом посещении соединение пингуется на следующем, до конца интервала
+    subscriber.last_active = now - period + 0.1
+    assert hub.sweep(slot, now) == 0
+    assert hub.sweep(slot, now + period) == 1
+    assert (now + period) - subscriber.last_active <= hub.keepalive
+
+    subscriber.last_active = now - period
+    assert hub.sweep(slot, now) == 1
+    hub.remove(subscriber)
+
+
+def test_per_ip_limit_is_off_by_default(app_module):
+    # За роутером PaaS все клиенты приходят с одного адреса
+    hub = app_module.SSEHub()
+    subscribers = [app_module.SSESubscriber(f'sse_ip_user{n}', ip='10.0.0.1') for n in range(30)]
+    assert all(hub.admit(subscriber) is None for subscriber in subscribers)
+    for subscriber in subscribers:
+        hub.remove(subscriber)
+
+    limited = app_module.SSEHub(max_per_ip=2)
+    subscribers = [app_module.SSESubscriber(f'sse_ip_user{n}', ip='10.0.0.1') for n in range(3)]
+    assert limited.admit(subscribers[0]) is None
+    assert limited.admit(subscribers[1]) is None
+    assert limited.admit(subscribers[2])[0] == 429
+    for subscriber in subscribers[:2]:
+        limited.remove(subscriber)
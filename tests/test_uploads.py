@@ -0,0 +1,48 @@
+import hashlib
+import io
+import os
+import threading
+
+import pytest
+
+
+class BlockingStream:
+    """Тело PUT, которое отдает данные только по сигналу"""
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def read(self, size=-1):
+        self.started.set()
+        assert self.release.wait(5)
+        return self.data.read(size)
+
+
+def test_chunks_and_finalize_exclude_each_other(app_module, tmp_path):
+    uploads = app_module.UploadManager(root=str(tmp_path))
+    payload = os.urandom(4096)
+    upload = uploads.create('upload_user', 'chat', 'file', 'a.bin', 'application/octet-stream', len(payload))
+    uploads.write_chunk(upload, 0, len(payload), io.BytesIO(payload))
+    assert uploads.is_complete(upload)
+
+    # Повтор куска еще пишется - завершать нельзя
+    stream = BlockingStream(payload[:1024])
+    writer = threading.Thread(target=uploads.write_chunk, args=(upload, 0, 1024, stream))
+    writer.start()
+    assert stream.started.wait(5)
+    with pytest.raises(app_module.UploadConflictError):
+        uploads.finalize(upload)
+    stream.release.set()
+    writer.join(5)
+
+    digest, size = uploads.finalize(upload)
+    assert digest == hashlib.sha256(payload).hexdigest()
+    assert size == len(payload)
+
+    # Опоздавший кусок после завершения отклоняется и не оставляет сиротский .json
+    with pytest.raises(app_module.UploadConflictError):
+        uploads.write_chunk(upload, 0, 1024, io.BytesIO(payload[:1024]))
+    assert os.listdir(tmp_path) == []
+    assert uploads.writing == {}
+    assert uploads.finalizing == set()